@@ -0,0 +1,57 @@
+"""
+Runs the benchmark suite on a generated corpus, optionally saving the results as a baseline or comparing them
+against one.
+
+Usage:
+    python -m benchmarks --save baseline.json
+    python -m benchmarks --compare baseline.json
+
+Exits with status 1 when ``--compare`` finds a regression.
+"""
+import argparse
+import json
+import platform
+import sys
+from .corpus import access_log_lines
+from .suite import BENCHMARKS, compare, run_benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.split('\n\n')[1])
+    parser.add_argument('--lines', type=int, default=20000, help='number of corpus lines (default 20000)')
+    parser.add_argument('--seed', type=int, default=0, help='corpus random seed (default 0)')
+    parser.add_argument('--only', action='append', choices=[benchmark.name for benchmark in BENCHMARKS],
+                        help='run only this benchmark; may be repeated')
+    parser.add_argument('--save', metavar='PATH', help='write the results to a JSON baseline file')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results against a JSON baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative change that counts as a regression (default 0.2)')
+    args = parser.parse_args(argv)
+
+    lines = access_log_lines(args.lines, seed=args.seed)
+    results = run_benchmarks(lines, args.only)
+    print('{0:<30} {1:>14} {2:>12} {3:>14}'.format('benchmark', 'ops/sec', 'p99 (us)', 'alloc (bytes)'))
+    for name, result in results.items():
+        print('{0:<30} {1[ops_per_sec]:>14,.0f} {1[p99_us]:>12,.1f} {1[alloc_bytes]:>14,.0f}'.format(name, result))
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'python': platform.python_version(),
+                       'corpus': {'lines': args.lines, 'seed': args.seed},
+                       'results': results}, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('corpus') != {'lines': args.lines, 'seed': args.seed}:
+            print('warning: baseline was recorded with a different corpus: {0}'.format(baseline.get('corpus')),
+                  file=sys.stderr)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {0}'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
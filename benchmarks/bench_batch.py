@@ -0,0 +1,36 @@
+"""
+Compares per-line ``convert_combined_log_to_ecs`` with ``convert_combined_log_to_ecs_batch`` at several batch sizes.
+
+Usage:
+    python -m benchmarks.bench_batch
+"""
+import random
+import timeit
+from structlog_extensions.utils import convert_combined_log_to_ecs, convert_combined_log_to_ecs_batch
+
+AGENTS = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{0}.0.3282.186 '
+          'Safari/537.36'.format(version) for version in range(60, 90)]
+REQUESTS = ['GET /static/{0}.css HTTP/1.1'.format(index) for index in range(20)] + ['GET / HTTP/1.1', 'GET /healthz HTTP/1.1']
+TOTAL = 20000
+
+
+def _lines(count):
+    rng = random.Random(42)
+    return ['10.0.{0}.{1} - - [05/Feb/2012:17:{2:02d}:{3:02d} +0000] "{4}" 200 {5} "-" "{6}"'.format(
+        rng.randrange(256), rng.randrange(256), index // 6000 % 60, index // 100 % 60, rng.choice(REQUESTS),
+        rng.randrange(100000), rng.choice(AGENTS)) for index in range(count)]
+
+
+def main():
+    lines = _lines(TOTAL)
+    seconds = timeit.timeit(lambda: [convert_combined_log_to_ecs(line, 'apache.access') for line in lines], number=1)
+    print('{0:<36} {1:>10,.0f} lines/sec'.format('convert_combined_log_to_ecs', TOTAL / seconds))
+    for batch_size in (1, 100, 10000):
+        batches = [lines[start:start + batch_size] for start in range(0, TOTAL, batch_size)]
+        seconds = timeit.timeit(lambda: [convert_combined_log_to_ecs_batch(batch, 'apache.access') for batch in batches],
+                                number=1)
+        print('{0:<36} {1:>10,.0f} lines/sec'.format('batch size {0}'.format(batch_size), TOTAL / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Compares the memory held by converted access log events kept as dicts and as ``EcsAccessEvent`` objects.
+
+Usage:
+    python -m benchmarks.bench_event_memory
+"""
+import gc
+import tracemalloc
+from structlog_extensions.useragent import UserAgentCache
+from structlog_extensions.utils import convert_combined_log_to_ecs_batch
+from .corpus import access_log_lines
+
+COUNT = 100000
+
+
+def _retained(lines, compact):
+    user_agent_parser = UserAgentCache(4096)
+    # Parse the user agents once up front, so cached strings aren't counted as event memory.
+    convert_combined_log_to_ecs_batch(lines[:1000], 'apache.access', user_agent_parser=user_agent_parser)
+    gc.collect()
+    tracemalloc.start()
+    events = convert_combined_log_to_ecs_batch(lines, 'apache.access', user_agent_parser=user_agent_parser,
+                                               compact=compact)
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return retained, len([event for event in events if event is not None])
+
+
+def main():
+    lines = access_log_lines(COUNT, distinct_agents=200)
+    for name, compact in [('dict', False), ('EcsAccessEvent', True)]:
+        retained, count = _retained(lines, compact)
+        print('{0:<16} {1:>12,} bytes retained {2:>8,.0f} bytes/event'.format(name, retained, retained / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Measures how long importing ``structlog_extensions`` takes in a fresh interpreter, and checks that the heavy
+dependencies (user_agents with ua-parser's regexes, pytz) are only loaded on first use.
+
+Usage:
+    python -m benchmarks.bench_import [--max-ms 250]
+
+Exits with status 1 when a heavy dependency is imported eagerly or the median import time exceeds ``--max-ms``.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+RUNS = 10
+HEAVY_MODULES = ('user_agents', 'ua_parser', 'pytz')
+_CODE = ('import sys, time; started = time.perf_counter(); import {0}; elapsed = time.perf_counter() - started; '
+         'print(elapsed * 1000, ",".join(name for name in {1!r} if name in sys.modules))')
+
+
+def _measure(module, runs=RUNS):
+    timings = []
+    eager = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _CODE.format(module, HEAVY_MODULES)], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+        timings.append(float(output[0]))
+        eager.update(output[1].split(',') if len(output) > 1 else ())
+    return statistics.median(timings), eager
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_import')
+    parser.add_argument('--max-ms', type=float, help='fail when the median import time exceeds this')
+    args = parser.parse_args(argv)
+    status = 0
+    for module in ('structlog', 'structlog_extensions', 'structlog_extensions.utils'):
+        median, eager = _measure(module)
+        print('{0:<32} {1:>8.1f} ms median of {2} runs'.format(module, median, RUNS))
+        if module.startswith('structlog_extensions'):
+            if eager:
+                print('REGRESSION {0} eagerly imports {1}'.format(module, ', '.join(sorted(eager))), file=sys.stderr)
+                status = 1
+            if args.max_ms is not None and median > args.max_ms:
+                print('REGRESSION {0} takes {1:.1f} ms to import, limit {2:.1f} ms'.format(module, median,
+                                                                                            args.max_ms),
+                      file=sys.stderr)
+                status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+"""
+Compares the regular and streaming ``NestedDictJSONRenderer`` on CombinedLogParser style events.
+
+Usage:
+    python -m benchmarks.bench_renderer
+"""
+import logging
+import timeit
+import tracemalloc
+from structlog_extensions.processors import CombinedLogParser, NestedDictJSONRenderer
+
+LINE = ('127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 '
+        '"http://www.example.com/start.html" "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/64.0.3282.186 Safari/537.36"')
+NUMBER = 20000
+
+
+def _event():
+    event_dict = {'event': LINE, 'logger': 'gunicorn.access', 'level': 'info'}
+    event_dict = CombinedLogParser('gunicorn.access')(logging.getLogger('gunicorn.access'), 'info', event_dict)
+    event_dict.pop('event')
+    return event_dict
+
+
+def _peak_memory(renderer, event_dict):
+    renderer(None, 'info', dict(event_dict))
+    tracemalloc.start()
+    for _ in range(100):
+        renderer(None, 'info', dict(event_dict))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    event_dict = _event()
+    for name, renderer in [('NestedDictJSONRenderer', NestedDictJSONRenderer(separator='.')),
+                           ('NestedDictJSONRenderer(streaming=True)',
+                            NestedDictJSONRenderer(separator='.', streaming=True))]:
+        seconds = timeit.timeit(lambda: renderer(None, 'info', dict(event_dict)), number=NUMBER)
+        peak = _peak_memory(renderer, event_dict)
+        print('{0:<42} {1:>10,.0f} ops/sec {2:>8,} bytes peak'.format(name, NUMBER / seconds, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Compares the cached timestamp conversions against the original strptime based implementation.
+
+Usage:
+    python -m benchmarks.bench_timestamps
+"""
+import timeit
+from datetime import datetime, timezone
+import pytz
+from structlog_extensions.timestamps import CoarseClock, parse_combined_timestamp
+from structlog_extensions.utils import combined_log_timestring_to_iso
+
+# One new second every 500 lines, which is what a busy gunicorn worker produces.
+TIMESTAMPS = ['05/Feb/2012:17:{0:02d}:{1:02d} +0000'.format(i // 30000 % 60, i // 500 % 60) for i in range(100000)]
+
+
+def _strptime_to_iso(timestamp):
+    dt = datetime.strptime(timestamp[0:-6], '%d/%b/%Y:%H:%M:%S')
+    dt_tz = int(timestamp[-5:-2]) * 60 + int(timestamp[-2:])
+    return dt.replace(tzinfo=pytz.FixedOffset(dt_tz)).isoformat()
+
+
+def _run(name, function, number=1):
+    seconds = timeit.timeit(function, number=number)
+    print('{0:<40} {1:>12,.0f} ops/sec'.format(name, len(TIMESTAMPS) * number / seconds))
+
+
+def main():
+    _run('strptime + isoformat (original)', lambda: [_strptime_to_iso(t) for t in TIMESTAMPS])
+    _run('parse_combined_timestamp + isoformat', lambda: [parse_combined_timestamp(t).isoformat() for t in TIMESTAMPS])
+    _run('combined_log_timestring_to_iso (cached)', lambda: [combined_log_timestring_to_iso(t) for t in TIMESTAMPS])
+    clock = CoarseClock()
+    _run('datetime.now().isoformat()', lambda: [datetime.now(timezone.utc).isoformat() for _ in TIMESTAMPS])
+    _run('CoarseClock()', lambda: [clock() for _ in TIMESTAMPS])
+
+
+if __name__ == '__main__':
+    main()
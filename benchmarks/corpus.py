@@ -0,0 +1,98 @@
+"""
+Generates reproducible access log corpora for the benchmarks.
+
+The corpora mimic a busy gunicorn worker: a long tail of user agents with a few very common ones, timestamps that
+advance one second every few hundred lines, a mix of routes and status codes and a share of malformed lines.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+_BROWSERS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{major}.0.{build}.{patch} '
+    'Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_{minor}_{patch}) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/{major_safari}.{minor} Safari/605.1.15',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:{major}.0) Gecko/20100101 Firefox/{major}.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS {major_ios}_{minor} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/{major_ios}.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android {major_android}; SM-G{build}) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/{major}.0.{build}.{patch} Mobile Safari/537.36',
+    'curl/7.{minor}.{patch}',
+    'python-requests/2.{minor}.{patch}',
+    'Googlebot/2.1 (+http://www.google.com/bot.html)',
+]
+_ROUTES = ['/', '/healthz', '/static/app.{0}.js', '/static/style.{0}.css', '/api/users/{0}', '/api/orders/{0}/items',
+           '/search?q=term{0}&page=2', '/login']
+_METHODS = ['GET'] * 8 + ['POST', 'PUT', 'DELETE', 'HEAD']
+_STATUSES = [200] * 20 + [204, 301, 302, 304, 304, 400, 401, 404, 404, 500, 503]
+_MALFORMED = [
+    'garbage',
+    '',
+    '127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET / HTTP/1.1" 200',
+    '127.0.0.1 - - [not a timestamp] "GET / HTTP/1.1" 200 12 "-" "curl/7.1"',
+    '\x16\x03\x01\x02\x00\x01\x00\x01\xfc\x03\x03',
+]
+# Malformed lines that make the Combined format regular expression backtrack through many combinations of group
+# ends before failing, repeated to the length of a long log line.
+_PATHOLOGICAL = [
+    '1 - - [' + '] "a" 1 1 "' * 200,
+    '1 - - [x] "' + '" 1 1 "' * 300,
+    '1 - - [' + '] "' * 500 + ' x',
+    '1 - - [x] "GET / HTTP/1.1" 200 1 "' + '" "' * 500,
+]
+
+
+def user_agents(count, seed=0):
+    """Returns ``count`` distinct user agent strings."""
+    rng = random.Random(seed)
+    agents = []
+    seen = set()
+    while len(agents) < count:
+        agent = rng.choice(_BROWSERS).format(major=rng.randrange(50, 120), minor=rng.randrange(16),
+                                             patch=rng.randrange(200), build=rng.randrange(1000, 5000),
+                                             major_safari=rng.randrange(10, 17), major_ios=rng.randrange(10, 17),
+                                             major_android=rng.randrange(6, 14))
+        if agent not in seen:
+            seen.add(agent)
+            agents.append(agent)
+    return agents
+
+
+def access_log_lines(count, seed=0, distinct_agents=500, lines_per_second=300, malformed_ratio=0.01):
+    """
+    Generates Combined log format lines.
+
+    Args:
+        count (int): Number of lines.
+        seed (int, optional): Random seed; the same arguments always produce the same lines. Default 0.
+        distinct_agents (int, optional): Size of the user agent pool. Agents are drawn with a Zipf-like skew.
+        lines_per_second (int, optional): Average number of lines sharing a timestamp. Default 300.
+        malformed_ratio (float, optional): Share of lines that don't match the log format. Default 0.01.
+
+    Returns:
+        list: The log lines.
+    """
+    rng = random.Random(seed)
+    agents = user_agents(distinct_agents, seed)
+    weights = [1.0 / (rank + 1) for rank in range(distinct_agents)]
+    agent_choices = rng.choices(agents, weights, k=count)
+    start = datetime(2020, 3, 1, 12, 0, 0, tzinfo=timezone(timedelta(hours=1)))
+    lines = []
+    for index in range(count):
+        if rng.random() < malformed_ratio:
+            lines.append(rng.choice(_MALFORMED))
+            continue
+        timestamp = (start + timedelta(seconds=index // lines_per_second)).strftime('%d/%b/%Y:%H:%M:%S %z')
+        route = rng.choice(_ROUTES).format(rng.randrange(10000))
+        referrer = '-' if rng.random() < 0.5 else 'https://www.example.com{0}'.format(rng.choice(_ROUTES).format(1))
+        lines.append('10.{0}.{1}.{2} - {3} [{4}] "{5} {6} HTTP/1.1" {7} {8} "{9}" "{10}"'.format(
+            rng.randrange(256), rng.randrange(256), rng.randrange(256), '-' if rng.random() < 0.9 else 'frank',
+            timestamp, rng.choice(_METHODS), route, rng.choice(_STATUSES), rng.randrange(50000), referrer,
+            agent_choices[index]))
+    return lines
+
+
+def pathological_lines(count, seed=0):
+    """Returns ``count`` malformed lines that are slow to reject with a backtracking regular expression."""
+    rng = random.Random(seed)
+    return [rng.choice(_PATHOLOGICAL) for _ in range(count)]
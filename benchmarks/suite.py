@@ -0,0 +1,214 @@
+"""
+Benchmarks of the parse and render hot paths.
+
+Every benchmark runs an operation over the inputs of a generated corpus and reports:
+
+- ``ops_per_sec``: best throughput of a few timed passes over the inputs
+- ``p99_us``: 99th percentile latency of a single operation in microseconds, the best of a few passes
+- ``alloc_bytes``: mean peak memory allocated while running a single operation, measured with ``tracemalloc``
+"""
+import io
+import logging
+import time
+import tracemalloc
+import structlog
+from structlog_extensions import utils
+from structlog_extensions.logformat import CombinedLogScanner
+from structlog_extensions.processors import CombinedLogParser, NestedDictJSONRenderer
+from .corpus import pathological_lines, user_agents
+
+ACCESS_LOGGER = 'gunicorn.access'
+
+
+class Benchmark:
+    """
+    A named operation and the inputs it is run over.
+
+    Attributes:
+        name (str): Benchmark name, used as the key in baselines.
+        setup (callable): Function taking the corpus lines and returning ``(operation, inputs)``.
+    """
+
+    def __init__(self, name, setup):
+        self.name = name
+        self.setup = setup
+
+    def run(self, lines, repeat=3, latency_samples=2000, allocation_samples=200):
+        operation, inputs = self.setup(lines)
+        for item in inputs[:100]:
+            operation(item)
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for item in inputs:
+                operation(item)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        clock = time.perf_counter_ns
+        p99 = None
+        for _ in range(repeat):
+            latencies = []
+            for index in range(latency_samples):
+                item = inputs[index % len(inputs)]
+                started = clock()
+                operation(item)
+                latencies.append(clock() - started)
+            latencies.sort()
+            pass_p99 = latencies[int(len(latencies) * 0.99) - 1]
+            p99 = pass_p99 if p99 is None else min(p99, pass_p99)
+        allocated = 0
+        tracemalloc.start()
+        try:
+            for index in range(allocation_samples):
+                item = inputs[index % len(inputs)]
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                operation(item)
+                allocated += tracemalloc.get_traced_memory()[1] - before
+        finally:
+            tracemalloc.stop()
+        return {'ops_per_sec': len(inputs) / best,
+                'p99_us': p99 / 1000.0,
+                'alloc_bytes': allocated / allocation_samples}
+
+
+def _logger(name=ACCESS_LOGGER):
+    return logging.Logger(name)
+
+
+def _parsed_events(lines):
+    parser = CombinedLogParser(ACCESS_LOGGER)
+    logger = _logger()
+    events = [parser(logger, 'info', {'event': line, 'level': 'info', 'logger': ACCESS_LOGGER}) for line in lines]
+    for event_dict in events:
+        event_dict.pop('event', None)
+    return events
+
+
+def _setup_parse_log_into_fields(lines):
+    return utils._parse_log_into_fields, lines
+
+
+def _setup_parse_user_agent_section(lines):
+    # Uncached parsing is slow, so a few hundred distinct agents are enough for stable numbers.
+    return utils._parse_user_agent_section, user_agents(300, seed=1)
+
+
+def _setup_parse_datetime(lines):
+    timestamps = []
+    for fields in map(utils._parse_log_into_fields, lines):
+        try:
+            utils._parse_datetime(fields['time'])
+        except (KeyError, ValueError):
+            continue
+        timestamps.append(fields['time'])
+    return utils._parse_datetime, timestamps
+
+
+def _setup_combined_log_scanner(lines):
+    return CombinedLogScanner().parse, lines
+
+
+def _setup_combined_log_scanner_pathological(lines):
+    # The regular expression needs up to hundreds of milliseconds per line here, too slow to benchmark alongside.
+    return CombinedLogScanner().parse, pathological_lines(1000, seed=1)
+
+
+def _setup_unflatten_dict(lines):
+    return utils.unflatten_dict, _parsed_events(lines)
+
+
+def _setup_combined_log_parser(lines):
+    parser = CombinedLogParser(ACCESS_LOGGER)
+    logger = _logger()
+
+    def operation(line):
+        return parser(logger, 'info', {'event': line, 'level': 'info', 'logger': ACCESS_LOGGER})
+    return operation, lines
+
+
+def _setup_nested_dict_json_renderer(lines):
+    renderer = NestedDictJSONRenderer(separator='.')
+    return (lambda event_dict: renderer(None, 'info', dict(event_dict))), _parsed_events(lines)
+
+
+def _setup_nested_dict_json_renderer_static_fields(lines):
+    static_fields = {'service.name': 'shop', 'service.version': '1.2.0', 'service.environment': 'production',
+                     'host.hostname': 'web-1', 'host.ip': '10.0.0.5', 'host.os.name': 'linux'}
+    renderer = NestedDictJSONRenderer(separator='.', static_fields=static_fields)
+    return (lambda event_dict: renderer(None, 'info', dict(event_dict))), _parsed_events(lines)
+
+
+def _setup_processor_formatter_pipeline(lines):
+    """The gunicorn configuration from the README: a foreign pre chain parsing the line, then rendering it."""
+    handler = logging.StreamHandler(io.StringIO())
+    handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+        processor=NestedDictJSONRenderer(separator='.'),
+        foreign_pre_chain=[structlog.stdlib.add_log_level,
+                           structlog.stdlib.add_logger_name,
+                           CombinedLogParser(ACCESS_LOGGER)]))
+    logger = _logger()
+    logger.propagate = False
+    logger.addHandler(handler)
+    stream = handler.stream
+
+    def operation(line):
+        logger.info(line)
+        stream.seek(0)
+        stream.truncate()
+    return operation, lines
+
+
+BENCHMARKS = [
+    Benchmark('parse_log_into_fields', _setup_parse_log_into_fields),
+    Benchmark('CombinedLogScanner', _setup_combined_log_scanner),
+    Benchmark('CombinedLogScanner_pathological', _setup_combined_log_scanner_pathological),
+    Benchmark('parse_user_agent_section', _setup_parse_user_agent_section),
+    Benchmark('parse_datetime', _setup_parse_datetime),
+    Benchmark('unflatten_dict', _setup_unflatten_dict),
+    Benchmark('CombinedLogParser', _setup_combined_log_parser),
+    Benchmark('NestedDictJSONRenderer', _setup_nested_dict_json_renderer),
+    Benchmark('NestedDictJSONRenderer_static', _setup_nested_dict_json_renderer_static_fields),
+    Benchmark('ProcessorFormatter_pipeline', _setup_processor_formatter_pipeline),
+]
+
+
+def run_benchmarks(lines, names=None, **kwargs):
+    """
+    Runs the benchmarks.
+
+    Args:
+        lines (list): Corpus of access log lines.
+        names (list, optional): Names of the benchmarks to run. Default None (all).
+
+    Returns:
+        dict: Benchmark name to result.
+    """
+    return {benchmark.name: benchmark.run(lines, **kwargs) for benchmark in BENCHMARKS
+            if names is None or benchmark.name in names}
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares results against a baseline.
+
+    A result regresses when its throughput is more than ``tolerance`` below the baseline, or its p99 latency or
+    allocations are more than ``tolerance`` (plus a small absolute slack, so that tiny values don't flap) above it.
+    Benchmarks missing from either side are ignored.
+
+    Returns:
+        list: Descriptions of the regressions.
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result['ops_per_sec'] < reference['ops_per_sec'] * (1 - tolerance):
+            regressions.append('{0}: {1:,.0f} ops/sec, baseline {2:,.0f}'.format(
+                name, result['ops_per_sec'], reference['ops_per_sec']))
+        for metric, slack in (('p99_us', 1.0), ('alloc_bytes', 64.0)):
+            if result[metric] > reference[metric] * (1 + tolerance) + slack:
+                regressions.append('{0}: {1} {2:,.1f}, baseline {3:,.1f}'.format(
+                    name, metric, result[metric], reference[metric]))
+    return regressions
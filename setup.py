@@ -19,17 +19,22 @@ setup(
     author='Niels Albers',
     author_email='nralbers@gmail.com',
     description='Processors for Structlog library',
-    install_requires=['structlog>=19.2','user-agents','deepmerge', 'pytz'],
+    # IndexedUserAgentParser builds on ua-parser's regex tables and user-agents' parser internals; the ranges are the
+    # releases its differential test against ua-parser has been run with.
+    install_requires=['structlog>=19.2', 'user-agents>=2.0,<2.3', 'ua-parser>=0.8,<1.1', 'pytz'],
+    extras_require={'orjson': ['orjson'], 'gunicorn': ['gunicorn']},
     keywords=KEYWORDS,
     long_description=long_description,
     long_description_content_type="text/x-rst",
-    python_requires='~=3.5',
+    python_requires='>=3.8',
     classifiers=[
         "Natural Language :: English",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3 :: Only",
         "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Programming Language :: Python :: Implementation :: CPython",
         "Programming Language :: Python :: Implementation :: PyPy",
         "License :: OSI Approved :: MIT License",
@@ -1 +1,2 @@
-from structlog_extensions import processors, utils
+from structlog_extensions import events, fields, handlers, instrumentation, jsonstream, logformat, metrics, processors, timestamps, useragent, utils
+from structlog_extensions.utils import warmup
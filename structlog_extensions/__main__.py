@@ -0,0 +1,104 @@
+"""
+Command line tools for structlog_extensions.
+
+Usage:
+    python -m structlog_extensions build-ua-table OUTPUT LOGFILE [LOGFILE ...]
+    python -m structlog_extensions convert [-o OUTPUT] [--flat] LOGFILE [LOGFILE ...]
+    python -m structlog_extensions follow [-o OUTPUT] [--checkpoint FILE] [--flat] LOGFILE [LOGFILE ...]
+"""
+import argparse
+import signal
+import sys
+import threading
+from contextlib import nullcontext
+from .convert import DEFAULT_CHUNK_SIZE, convert_log_files
+from .follow import LogFollower
+from .logformat import COMBINED_LOG_FORMAT
+from .useragent import build_user_agent_table
+
+
+def _build_ua_table(args):
+    count = build_user_agent_table(args.log_files, args.output, log_format=args.log_format,
+                                   min_count=args.min_count)
+    print('Wrote {0} user agents to {1}'.format(count, args.output), file=sys.stderr)
+    return 0
+
+
+def _convert(args):
+    if args.output == '-':
+        stats = convert_log_files(args.log_files, sys.stdout.buffer, nested=not args.flat, log_format=args.log_format,
+                                  dataset=args.dataset, processes=args.processes, chunk_size=args.chunk_size)
+    else:
+        with open(args.output, 'wb') as output:
+            stats = convert_log_files(args.log_files, output, nested=not args.flat, log_format=args.log_format,
+                                      dataset=args.dataset, processes=args.processes, chunk_size=args.chunk_size)
+    print('Converted {lines} lines in {seconds:.2f}s ({lines_per_second:,.0f} lines/sec), '
+          '{unparseable} unparseable'.format(**stats), file=sys.stderr)
+    return 0
+
+
+def _follow(args):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    with (nullcontext(sys.stdout.buffer) if args.output == '-' else open(args.output, 'ab')) as output:
+        follower = LogFollower(args.log_files, output, checkpoint=args.checkpoint, nested=not args.flat,
+                               log_format=args.log_format, dataset=args.dataset,
+                               from_beginning=args.from_beginning)
+        try:
+            follower.run(poll_interval=args.interval, stop=stop)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            follower.close()
+    print('Followed {lines} lines, {unparseable} unparseable, {rotations} rotations, '
+          '{truncations} truncations'.format(**follower.stats()), file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m structlog_extensions')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    build_table = commands.add_parser('build-ua-table',
+                                      help='Build a precomputed user agent lookup table from access logs')
+    build_table.add_argument('output', help='Path of the table file to write')
+    build_table.add_argument('log_files', nargs='+', help='Access log files (.gz files are decompressed)')
+    build_table.add_argument('--log-format', default=COMBINED_LOG_FORMAT,
+                             help='Apache LogFormat or gunicorn access_log_format of the log lines')
+    build_table.add_argument('--min-count', type=int, default=1,
+                             help='Only include user agents seen at least this many times')
+    build_table.set_defaults(handler=_build_ua_table)
+
+    convert = commands.add_parser('convert', help='Convert access log files to ECS NDJSON')
+    convert.add_argument('log_files', nargs='+', help='Access log files (.gz files are decompressed, - reads stdin)')
+    convert.add_argument('-o', '--output', default='-', help='NDJSON output file (default stdout)')
+    convert.add_argument('--flat', action='store_true', help='Write flat dotted keys instead of nested objects')
+    convert.add_argument('--log-format', default=COMBINED_LOG_FORMAT,
+                         help='Apache LogFormat or gunicorn access_log_format of the log lines')
+    convert.add_argument('--dataset', default='apache.access', help='Value for event.dataset')
+    convert.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: CPUs)')
+    convert.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                         help='Approximate number of bytes per chunk of work')
+    convert.set_defaults(handler=_convert)
+
+    follow = commands.add_parser('follow', help='Follow growing access log files and write new lines as ECS NDJSON')
+    follow.add_argument('log_files', nargs='+', help='Access log files to follow')
+    follow.add_argument('-o', '--output', default='-', help='NDJSON output file, appended to (default stdout)')
+    follow.add_argument('--checkpoint', default=None,
+                        help='File to save read positions in, to continue from them after a restart')
+    follow.add_argument('--from-beginning', action='store_true',
+                        help='Read files without a checkpoint from the start instead of only new lines')
+    follow.add_argument('--interval', type=float, default=1.0, help='Seconds between polls for new lines')
+    follow.add_argument('--flat', action='store_true', help='Write flat dotted keys instead of nested objects')
+    follow.add_argument('--log-format', default=COMBINED_LOG_FORMAT,
+                        help='Apache LogFormat or gunicorn access_log_format of the log lines')
+    follow.add_argument('--dataset', default='apache.access', help='Value for event.dataset')
+    follow.set_defaults(handler=_follow)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+structlog_extensions.convert
+
+This module converts access log files into ECS NDJSON in bulk, spreading the work over multiple processes.
+"""
+import gzip
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from .jsonstream import FlatJSONSerializer
+from .logformat import COMBINED_LOG_FORMAT, compile_log_format
+from .useragent import IndexedUserAgentParser, UserAgentCache
+from .utils import convert_combined_log_to_ecs_batch, unflatten_dict
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+_worker_state = dict()
+# The index is built on first use and only read afterwards, so one parser serves every converter in a process.
+_indexed_user_agent_parser = IndexedUserAgentParser()
+
+
+def _converter_state(log_format, dataset, nested):
+    return {'parser': compile_log_format(log_format),
+            'user_agent_parser': UserAgentCache(4096, parser=_indexed_user_agent_parser),
+            'dataset': dataset,
+            'dumps': _nested_dumps(FlatJSONSerializer('.')) if nested else json.dumps}
+
+
+def _init_worker(log_format, dataset, nested):
+    _worker_state.update(_converter_state(log_format, dataset, nested))
+
+
+def _nested_dumps(serializer):
+    def dumps(ecs_fields):
+        rendered = serializer(ecs_fields)
+        return json.dumps(unflatten_dict(ecs_fields)) if rendered is None else rendered
+    return dumps
+
+
+def _convert_chunk(chunk):
+    """
+    Converts a chunk of log lines into NDJSON.
+
+    Args:
+        chunk: Either the raw bytes of the chunk, or a ``(path, start, end)`` tuple to read it from a file.
+
+    Returns:
+        tuple: The NDJSON output as bytes, the number of lines and the number of unparseable lines.
+    """
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        with open(path, 'rb') as log_file:
+            log_file.seek(start)
+            chunk = log_file.read(end - start)
+    return _convert_data(chunk, _worker_state)
+
+
+def _convert_data(chunk, state):
+    """Converts the raw bytes of complete log lines with the parser state of ``_converter_state``."""
+    parser = state['parser']
+    user_agent_parser = state['user_agent_parser']
+    dataset = state['dataset']
+    dumps = state['dumps']
+    lines = [line.rstrip('\r') for line in chunk.decode('utf-8', 'replace').split('\n')]
+    lines = [line for line in lines if line]
+    converted = convert_combined_log_to_ecs_batch(lines, dataset, parser=parser, user_agent_parser=user_agent_parser)
+    output = [dumps(ecs_fields) for ecs_fields in converted if ecs_fields is not None]
+    unparseable = len(lines) - len(output)
+    if output:
+        output.append('')
+    return '\n'.join(output).encode('utf-8'), len(lines), unparseable
+
+
+def _mapped_chunks(path, chunk_size):
+    """Yields ``(path, start, end)`` ranges of roughly ``chunk_size`` bytes that end on a line boundary."""
+    with open(path, 'rb') as log_file:
+        if os.fstat(log_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = 0
+            size = len(mapped)
+            while start < size:
+                end = mapped.find(b'\n', min(start + chunk_size, size - 1))
+                end = size if end == -1 else end + 1
+                yield path, start, end
+                start = end
+
+
+def _buffered_chunks(stream, chunk_size):
+    """Yields blocks of roughly ``chunk_size`` bytes that end on a line boundary from a stream."""
+    remainder = b''
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            break
+        block = remainder + block
+        split = block.rfind(b'\n') + 1
+        if split == 0:
+            remainder = block
+            continue
+        remainder = block[split:]
+        yield block[:split]
+    if remainder:
+        yield remainder
+
+
+def _chunks(paths, chunk_size):
+    for path in paths:
+        if path == '-':
+            yield from _buffered_chunks(sys.stdin.buffer, chunk_size)
+        elif path.endswith('.gz'):
+            with gzip.open(path, 'rb') as log_file:
+                yield from _buffered_chunks(log_file, chunk_size)
+        else:
+            yield from _mapped_chunks(path, chunk_size)
+
+
+def convert_log_files(paths, output, nested=True, log_format=COMBINED_LOG_FORMAT, dataset='apache.access',
+                      processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Converts access log files into ECS NDJSON, one document per line, in input order.
+
+    Plain files are memory mapped and split into chunks at line boundaries, which worker processes read
+    themselves; gzip files and stdin are read in large blocks. Lines that can't be parsed are counted and skipped.
+
+    Args:
+        paths (list): Access log files to convert. ``.gz`` files are decompressed and ``-`` reads stdin.
+        output (file): Binary file object the NDJSON is written to.
+        nested (bool, optional): Write nested ECS objects (as ``NestedDictJSONRenderer`` does) instead of flat,
+                                 dotted keys. Default True.
+        log_format (str, optional): Apache ``LogFormat`` or gunicorn ``access_log_format`` of the log lines.
+                                    Default is the Apache Combined log format.
+        dataset (str, optional): Value for ``event.dataset``. Default 'apache.access'.
+        processes (int, optional): Number of worker processes. Default is the number of CPUs; 1 converts in the
+                                   calling process.
+        chunk_size (int, optional): Approximate number of bytes per chunk of work. Default 4 MiB.
+
+    Returns:
+        dict: ``lines``, ``unparseable``, ``seconds`` and ``lines_per_second``.
+    """
+    compile_log_format(log_format)
+    processes = processes or os.cpu_count() or 1
+    started = time.monotonic()
+    lines = unparseable = 0
+    chunks = _chunks(paths, chunk_size)
+
+    def write(result):
+        nonlocal lines, unparseable
+        data, chunk_lines, chunk_unparseable = result
+        output.write(data)
+        lines += chunk_lines
+        unparseable += chunk_unparseable
+
+    if processes == 1:
+        _init_worker(log_format, dataset, nested)
+        for chunk in chunks:
+            write(_convert_chunk(chunk))
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker,
+                                  initargs=(log_format, dataset, nested)) as pool:
+            # Keep a bounded number of chunks in flight so memory use doesn't grow with the input size.
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_convert_chunk, (chunk,)))
+                if len(pending) >= processes * 2:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+    output.flush()
+    seconds = time.monotonic() - started
+    return {'lines': lines,
+            'unparseable': unparseable,
+            'seconds': seconds,
+            'lines_per_second': lines / seconds if seconds else 0.0}
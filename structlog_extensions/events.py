@@ -0,0 +1,143 @@
+"""
+structlog_extensions.events
+
+This module contains a compact, read-only representation of converted access log events.
+"""
+import sys
+from collections.abc import ItemsView, KeysView, Mapping, ValuesView
+
+_schemas = dict()
+_SCHEMA_CACHE_SIZE = 256
+
+
+class _EventSchema:
+    """Interned field names of a key set and the position of each name in the values tuple."""
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = tuple(sys.intern(key) for key in keys)
+        self.index = {key: position for position, key in enumerate(self.keys)}
+
+
+def _schema(keys):
+    schema = _schemas.get(keys)
+    if schema is None:
+        schema = _EventSchema(keys)
+        if len(_schemas) >= _SCHEMA_CACHE_SIZE:
+            _schemas.pop(next(iter(_schemas)), None)
+        _schemas[keys] = schema
+    return schema
+
+
+class _EventValuesView(ValuesView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(self._mapping._values)
+
+
+class _EventItemsView(ItemsView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return zip(self._mapping._schema.keys, self._mapping._values)
+
+
+class EcsAccessEvent(Mapping):
+    """
+    Read-only mapping of ECS field names to values, stored as a tuple of values and a schema shared by every event
+    with the same fields.
+
+    Converted access log lines have the same 25 or so fields every time, so holding many of them (for example the
+    results of ``utils.convert_combined_log_to_ecs_batch`` waiting to be written) as dicts repeats the same hash
+    table layout per event. An ``EcsAccessEvent`` only stores its values; the interned field names and the name to
+    position index are stored once per key set. Read-only consumers such as ``utils.unflatten_dict``,
+    ``jsonstream.FlatJSONSerializer`` and ``dict.update`` accept it as is; use ``to_dict()`` where a mutable dict
+    is needed. ``keys()``, ``values()`` and ``items()`` return the usual views.
+
+    Example:
+        .. code-block:: python
+
+            event = EcsAccessEvent.from_dict({'http.response.status_code': 200, 'url.original': '/'})
+            event['http.response.status_code']  # 200
+            event_dict.update(event)
+    """
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, keys, values):
+        """
+        Args:
+            keys (tuple): Field names
+            values (tuple): Field values, in the same order as ``keys``
+        """
+        if len(keys) != len(values):
+            raise ValueError('Expected {0} values, got {1}'.format(len(keys), len(values)))
+        self._schema = _schema(tuple(keys))
+        self._values = tuple(values)
+
+    @classmethod
+    def from_dict(cls, fields):
+        """
+        Creates an event from a dict of fields, keeping their order.
+
+        Args:
+            fields (dict): ECS field name to value
+
+        Returns:
+            EcsAccessEvent: The event.
+        """
+        event = cls.__new__(cls)
+        event._schema = _schema(tuple(fields))
+        event._values = tuple(fields.values())
+        return event
+
+    @classmethod
+    def _from_schema(cls, schema, values):
+        event = cls.__new__(cls)
+        event._schema = schema
+        event._values = values
+        return event
+
+    def __getitem__(self, key):
+        return self._values[self._schema.index[key]]
+
+    def get(self, key, default=None):
+        position = self._schema.index.get(key)
+        return default if position is None else self._values[position]
+
+    def __contains__(self, key):
+        return key in self._schema.index
+
+    def __iter__(self):
+        return iter(self._schema.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return KeysView(self)
+
+    def values(self):
+        return _EventValuesView(self)
+
+    def items(self):
+        return _EventItemsView(self)
+
+    def to_dict(self):
+        """Returns the fields as a new dict."""
+        return dict(zip(self._schema.keys, self._values))
+
+    def __eq__(self, other):
+        if isinstance(other, EcsAccessEvent):
+            return self._schema.keys == other._schema.keys and self._values == other._values
+        if isinstance(other, Mapping):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return type(self), (self._schema.keys, self._values)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.to_dict())
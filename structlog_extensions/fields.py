@@ -0,0 +1,149 @@
+"""
+structlog_extensions.fields
+
+This module contains helpers for selecting ECS fields and for deferring the computation of expensive ones.
+"""
+
+_missing = object()
+
+
+class FieldProjection:
+    """
+    Selection of ECS fields by name or namespace.
+
+    A selector matches the field with that exact name and every field nested below it, so ``'user_agent'``
+    selects ``user_agent.name``, ``user_agent.os.full`` and so on. A field is selected when it matches one of the
+    ``include`` selectors (or ``include`` is None) and none of the ``exclude`` selectors.
+
+    Attributes:
+        include (list, optional): Selectors of the fields to keep. Default None (all fields).
+        exclude (list, optional): Selectors of the fields to drop. Default None.
+
+    Example:
+        .. code-block:: python
+
+            projection = FieldProjection(include=['@timestamp', 'http', 'url'], exclude=['http.request.referrer'])
+            projection.selects('http.response.status_code')  # True
+            projection.selects('user_agent.name')  # False
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = None if include is None else tuple(include)
+        self.exclude = tuple(exclude or ())
+        self._selected = dict()
+
+    @staticmethod
+    def _matches(name, selectors):
+        return any(name == selector or name.startswith(selector + '.') for selector in selectors)
+
+    def selects(self, name):
+        """
+        Returns whether a field is selected.
+
+        Args:
+            name (str): ECS field name
+
+        Returns:
+            bool: True if the field is part of the projection.
+        """
+        selected = self._selected.get(name)
+        if selected is None:
+            selected = ((self.include is None or self._matches(name, self.include))
+                        and not self._matches(name, self.exclude))
+            self._selected[name] = selected
+        return selected
+
+    def selects_any(self, names):
+        """
+        Returns whether any of the fields is selected.
+
+        Args:
+            names (iterable): ECS field names
+
+        Returns:
+            bool: True if at least one of the fields is part of the projection.
+        """
+        return any(self.selects(name) for name in names)
+
+    def project(self, fields):
+        """
+        Returns the selected items of a dict of ECS fields.
+
+        Args:
+            fields (dict): ECS field name to value
+
+        Returns:
+            dict: The selected fields, in their original order.
+        """
+        selects = self.selects
+        return {name: value for name, value in fields.items() if selects(name)}
+
+
+class LazyField:
+    """
+    Placeholder for a field value that is only computed when it is first read.
+
+    Renderers that use structlog's JSON fallback handler (``structlog.processors.JSONRenderer`` and
+    ``NestedDictJSONRenderer``) resolve it through ``__structlog__``; ``str()`` and ``repr()`` resolve it as well.
+    Processors that need the plain value can read ``value``, or run ``resolve_lazy_fields`` first.
+
+    Attributes:
+        compute (callable): Function without arguments returning the value.
+    """
+    __slots__ = ('_compute', '_value')
+
+    def __init__(self, compute):
+        self._compute = compute
+        self._value = _missing
+
+    @property
+    def value(self):
+        """The computed value."""
+        if self._value is _missing:
+            self._value = self._compute()
+            self._compute = None
+        return self._value
+
+    def __structlog__(self):
+        return self.value
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyField):
+            other = other.value
+        return self.value == other
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+def lazy_fields(compute, names):
+    """
+    Returns ``LazyField`` placeholders for several fields computed together.
+
+    Args:
+        compute (callable): Function without arguments returning a dict that holds all the ``names``.
+        names (iterable): Field names to create placeholders for.
+
+    Returns:
+        dict: Field name to ``LazyField``. ``compute`` is called at most once, when the first of them is read.
+    """
+    group = LazyField(compute)
+    return {name: LazyField(lambda name=name: group.value[name]) for name in names}
+
+
+def resolve_lazy_fields(logger, method_name, event_dict):
+    """
+    Structlog processor that replaces every ``LazyField`` in the event dict with its value.
+
+    Add it before processors that need to read or compare lazily computed fields.
+    """
+    for name, value in event_dict.items():
+        if isinstance(value, LazyField):
+            event_dict[name] = value.value
+    return event_dict
@@ -0,0 +1,280 @@
+"""
+structlog_extensions.follow
+
+This module follows growing access log files and converts new lines into ECS NDJSON as they are written, keeping
+track of how far every file has been read in a checkpoint file.
+"""
+import json
+import os
+import threading
+from .convert import _convert_data, _converter_state
+from .logformat import COMBINED_LOG_FORMAT
+
+DEFAULT_READ_SIZE = 1024 * 1024
+
+
+def _identity(stat):
+    return stat.st_dev, stat.st_ino
+
+
+def _find_rotated(path, identity):
+    """Returns the path of the file next to ``path`` (such as ``access.log.1``) with the given identity, or None."""
+    directory, name = os.path.split(os.path.abspath(path))
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return None
+    for entry in entries:
+        if entry.name != name and entry.name.startswith(name):
+            try:
+                if _identity(entry.stat(follow_symlinks=False)) == identity:
+                    return entry.path
+            except OSError:
+                continue
+    return None
+
+
+class _FollowedFile:
+    """
+    Read position in one followed log file.
+
+    ``offset`` is always just after the last complete line that was read, so an unterminated last line is read
+    again, in full, once the writer finishes it.
+    """
+
+    def __init__(self, path, read_size, start_at_end, checkpoint=None):
+        self.path = path
+        self.read_size = read_size
+        self.handle = None
+        self.identity = None
+        self.offset = 0
+        self.rotations = 0
+        self.truncations = 0
+        self._open_initial(start_at_end, checkpoint)
+
+    def _open(self, path, offset):
+        handle = open(path, 'rb')
+        stat = os.fstat(handle.fileno())
+        if stat.st_size < offset:
+            offset = 0
+            self.truncations += 1
+        self.handle = handle
+        self.identity = _identity(stat)
+        self.offset = offset
+
+    def _open_initial(self, start_at_end, checkpoint):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if checkpoint is not None:
+            identity = (checkpoint['device'], checkpoint['inode'])
+            if identity == _identity(stat):
+                self._open(self.path, checkpoint['offset'])
+                return
+            # Rotated while nobody was following it: finish the old file first, if it's still there.
+            rotated = _find_rotated(self.path, identity)
+            if rotated is not None:
+                self._open(rotated, checkpoint['offset'])
+                return
+            self._open(self.path, 0)
+            return
+        self._open(self.path, stat.st_size if start_at_end else 0)
+
+    def _read_lines(self):
+        handle = self.handle
+        handle.seek(self.offset)
+        data = handle.read(self.read_size)
+        end = data.rfind(b'\n') + 1
+        while not end and len(data) >= self.read_size:
+            # A line longer than read_size: keep reading until it ends.
+            more = handle.read(self.read_size)
+            if not more:
+                break
+            start = len(data)
+            data += more
+            end = data.find(b'\n', start) + 1
+        self.offset += end
+        return data[:end]
+
+    def read(self):
+        """
+        Reads new complete lines.
+
+        Returns:
+            bytes: The lines, or an empty string when there is nothing new.
+        """
+        if self.handle is None:
+            try:
+                self._open(self.path, 0)
+            except FileNotFoundError:
+                return b''
+        if os.fstat(self.handle.fileno()).st_size < self.offset:
+            # Truncated in place (copytruncate).
+            self.offset = 0
+            self.truncations += 1
+        data = self._read_lines()
+        if data:
+            return data
+        try:
+            current = _identity(os.stat(self.path))
+        except FileNotFoundError:
+            return b''
+        if current == self.identity:
+            return b''
+        # Rotated: the open file is complete, including an unterminated last line.
+        self.handle.seek(self.offset)
+        rest = self.handle.read()
+        self.handle.close()
+        self.handle = None
+        self.rotations += 1
+        try:
+            self._open(self.path, 0)
+        except FileNotFoundError:
+            return rest + b'\n' if rest else b''
+        return rest + b'\n' if rest else self._read_lines()
+
+    def checkpoint(self):
+        if self.identity is None:
+            return None
+        return {'device': self.identity[0], 'inode': self.identity[1], 'offset': self.offset}
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+class LogFollower:
+    """
+    Follows growing access log files and writes their new lines as ECS NDJSON.
+
+    Every ``poll()`` reads what was appended to each file since the last one, converts it in batches of up to
+    ``read_size`` bytes (with the same parsing as ``convert.convert_log_files``) and writes the documents to
+    ``output``. Files are read from their last complete line onwards, so the work done is proportional to the new
+    data; a poll without new data only costs a ``stat`` per file.
+
+    Rotation is detected by the path pointing to a different file: the old file is read to its end before the new
+    one is read from the start. A file that shrinks (truncated in place, as with logrotate's ``copytruncate``) is
+    read again from the start.
+
+    With a ``checkpoint`` path the device, inode and offset of every file are saved after every batch that was
+    written, and a restarted follower continues where the previous one stopped. That includes a file that was
+    rotated in the meantime, as long as the rotated file is in the same directory with a name starting with the
+    original name (``access.log.1``) and isn't compressed yet.
+
+    Attributes:
+        paths (list): Access log files to follow. Files that don't exist yet are picked up when they appear.
+        output (file): Binary file object the NDJSON is written to.
+        checkpoint (str, optional): Path of the checkpoint file. Default None (no checkpoints).
+        nested (bool, optional): Write nested ECS objects instead of flat, dotted keys. Default True.
+        log_format (str, optional): Apache ``LogFormat`` or gunicorn ``access_log_format`` of the log lines.
+                                    Default is the Apache Combined log format.
+        dataset (str, optional): Value for ``event.dataset``. Default 'apache.access'.
+        from_beginning (bool, optional): Read files without a checkpoint from the start instead of only following
+                                         new lines. Default False.
+        read_size (int, optional): Maximum number of bytes converted per batch. Default 1 MiB.
+
+    Example:
+        .. code-block:: python
+
+            with open('/var/log/ecs/access.ndjson', 'ab') as output:
+                follower = LogFollower(['/var/log/apache2/access.log'], output,
+                                       checkpoint='/var/lib/myapp/follow.checkpoint')
+                follower.run(poll_interval=1.0)
+    """
+
+    def __init__(self, paths, output, checkpoint=None, nested=True, log_format=COMBINED_LOG_FORMAT,
+                 dataset='apache.access', from_beginning=False, read_size=DEFAULT_READ_SIZE):
+        if read_size < 1:
+            raise ValueError('read_size must be at least 1')
+        self.paths = list(paths)
+        self.output = output
+        self.checkpoint = checkpoint
+        self._state = _converter_state(log_format, dataset, nested)
+        saved = self._load_checkpoint()
+        self._files = [_FollowedFile(path, read_size, not from_beginning, saved.get(os.path.abspath(path)))
+                       for path in self.paths]
+        self.lines = 0
+        self.unparseable = 0
+        self.bytes = 0
+
+    def _load_checkpoint(self):
+        if not self.checkpoint:
+            return dict()
+        try:
+            with open(self.checkpoint, 'r') as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return dict()
+
+    def save_checkpoint(self):
+        """Writes the current positions to the checkpoint file, replacing it atomically."""
+        if not self.checkpoint:
+            return
+        positions = dict()
+        for followed in self._files:
+            position = followed.checkpoint()
+            if position is not None:
+                positions[os.path.abspath(followed.path)] = position
+        temp_path = '{0}.tmp{1}'.format(self.checkpoint, os.getpid())
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(positions, checkpoint_file)
+        os.replace(temp_path, self.checkpoint)
+
+    def poll(self):
+        """
+        Converts everything that was appended to the files since the last poll.
+
+        Returns:
+            int: Number of lines read.
+        """
+        lines = 0
+        for followed in self._files:
+            while True:
+                data = followed.read()
+                if not data:
+                    break
+                ndjson, batch_lines, unparseable = _convert_data(data, self._state)
+                self.output.write(ndjson)
+                self.output.flush()
+                # Only record the new position once the documents are written.
+                self.save_checkpoint()
+                lines += batch_lines
+                self.unparseable += unparseable
+                self.bytes += len(data)
+        self.lines += lines
+        return lines
+
+    def run(self, poll_interval=1.0, stop=None):
+        """
+        Polls every ``poll_interval`` seconds until ``stop`` is set.
+
+        Args:
+            poll_interval (float, optional): Seconds to wait after a poll that found no new lines. Default 1.0.
+            stop (threading.Event, optional): Event that ends the loop. Default None (run until interrupted).
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if not self.poll():
+                stop.wait(poll_interval)
+        self.save_checkpoint()
+
+    def stats(self):
+        """
+        Returns the follower counters.
+
+        Returns:
+            dict: ``lines`` read, ``unparseable`` lines, ``bytes`` read, file ``rotations`` and ``truncations``.
+        """
+        return {'lines': self.lines,
+                'unparseable': self.unparseable,
+                'bytes': self.bytes,
+                'rotations': sum(followed.rotations for followed in self._files),
+                'truncations': sum(followed.truncations for followed in self._files)}
+
+    def close(self):
+        """Saves the checkpoint and closes the files."""
+        self.save_checkpoint()
+        for followed in self._files:
+            followed.close()
@@ -0,0 +1,129 @@
+"""
+structlog_extensions.glogging
+
+This module contains a gunicorn logger class that logs access events as ECS fields, without formatting and re-parsing
+an access log line.
+
+It requires gunicorn and isn't imported by ``structlog_extensions`` itself.
+"""
+import logging
+import os
+import traceback
+from datetime import datetime, timezone
+from gunicorn.glogging import Logger
+from .useragent import UserAgentCache
+
+
+class EcsLogger(Logger):
+    """
+    gunicorn logger class that builds the ECS fields of an access event straight from the request, response and WSGI
+    environ.
+
+    The stock logger formats every request into an access log line, which ``processors.CombinedLogParser`` then
+    parses again with regular expressions. ``EcsLogger.access`` produces the same ECS fields (see
+    ``utils.convert_combined_log_to_ecs``) directly, plus ``url.path``, ``url.query``, ``event.duration`` (in
+    nanoseconds), ``process.pid`` and ``http.request.id`` (from an ``X-Request-Id`` header). Values are not lost to
+    the text format: the response size of an empty body is 0 rather than '-' and timestamps have microsecond
+    resolution. There is no ``event.original``, as there is no log line.
+
+    The event dict is logged on the 'gunicorn.access' logger the way ``ProcessorFormatter.wrap_for_formatter`` does,
+    so a ``structlog.stdlib.ProcessorFormatter`` hands it straight to its ``processors`` (for example a
+    ``NestedDictJSONRenderer``) and skips the ``foreign_pre_chain``. ``access_log_format`` is not used.
+
+    Attributes:
+        ua_cache_size (int): Size of the per-process user agent cache. Default 1024.
+
+    Example:
+        ``gunicorn.conf.py``
+
+        .. code-block:: python
+
+            logger_class = "structlog_extensions.glogging.EcsLogger"
+            logconfig_dict = {
+                "version": 1,
+                "disable_existing_loggers": False,
+                "formatters": {
+                    "json_formatter": {
+                        "()": structlog.stdlib.ProcessorFormatter,
+                        "processor": structlog_extensions.processors.NestedDictJSONRenderer(separator='.'),
+                        "foreign_pre_chain": pre_chain,
+                    }
+                },
+                ...
+            }
+    """
+    ua_cache_size = 1024
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.user_agent_parser = UserAgentCache(self.ua_cache_size)
+
+    def _access_log_enabled(self):
+        cfg = self.cfg
+        return bool(cfg.accesslog or cfg.logconfig or getattr(cfg, 'logconfig_dict', None)
+                    or getattr(cfg, 'logconfig_json', None)
+                    or (cfg.syslog and not cfg.disable_redirect_access_to_syslog))
+
+    def ecs_fields(self, resp, req, environ, request_time):
+        """
+        Builds the ECS fields of an access event.
+
+        Args:
+            resp: gunicorn response
+            req: gunicorn request
+            environ (dict): WSGI environ
+            request_time (datetime.timedelta): Time it took to handle the request
+
+        Returns:
+            dict: Flat ECS fields.
+        """
+        status = resp.status
+        if isinstance(status, str):
+            status = status.split(None, 1)[0]
+        status = int(status)
+        method = environ['REQUEST_METHOD']
+        url = environ['RAW_URI']
+        protocol = environ['SERVER_PROTOCOL']
+        size = getattr(resp, 'sent', None)
+        created = datetime.now(timezone.utc).isoformat()
+
+        ecs_fields = {'source.ip': environ.get('REMOTE_ADDR'),
+                      'user.name': self._get_user(environ),
+                      '@timestamp': created,
+                      'http.request.method': method.lower(),
+                      'url.original': url,
+                      'url.path': environ.get('PATH_INFO'),
+                      'url.query': environ.get('QUERY_STRING') or None,
+                      'http.version': protocol[5:] if protocol.startswith('HTTP/') else protocol,
+                      'http.response.status_code': status,
+                      'http.response.body.bytes': size,
+                      'http.request.referrer': environ.get('HTTP_REFERER')}
+        request_id = environ.get('HTTP_X_REQUEST_ID')
+        if request_id is not None:
+            ecs_fields['http.request.id'] = request_id
+        ecs_fields['event.action'] = ecs_fields['http.request.method']
+        agent = environ.get('HTTP_USER_AGENT')
+        if agent:
+            ecs_fields.update(self.user_agent_parser(agent))
+        message = '"{0} {1} {2}" {3} {4}'.format(method, url, protocol, status, '-' if size is None else size)
+        ecs_fields['event'] = message
+        ecs_fields['message'] = message
+        ecs_fields['event.dataset'] = self.access_log.name
+        ecs_fields['ecs.version'] = '1.0.0'
+        ecs_fields['event.created'] = created
+        ecs_fields['event.severity'] = logging.INFO
+        ecs_fields['event.duration'] = ((request_time.days * 86400 + request_time.seconds) * 1000000
+                                        + request_time.microseconds) * 1000
+        ecs_fields['process.pid'] = os.getpid()
+        ecs_fields['level'] = 'info'
+        ecs_fields['logger'] = self.access_log.name
+        return ecs_fields
+
+    def access(self, resp, req, environ, request_time):
+        if not self._access_log_enabled():
+            return
+        try:
+            self.access_log.info(self.ecs_fields(resp, req, environ, request_time),
+                                 extra={'_logger': self.access_log, '_name': 'info'})
+        except Exception:
+            self.error(traceback.format_exc())
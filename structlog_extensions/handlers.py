@@ -0,0 +1,619 @@
+"""
+structlog_extensions.handlers
+
+This module contains logging handlers that move formatting and writing of log records off the logging thread.
+"""
+import base64
+import contextvars
+import glob
+import http.client
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+from urllib.parse import unquote, urlsplit
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest')
+BULK_OP_TYPES = ('create', 'index')
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+
+_queued_handlers = weakref.WeakSet()
+
+
+class QueuedStreamHandler(logging.StreamHandler):
+    """
+    Stream handler that formats and writes records on background threads.
+
+    ``emit`` only puts the record on a bounded queue, so the thread that logged it (for example the gunicorn worker
+    thread serving a request) doesn't pay for the formatter's processors - ``CombinedLogParser`` in a
+    ``ProcessorFormatter``'s ``foreign_pre_chain`` and ``NestedDictJSONRenderer`` - or wait on the stream. Background
+    threads are started on first use in every process, so the handler can be configured in the gunicorn master
+    before the workers are forked.
+
+    When the queue is full the ``policy`` decides what happens:
+
+    - ``'block'``: wait for space (at most ``block_timeout`` seconds, after which the new record is dropped)
+    - ``'drop_oldest'``: discard the oldest queued record to make room
+    - ``'drop_newest'``: discard the new record
+
+    Before a record is queued its message is merged with its arguments (so later changes to mutable arguments don't
+    show up in the output), its exception is rendered into ``exc_text`` and the logging thread's ``contextvars``
+    context is captured; the formatter then runs inside that context, so ``structlog.contextvars.merge_contextvars``
+    in a ``foreign_pre_chain`` sees the values bound by the request. Thread-local state is not carried over: bind
+    per-request values with ``structlog.contextvars`` instead of thread-locals.
+
+    Queued records are written out by ``flush()``, which ``logging.shutdown`` calls when the process exits. Call
+    ``flush_queued_handlers`` from gunicorn's ``worker_exit`` hook to make sure a worker's queue is drained.
+
+    Attributes:
+        stream (file, optional): Stream to write to. Default ``sys.stderr``.
+        capacity (int, optional): Maximum number of queued records. Default 10000.
+        policy (str, optional): Back-pressure policy, one of ``POLICIES``. Default 'block'.
+        workers (int, optional): Number of background threads. Default 1.
+        block_timeout (float, optional): Maximum seconds to wait for space with the 'block' policy. Default None
+                                         (wait indefinitely).
+
+    Example:
+        .. code-block:: python
+
+            "handlers": {
+                "console": {
+                    "class": "structlog_extensions.handlers.QueuedStreamHandler",
+                    "formatter": "json_formatter",
+                    "capacity": 50000,
+                    "policy": "drop_oldest",
+                }
+            }
+    """
+
+    def __init__(self, stream=None, capacity=10000, policy='block', workers=1, block_timeout=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy {0!r}, expected one of {1}'.format(policy, ', '.join(POLICIES)))
+        if capacity < 1 or workers < 1:
+            raise ValueError('capacity and workers must be at least 1')
+        super().__init__(stream)
+        self.capacity = capacity
+        self.policy = policy
+        self.workers = workers
+        self.block_timeout = block_timeout
+        self._reset()
+        _queued_handlers.add(self)
+
+    def _reset(self):
+        self._queue = deque()
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._idle = threading.Condition(self._mutex)
+        self._write_lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        self._closed = False
+        self._pid = os.getpid()
+        self.processed = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+
+    def _start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name='{0}-{1}'.format(type(self).__name__, index),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # Forked: the queue, locks and threads belong to the parent process.
+            self._reset()
+        with self._mutex:
+            if not self._closed:
+                if not self._threads:
+                    self._start()
+                while len(self._queue) >= self.capacity:
+                    if self.policy == 'drop_newest':
+                        self.dropped_newest += 1
+                        return
+                    if self.policy == 'drop_oldest':
+                        self._queue.popleft()
+                        self.dropped_oldest += 1
+                        break
+                    if not self._not_full.wait(self.block_timeout) and len(self._queue) >= self.capacity:
+                        self.dropped_newest += 1
+                        return
+                self._queue.append(self._prepare(record))
+                self._not_empty.notify()
+                return
+        self._write(record)
+
+    def _prepare(self, record):
+        """Freezes the parts of a record that depend on the logging thread, like ``QueueHandler.prepare``."""
+        # structlog's own records carry the event dict as msg, which the ProcessorFormatter needs unchanged.
+        if record.args and isinstance(record.msg, str):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+        return record, contextvars.copy_context()
+
+    def _write(self, record):
+        try:
+            msg = self.format(record)
+            with self._write_lock:
+                self.stream.write(msg + self.terminator)
+                self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            with self._mutex:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                record, context = self._queue.popleft()
+                self._busy += 1
+                self._not_full.notify()
+            try:
+                context.run(self._write, record)
+            finally:
+                with self._mutex:
+                    self._busy -= 1
+                    self.processed += 1
+                    if not self._queue and not self._busy:
+                        self._idle.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all queued records are written, then flushes the stream.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait. Default None (wait indefinitely).
+
+        Returns:
+            bool: True if the queue was drained.
+        """
+        drained = True
+        if self._pid == os.getpid():
+            with self._mutex:
+                if self._threads:
+                    drained = self._idle.wait_for(lambda: not self._queue and not self._busy, timeout)
+        with self._write_lock:
+            if self.stream and hasattr(self.stream, 'flush'):
+                self.stream.flush()
+        return drained
+
+    def close(self):
+        """Drains the queue, stops the background threads and closes the handler."""
+        if self._pid == os.getpid():
+            with self._mutex:
+                self._closed = True
+                self._not_empty.notify_all()
+            for thread in self._threads:
+                thread.join()
+        super().close()
+
+    def stats(self):
+        """
+        Returns the handler counters.
+
+        Returns:
+            dict: ``queued``, ``processed``, ``dropped_oldest`` and ``dropped_newest`` record counts.
+        """
+        with self._mutex:
+            return {'queued': len(self._queue),
+                    'processed': self.processed,
+                    'dropped_oldest': self.dropped_oldest,
+                    'dropped_newest': self.dropped_newest}
+
+
+class ElasticsearchBulkHandler(logging.Handler):
+    """
+    Handler that ships formatted records to an Elasticsearch ``_bulk`` endpoint from a background thread.
+
+    Every record is formatted on the logging thread (typically by a ``ProcessorFormatter`` ending in a
+    ``NestedDictJSONRenderer``, so the output must be one JSON document per record) and appended to an in-memory
+    buffer. A background thread sends the buffered documents as NDJSON ``_bulk`` requests once ``batch_bytes`` or
+    ``batch_size`` is reached, or when the oldest buffered document is ``flush_interval`` seconds old. Requests go over
+    one keep-alive HTTP connection per process, which is reopened after errors.
+
+    Failed requests (connection errors and 429, 502, 503 and 504 responses) are retried up to ``max_retries`` times
+    with exponential backoff; when a bulk response reports per-document errors, only the documents rejected with a
+    retryable status are sent again. Documents that still can't be delivered are appended to ``spill_path``, when
+    set, and replayed after the next successful request. Replay claims every file matching ``spill_path`` (any
+    ``{pid}``), so the documents of workers that exited or were recycled are not left behind. Documents rejected for other reasons (mapping errors, 4xx
+    responses) are counted and dropped. When the buffer holds ``capacity_bytes`` new records are dropped, so an
+    unavailable endpoint doesn't grow memory use without bound.
+
+    The background thread is started on first use in every process, so the handler can be configured in the gunicorn
+    master. Give every worker its own spill file by including ``{pid}`` in ``spill_path``. ``flush()`` waits until
+    the buffer has been sent (``flush_queued_handlers`` includes these handlers) and ``close()`` sends what is left.
+
+    Attributes:
+        url (str): Elasticsearch URL, for example 'http://localhost:9200' or 'https://user:pass@es:9200/logs'.
+                   Credentials in the URL are sent as basic authentication.
+        index (str, optional): Index or data stream to write to. Default None (taken from the URL path).
+        op_type (str, optional): Bulk action, 'create' (required by data streams) or 'index'. Default 'create'.
+        batch_size (int, optional): Maximum number of documents per request. Default 1000.
+        batch_bytes (int, optional): Maximum size of a request body in bytes. Default 5 MiB.
+        flush_interval (float, optional): Maximum age of a buffered document in seconds. Default 1.0.
+        capacity_bytes (int, optional): Maximum size of the buffer in bytes. Default 64 MiB.
+        max_retries (int, optional): Number of retries of a failed request. Default 5.
+        backoff (float, optional): Delay before the first retry in seconds; doubled for every further retry. Default 0.5.
+        max_backoff (float, optional): Maximum delay between retries in seconds. Default 30.
+        spill_path (str, optional): File to append undeliverable documents to. Default None (drop them).
+        max_spill_bytes (int, optional): Maximum size of the spill file in bytes. Default 256 MiB.
+        timeout (float, optional): Socket timeout of requests in seconds. Default 10.
+        headers (dict, optional): Extra request headers, for example ``{'Authorization': 'ApiKey ...'}``.
+
+    Example:
+        .. code-block:: python
+
+            "handlers": {
+                "elasticsearch": {
+                    "class": "structlog_extensions.handlers.ElasticsearchBulkHandler",
+                    "formatter": "json_formatter",
+                    "url": "http://localhost:9200",
+                    "index": "logs-gunicorn.access-default",
+                    "spill_path": "/var/spool/myapp/bulk-{pid}.ndjson",
+                }
+            }
+    """
+
+    def __init__(self, url, index=None, op_type='create', batch_size=1000, batch_bytes=5 * 1024 * 1024,
+                 flush_interval=1.0, capacity_bytes=64 * 1024 * 1024, max_retries=5, backoff=0.5, max_backoff=30.0,
+                 spill_path=None, max_spill_bytes=256 * 1024 * 1024, timeout=10.0, headers=None):
+        if op_type not in BULK_OP_TYPES:
+            raise ValueError('Unknown op_type {0!r}, expected one of {1}'.format(op_type, ', '.join(BULK_OP_TYPES)))
+        if batch_size < 1 or batch_bytes < 1 or capacity_bytes < 1:
+            raise ValueError('batch_size, batch_bytes and capacity_bytes must be at least 1')
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('Expected an http or https URL, got {0!r}'.format(url))
+        super().__init__()
+        self.url = url
+        self.index = index
+        self.op_type = op_type
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.capacity_bytes = capacity_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spill_path = spill_path
+        self.max_spill_bytes = max_spill_bytes
+        self.timeout = timeout
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path.rstrip('/') + '/_bulk'
+        self._headers = {'Content-Type': 'application/x-ndjson'}
+        if parts.username is not None:
+            credentials = '{0}:{1}'.format(unquote(parts.username), unquote(parts.password or ''))
+            self._headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        self._headers.update(headers or {})
+        action = {op_type: {'_index': index} if index else {}}
+        self._action = json.dumps(action, separators=(',', ':')).encode('utf-8') + b'\n'
+        self._reset()
+        _queued_handlers.add(self)
+
+    def _reset(self):
+        self._documents = deque()
+        self._buffered_bytes = 0
+        self._first_buffered = None
+        self._mutex = threading.Lock()
+        self._wakeup = threading.Condition(self._mutex)
+        self._idle = threading.Condition(self._mutex)
+        self._thread = None
+        self._sending = False
+        self._flushing = 0
+        self._closed = False
+        self._connection = None
+        self._pid = os.getpid()
+        self.sent = 0
+        self.requests = 0
+        self.retries = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replayed = 0
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # Forked: the buffer, locks, thread and connection belong to the parent process.
+            self._reset()
+        try:
+            document = self.format(record)
+            if isinstance(document, str):
+                document = document.encode('utf-8')
+            document = self._action + document.rstrip(b'\n') + b'\n'
+        except Exception:
+            self.handleError(record)
+            return
+        with self._mutex:
+            if self._closed or self._buffered_bytes + len(document) > self.capacity_bytes:
+                self.dropped += 1
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+                self._thread.start()
+            if not self._documents:
+                self._first_buffered = time.monotonic()
+            self._documents.append(document)
+            self._buffered_bytes += len(document)
+            if self._buffered_bytes >= self.batch_bytes or len(self._documents) >= self.batch_size:
+                self._wakeup.notify()
+
+    def _take_batch(self):
+        """Waits until a batch is due and takes it off the buffer. Returns None when closed and drained."""
+        with self._mutex:
+            while True:
+                if self._documents:
+                    age = time.monotonic() - self._first_buffered
+                    if (self._closed or self._flushing or age >= self.flush_interval
+                            or self._buffered_bytes >= self.batch_bytes or len(self._documents) >= self.batch_size):
+                        break
+                    self._wakeup.wait(self.flush_interval - age)
+                elif self._closed:
+                    return None
+                else:
+                    self._wakeup.wait()
+            batch = []
+            size = 0
+            while self._documents and len(batch) < self.batch_size:
+                document = self._documents[0]
+                if batch and size + len(document) > self.batch_bytes:
+                    break
+                batch.append(self._documents.popleft())
+                size += len(document)
+            self._buffered_bytes -= size
+            self._first_buffered = time.monotonic() if self._documents else None
+            self._sending = True
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                break
+            try:
+                if self._send(batch) and self.spill_path:
+                    self._replay()
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+            finally:
+                with self._mutex:
+                    self._sending = False
+                    if not self._documents:
+                        self._idle.notify_all()
+        self._disconnect()
+
+    def _connect(self):
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self.timeout,
+                                               context=ssl.create_default_context())
+        return http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+
+    def _disconnect(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _post(self, body):
+        if self._connection is None:
+            self._connection = self._connect()
+        try:
+            self._connection.request('POST', self._path, body, self._headers)
+            response = self._connection.getresponse()
+            data = response.read()
+        except Exception:
+            self._disconnect()
+            raise
+        if response.will_close:
+            self._disconnect()
+        self.requests += 1
+        return response.status, data
+
+    def _send(self, documents):
+        """
+        Sends documents, retrying failures, and spills what can't be delivered.
+
+        Returns:
+            bool: True if every document was either accepted or permanently rejected, False if some were spilled.
+        """
+        attempt = 0
+        while True:
+            try:
+                status, data = self._post(b''.join(documents))
+            except (OSError, http.client.HTTPException):
+                status = None
+            if status is not None and status not in RETRY_STATUSES:
+                if status >= 300:
+                    self.rejected += len(documents)
+                    return True
+                documents = self._retryable_documents(documents, data)
+                if not documents:
+                    return True
+            attempt += 1
+            if attempt > self.max_retries or not self._backoff(attempt):
+                self._spill(documents)
+                return False
+            self.retries += 1
+
+    def _retryable_documents(self, documents, data):
+        """Counts the outcome of a successful bulk request and returns the documents to send again."""
+        try:
+            response = json.loads(data)
+        except ValueError:
+            response = dict()
+        if not response.get('errors'):
+            self.sent += len(documents)
+            return []
+        retry = []
+        items = response.get('items') or ()
+        for document, item in zip(documents, items):
+            status = next(iter(item.values())).get('status', 500)
+            if status < 300:
+                self.sent += 1
+            elif status in RETRY_STATUSES:
+                retry.append(document)
+            else:
+                self.rejected += 1
+        # Documents without a result item in the response have an unknown outcome; send them again.
+        retry.extend(documents[len(items):])
+        return retry
+
+    def _backoff(self, attempt):
+        """Waits before a retry. Returns False when the handler was closed, so pending documents are spilled."""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        with self._mutex:
+            if not self._closed:
+                self._wakeup.wait_for(lambda: self._closed, delay)
+            return not self._closed
+
+    def _spill_file(self):
+        return self.spill_path.format(pid=self._pid)
+
+    def _spill(self, documents):
+        if not self.spill_path:
+            self.dropped += len(documents)
+            return
+        path = self._spill_file()
+        data = b''.join(documents)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if size + len(data) > self.max_spill_bytes:
+            self.dropped += len(documents)
+            return
+        with open(path, 'ab') as spill_file:
+            spill_file.write(data)
+        self.spilled += len(documents)
+
+    def _spill_files(self):
+        # Formatting with a NUL placeholder keeps glob characters in the rest of the path escaped.
+        pattern = glob.escape(self.spill_path.format(pid='\0')).replace('\0', '*')
+        return sorted(path for path in glob.glob(pattern) if not path.endswith('.replay'))
+
+    def _replay(self):
+        """
+        Sends the documents of every spill file matching ``spill_path``, so the files of exited workers are replayed
+        too. Documents that fail again are spilled again.
+        """
+        for path in self._spill_files():
+            # Renaming claims the file atomically; the name is unique to this process, so claims never overwrite
+            # each other when several workers replay at once.
+            replay_path = '{0}.{1}.replay'.format(path, self._pid)
+            try:
+                if not os.path.getsize(path):
+                    continue
+                os.replace(path, replay_path)
+                with open(replay_path, 'rb') as replay_file:
+                    lines = replay_file.readlines()
+            except OSError:
+                continue
+            os.remove(replay_path)
+            documents = [b''.join(lines[position:position + 2]) for position in range(0, len(lines) - 1, 2)]
+            if not self._replay_documents(documents):
+                return
+
+    def _replay_documents(self, documents):
+        """Sends replayed documents in batches. Returns False, after spilling the rest, when a batch fails."""
+        batch = []
+        size = 0
+        for position, document in enumerate(documents):
+            if batch and (size + len(document) > self.batch_bytes or len(batch) >= self.batch_size):
+                if not self._send(batch):
+                    self._spill(documents[position:])
+                    return False
+                self.replayed += len(batch)
+                batch = []
+                size = 0
+            batch.append(document)
+            size += len(document)
+        if batch:
+            if not self._send(batch):
+                return False
+            self.replayed += len(batch)
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Waits until all buffered documents have been sent (or spilled).
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait. Default None (wait indefinitely).
+
+        Returns:
+            bool: True if the buffer was drained.
+        """
+        if self._pid != os.getpid():
+            return True
+        with self._mutex:
+            if self._thread is None:
+                return not self._documents
+            self._flushing += 1
+            self._wakeup.notify_all()
+            try:
+                return self._idle.wait_for(lambda: not self._documents and not self._sending, timeout)
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        """Sends the buffered documents, stops the background thread and closes the connection."""
+        if self._pid == os.getpid():
+            with self._mutex:
+                self._closed = True
+                self._wakeup.notify_all()
+                thread = self._thread
+            if thread is not None:
+                thread.join()
+        super().close()
+
+    def stats(self):
+        """
+        Returns the handler counters.
+
+        Returns:
+            dict: ``buffered`` documents and ``buffered_bytes``, ``requests`` made, documents ``sent``,
+            ``retries``, documents ``rejected`` by Elasticsearch, ``dropped``, ``spilled`` to disk and
+            ``replayed`` from the spill file.
+        """
+        with self._mutex:
+            return {'buffered': len(self._documents),
+                    'buffered_bytes': self._buffered_bytes,
+                    'requests': self.requests,
+                    'sent': self.sent,
+                    'retries': self.retries,
+                    'rejected': self.rejected,
+                    'dropped': self.dropped,
+                    'spilled': self.spilled,
+                    'replayed': self.replayed}
+
+
+def flush_queued_handlers(timeout=None):
+    """
+    Drains every ``QueuedStreamHandler`` and ``ElasticsearchBulkHandler`` in the current process.
+
+    Intended for gunicorn's ``worker_exit`` server hook:
+
+    .. code-block:: python
+
+        def worker_exit(server, worker):
+            structlog_extensions.handlers.flush_queued_handlers()
+
+    Args:
+        timeout (float, optional): Maximum number of seconds to wait per handler. Default None (wait indefinitely).
+
+    Returns:
+        bool: True if all handlers were drained.
+    """
+    return all([handler.flush(timeout) for handler in list(_queued_handlers)])
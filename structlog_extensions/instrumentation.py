@@ -0,0 +1,266 @@
+"""
+structlog_extensions.instrumentation
+
+This module measures where the time goes in structlog processor chains and logging handlers.
+"""
+import time
+import structlog
+from . import utils
+from .processors import CombinedLogParser
+
+_cache_attributes = ('ua_cache', 'ua_table', 'plan_cache')
+
+
+class StageStats:
+    """
+    Counters of one instrumented stage.
+
+    Every call is counted, but only one in ``sample_every`` calls is timed; ``total_ms`` extrapolates the timed calls
+    to all of them. The counters are updated without locking to keep the overhead low, so with many threads logging
+    concurrently they can be slightly off.
+
+    Attributes:
+        name (str): Stage name.
+        calls (int): Number of calls.
+        timed (int): Number of timed calls.
+        timed_ns (int): Total duration of the timed calls in nanoseconds.
+        max_ns (int): Longest timed call in nanoseconds.
+        exceptions (int): Number of calls that raised an exception, other than ``structlog.DropEvent``.
+        dropped (int): Number of calls that raised ``structlog.DropEvent``.
+    """
+    __slots__ = ('name', 'calls', 'timed', 'timed_ns', 'max_ns', 'exceptions', 'dropped')
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.timed = 0
+        self.timed_ns = 0
+        self.max_ns = 0
+        self.exceptions = 0
+        self.dropped = 0
+
+    def add_timing(self, duration):
+        self.timed += 1
+        self.timed_ns += duration
+        if duration > self.max_ns:
+            self.max_ns = duration
+
+    def as_dict(self):
+        mean_ns = self.timed_ns / self.timed if self.timed else 0.0
+        return {'calls': self.calls,
+                'exceptions': self.exceptions,
+                'dropped': self.dropped,
+                'mean_us': mean_ns / 1000.0,
+                'max_us': self.max_ns / 1000.0,
+                'total_ms': mean_ns * self.calls / 1000000.0}
+
+
+def _hit_rate(cache):
+    lookups = cache.hits + cache.misses
+    return {'hits': cache.hits, 'misses': cache.misses, 'hit_rate': cache.hits / lookups if lookups else None}
+
+
+def _cache_stats(target):
+    """Returns the hit counters of the caches a processor or handler uses, keyed on the attribute name."""
+    caches = dict()
+    for attribute in _cache_attributes:
+        cache = getattr(target, attribute, None)
+        if cache is not None and hasattr(cache, 'hits'):
+            caches[attribute] = _hit_rate(cache)
+    if isinstance(target, CombinedLogParser):
+        caches['timestamp_cache'] = _hit_rate(utils._timestamp_cache)
+    return caches
+
+
+class InstrumentedProcessor:
+    """
+    Wraps a structlog processor and records its ``StageStats``.
+
+    Attributes:
+        processor (callable): The wrapped processor.
+        stats (StageStats): The counters.
+        instrumentation (ChainInstrumentation): Instrumentation the processor belongs to.
+    """
+
+    def __init__(self, processor, stats, instrumentation):
+        self.processor = processor
+        self.stats = stats
+        self.instrumentation = instrumentation
+        self._sample_every = instrumentation.sample_every
+
+    def __call__(self, logger, method_name, event_dict):
+        stats = self.stats
+        stats.calls += 1
+        try:
+            if stats.calls % self._sample_every:
+                return self.processor(logger, method_name, event_dict)
+            started = time.perf_counter_ns()
+            try:
+                return self.processor(logger, method_name, event_dict)
+            finally:
+                stats.add_timing(time.perf_counter_ns() - started)
+                self.instrumentation.tick()
+        except structlog.DropEvent:
+            stats.dropped += 1
+            raise
+        except Exception:
+            stats.exceptions += 1
+            raise
+
+    def __repr__(self):
+        return '<{0} {1}: {2!r}>'.format(type(self).__name__, self.stats.name, self.processor)
+
+
+def _structlog_emitter(logger_name):
+    def emit(snapshot):
+        structlog.get_logger(logger_name).info('processor_stats', **snapshot)
+    return emit
+
+
+class ChainInstrumentation:
+    """
+    Opt-in instrumentation of structlog processor chains and logging handlers.
+
+    ``wrap`` replaces the processors of a chain (for example a ``ProcessorFormatter``'s ``foreign_pre_chain`` or
+    ``processors``) with ``InstrumentedProcessor`` wrappers and ``wrap_handler`` instruments a handler's ``emit``.
+    Every call is counted, but only one in ``sample_every`` calls is timed with ``time.perf_counter_ns``, which keeps
+    the overhead low enough to leave it enabled in production.
+
+    ``snapshot()`` returns the counters per stage, including the hit rates of the user agent, nesting plan and
+    timestamp caches. With ``log_interval`` set, the snapshot is also passed to ``emit`` every ``log_interval``
+    seconds; the default ``emit`` logs a 'processor_stats' event through ``structlog.get_logger(stats_logger)``.
+
+    Attributes:
+        sample_every (int, optional): Time one in this many calls. Default 16.
+        log_interval (float, optional): Seconds between self-logged snapshots. Default None (never).
+        emit (callable, optional): Function called with each periodic snapshot.
+        stats_logger (str, optional): Logger name used by the default ``emit``. Default
+                                      'structlog_extensions.instrumentation'.
+
+    Example:
+        .. code-block:: python
+
+            instrumentation = ChainInstrumentation(log_interval=300)
+            pre_chain = instrumentation.wrap([
+                structlog.stdlib.add_log_level,
+                structlog.stdlib.add_logger_name,
+                structlog_extensions.processors.CombinedLogParser("gunicorn.access"),
+            ])
+            renderer = instrumentation.wrap([NestedDictJSONRenderer(separator='.')])[0]
+    """
+
+    def __init__(self, sample_every=16, log_interval=None, emit=None,
+                 stats_logger='structlog_extensions.instrumentation'):
+        if sample_every < 1:
+            raise ValueError('sample_every must be at least 1')
+        self.sample_every = sample_every
+        self.log_interval = log_interval
+        self.emit = emit or _structlog_emitter(stats_logger)
+        self._stages = dict()
+        self._targets = dict()
+        self._started = time.monotonic()
+        self._next_log = None if log_interval is None else self._started + log_interval
+        self._logging = False
+
+    def _stats(self, target, name=None):
+        name = name or getattr(target, '__name__', None) or type(target).__name__
+        unique_name = name
+        suffix = 2
+        while unique_name in self._stages:
+            unique_name = '{0}#{1}'.format(name, suffix)
+            suffix += 1
+        stats = self._stages[unique_name] = StageStats(unique_name)
+        self._targets[unique_name] = target
+        return stats
+
+    def wrap(self, processors, names=None):
+        """
+        Instruments a processor chain.
+
+        Args:
+            processors (list): structlog processors
+            names (list, optional): Stage names, one per processor. Default is the function or class name.
+
+        Returns:
+            list: The instrumented processors, in the same order.
+        """
+        names = names or [None] * len(processors)
+        return [InstrumentedProcessor(processor, self._stats(processor, name), self)
+                for processor, name in zip(processors, names)]
+
+    def wrap_handler(self, handler, name=None):
+        """
+        Instruments a ``logging.Handler`` by wrapping its ``emit`` method. For handlers that write inline this covers
+        formatting (including the formatter's processors) and writing; for a ``handlers.QueuedStreamHandler`` it
+        covers queueing, and its queue counters are added to the snapshot.
+
+        Args:
+            handler (logging.Handler): The handler to instrument.
+            name (str, optional): Stage name. Default 'handler:' followed by the handler class name.
+
+        Returns:
+            logging.Handler: The same handler.
+        """
+        stats = self._stats(handler, name or 'handler:{0}'.format(type(handler).__name__))
+        emit = handler.emit
+        sample_every = self.sample_every
+        tick = self.tick
+
+        def instrumented_emit(record):
+            stats.calls += 1
+            if stats.calls % sample_every:
+                return emit(record)
+            started = time.perf_counter_ns()
+            try:
+                return emit(record)
+            finally:
+                stats.add_timing(time.perf_counter_ns() - started)
+                tick()
+        handler.emit = instrumented_emit
+        return handler
+
+    def tick(self):
+        """Emits a snapshot when ``log_interval`` has passed. Called on every timed call."""
+        if self._next_log is None or self._logging:
+            return
+        now = time.monotonic()
+        if now < self._next_log:
+            return
+        self._next_log = now + self.log_interval
+        # The snapshot event can go through the instrumented chain itself, which must not log it again.
+        self._logging = True
+        try:
+            self.emit(self.snapshot())
+        finally:
+            self._logging = False
+
+    def snapshot(self):
+        """
+        Returns the current counters.
+
+        Returns:
+            dict: ``uptime`` in seconds, ``sample_every`` and ``stages``: stage name to ``calls``, ``exceptions``,
+            ``dropped``, ``mean_us``, ``max_us`` and estimated ``total_ms``, plus ``caches`` (attribute name to
+            ``hits``, ``misses`` and ``hit_rate``) and the ``stats()`` of stages that have them.
+        """
+        stages = dict()
+        for name, stats in list(self._stages.items()):
+            target = self._targets[name]
+            stage = stats.as_dict()
+            caches = _cache_stats(target)
+            if caches:
+                stage['caches'] = caches
+            if callable(getattr(target, 'stats', None)):
+                stage['stats'] = target.stats()
+            stages[name] = stage
+        return {'uptime': time.monotonic() - self._started,
+                'sample_every': self.sample_every,
+                'stages': stages}
+
+    def reset(self):
+        """Resets the counters of all stages."""
+        for stats in self._stages.values():
+            stats.reset()
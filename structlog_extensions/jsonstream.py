@@ -0,0 +1,187 @@
+"""
+structlog_extensions.jsonstream
+
+This module contains the JSON serialization backends and renders flat, namespaced event dicts straight to nested
+JSON without building the nested dicts first.
+"""
+import json
+from json.encoder import encode_basestring, encode_basestring_ascii
+from operator import itemgetter
+from .utils import _compile_nesting_plan
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+_conflict = object()
+
+if orjson is not None:
+    # Values stdlib json can't encode natively go through the default handler in both backends, so bound datetimes,
+    # dataclasses and exceptions render the same way whichever backend is used.
+    _orjson_options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+def _orjson_dumps(obj, default=None, sort_keys=False, indent=None):
+    option = _orjson_options
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent is not None:
+        if indent != 2:
+            raise ValueError('The orjson backend only supports indent=2')
+        option |= orjson.OPT_INDENT_2
+    try:
+        return orjson.dumps(obj, default=default, option=option)
+    except orjson.JSONEncodeError as error:
+        if 'Integer exceeds' not in str(error):
+            raise
+    # orjson only encodes integers up to 64 bits; json writes any int, so only this event takes the slow path.
+    return json.dumps(obj, default=default, sort_keys=sort_keys, indent=indent, ensure_ascii=False,
+                      separators=(',', ': ' if indent is not None else ':')).encode('utf-8')
+
+
+def resolve_json_backend(backend='auto'):
+    """
+    Looks up a JSON serialization backend.
+
+    ``'auto'`` picks orjson when it is installed and falls back to the standard library ``json`` module otherwise.
+    The orjson backend writes compact JSON (no spaces after separators), returns ``bytes`` and only accepts the
+    ``default``, ``sort_keys`` and ``indent=2`` dumps arguments. It serializes UUIDs and enums as their values, where
+    ``json`` passes them to the default handler, and writes NaN and infinite floats as ``null``, where ``json`` writes
+    ``NaN`` and ``Infinity`` (which are not valid JSON). Events holding integers beyond 64 bits are serialized with
+    ``json`` instead.
+
+    Args:
+        backend (str, optional): ``'auto'``, ``'orjson'`` or ``'json'``. Default ``'auto'``.
+
+    Returns:
+        tuple: The backend name and a ``json.dumps`` compatible serializer.
+
+    Raises:
+        ValueError: If the backend is unknown or not installed.
+    """
+    if backend == 'auto':
+        backend = 'json' if orjson is None else 'orjson'
+    if backend == 'json':
+        return backend, json.dumps
+    if backend == 'orjson':
+        if orjson is None:
+            raise ValueError('The orjson backend requires the orjson package')
+        return backend, _orjson_dumps
+    raise ValueError('Unknown JSON backend: {0}'.format(backend))
+
+
+def _float_repr(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return 'Infinity'
+    if value == float('-inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+def _compile_template(plan, encode_key):
+    """
+    Compiles a nesting plan into a ``%`` format template and the order in which the values fill it.
+
+    Returns:
+        tuple: ``(template, value_indices)``, or None if the plan contains a key that is both a value and a parent.
+    """
+    parts = []
+    indices = []
+
+    def emit(entries):
+        parts.append('{')
+        for position, (name, value_index, children) in enumerate(entries):
+            if position:
+                parts.append(', ')
+            parts.append(encode_key(name).replace('%', '%%') + ': ')
+            if children is None:
+                parts.append('%s')
+                indices.append(value_index)
+            elif value_index is not None:
+                raise ValueError('conflicting keys')
+            else:
+                emit(children)
+        parts.append('}')
+
+    try:
+        emit(plan)
+    except ValueError:
+        return None
+    return ''.join(parts), tuple(indices)
+
+
+class FlatJSONSerializer:
+    """
+    Serializes a flat event dict with namespaced keys directly into nested JSON text.
+
+    For each distinct key set the nesting is compiled once into a string template holding all the object
+    punctuation and encoded key names, so rendering an event only encodes its values and fills in the template. The
+    output is identical to ``json.dumps(unflatten_dict(event_dict, separator))`` with the default separators.
+
+    Key sets in which a key is both a value and the parent of other keys are not handled; ``__call__`` returns None
+    for them so the caller can fall back to ``unflatten_dict``.
+
+    Attributes:
+        separator (str, optional): Namespace separator. Default '.'
+        maxsize (int, optional): Maximum number of key sets to keep compiled templates for. Default 256.
+        default (callable, optional): ``json.dumps`` default handler used for values that aren't JSON native.
+        ensure_ascii (bool, optional): Same as the ``json.dumps`` argument. Default True.
+    """
+
+    def __init__(self, separator='.', maxsize=256, default=None, ensure_ascii=True):
+        self.separator = separator
+        self.maxsize = maxsize
+        self.default = default
+        self.ensure_ascii = ensure_ascii
+        self._encode_key = encode_basestring_ascii if ensure_ascii else encode_basestring
+        self._templates = dict()
+        none_value = 'null'
+        self._encoders = {str: self._encode_key,
+                          int: int.__repr__,
+                          float: _float_repr,
+                          bool: lambda value: 'true' if value else 'false',
+                          type(None): lambda value: none_value}
+
+    def _encode_other(self, value):
+        return json.dumps(value, default=self.default, ensure_ascii=self.ensure_ascii)
+
+    def _template(self, keys):
+        template = self._templates.get(keys)
+        if template is None:
+            template = _compile_template(_compile_nesting_plan(keys, self.separator), self._encode_key)
+            if template is None:
+                template = _conflict
+            else:
+                template_string, indices = template
+                # itemgetter returns a bare value rather than a tuple for a single index, so that case is indexed directly.
+                template = template_string, itemgetter(*indices) if len(indices) > 1 else None, indices
+            if len(self._templates) >= self.maxsize:
+                self._templates.pop(next(iter(self._templates)), None)
+            self._templates[keys] = template
+        return template
+
+    def __call__(self, event_dict):
+        """
+        Renders the event dict as nested JSON.
+
+        Args:
+            event_dict (dict): Flat event dict
+
+        Returns:
+            str: JSON text, or None if the event has conflicting keys.
+        """
+        template = self._template(tuple(event_dict))
+        if template is _conflict:
+            return None
+        template_string, getter, indices = template
+        values = list(event_dict.values())
+        if getter is not None:
+            values = getter(values)
+        elif indices:
+            values = (values[indices[0]],)
+        encoders = self._encoders
+        encode_other = self._encode_other
+        return template_string % tuple([encoders.get(type(value), encode_other)(value) for value in values])
@@ -0,0 +1,405 @@
+"""
+structlog_extensions.logformat
+
+This module compiles Apache ``LogFormat`` and gunicorn ``access_log_format`` strings into specialised parsers.
+"""
+import re
+from functools import lru_cache
+
+COMBINED_LOG_FORMAT = '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i"'
+GUNICORN_LOG_FORMAT = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+
+_ecs_field_mappings = {'host': 'source.ip',
+                       'user': 'user.name',
+                       'event': 'event.original',
+                       'method': 'http.request.method',
+                       'referrer': 'http.request.referrer',
+                       'size': 'http.response.body.bytes',
+                       'status': 'http.response.status_code',
+                       'time': '@timestamp',
+                       'url': 'url.original',
+                       'version': 'http.version',
+                       'path': 'url.path',
+                       'query': 'url.query',
+                       'duration': 'event.duration',
+                       'request_id': 'http.request.id',
+                       'request_bytes': 'http.request.bytes',
+                       'response_bytes': 'http.response.bytes',
+                       'pid': 'process.pid',
+                       'client_ip': 'client.ip',
+                       'server_ip': 'server.ip',
+                       'server_port': 'server.port',
+                       'server_name': 'server.domain',
+                       'truncated': 'labels.truncated'}
+
+# Captured fields that are only parsed further (into http.request.* and user_agent.* fields), never output as is.
+_raw_fields = ('request', 'agent')
+
+_DIRECTIVE_RE = re.compile(r'%\((?:\{(?P<g_arg>[^}]*)\})?(?P<g_code>[a-zA-Z])\)s'
+                           r'|%(?:[<>])?(?:\{(?P<a_arg>[^}]*)\})?(?P<a_code>[a-zA-Z%])')
+_WHITESPACE_RE = re.compile(r'(\s+)')
+_STATUS_SIZE_RE = re.compile(r'"\s+([0-9]+)\s+(\S+)\s+"')
+# Patterns searched for on reversed lines by CombinedLogScanner, so their first match is the rightmost one.
+_REVERSED_HEADERS_RE = re.compile(r'"\s+"')
+_REVERSED_STATUS_SIZE_RE = re.compile(r'"\s+\S+\s+[0-9]+\s+"')
+_REVERSED_REQUEST_RE = re.compile(r'"\s+\]')
+
+
+def _dash_to_none(value):
+    return None if value == '-' else value
+
+
+def _size(value):
+    return 0 if value == '-' else int(value)
+
+
+def _int_or_none(value):
+    return None if value == '-' else int(value)
+
+
+def _lower(value):
+    return value.lower()
+
+
+def _query(value):
+    return value[1:] if value.startswith('?') else value
+
+
+def _version(value):
+    return value[5:] if value.startswith('HTTP/') else value
+
+
+def _pid(value):
+    return int(value.strip('<>'))
+
+
+def _scaled_duration(factor):
+    def convert(value):
+        return None if value == '-' else int(round(float(value) * factor))
+    return convert
+
+
+_seconds_to_ns = _scaled_duration(1000000000)
+_ms_to_ns = _scaled_duration(1000000)
+_us_to_ns = _scaled_duration(1000)
+
+# (field name, regex, converter). A field name of None means the directive is matched but not captured.
+_apache_directives = {
+    'h': ('host', r'\S+', None),
+    'a': ('client_ip', r'\S+', None),
+    'A': ('server_ip', r'\S+', None),
+    'l': (None, r'\S+', None),
+    'u': ('user', r'\S+', _dash_to_none),
+    't': ('time', r'\[(.+)\]', None),
+    'r': ('request', r'.+', None),
+    'm': ('method', r'\S+', _lower),
+    'U': ('path', r'\S+', None),
+    'q': ('query', r'\S*', _query),
+    'H': ('version', r'\S+', _version),
+    's': ('status', r'[0-9]+', int),
+    'b': ('size', r'\S+', _size),
+    'B': ('size', r'[0-9]+', int),
+    'I': ('request_bytes', r'\S+', _int_or_none),
+    'O': ('response_bytes', r'\S+', _int_or_none),
+    'D': ('duration', r'[0-9]+', _us_to_ns),
+    'T': ('duration', r'[0-9]+', _seconds_to_ns),
+    'P': ('pid', r'[0-9]+', int),
+    'p': ('server_port', r'[0-9]+', int),
+    'v': ('server_name', r'\S+', None),
+    'V': ('server_name', r'\S+', None),
+    'X': (None, r'\S', None),
+}
+
+_gunicorn_directives = {
+    'h': ('host', r'\S+', None),
+    'l': (None, r'\S+', None),
+    'u': ('user', r'\S+', _dash_to_none),
+    't': ('time', r'\[(.+)\]', None),
+    'r': ('request', r'.+', None),
+    'm': ('method', r'\S+', _lower),
+    'U': ('path', r'\S+', None),
+    'q': ('query', r'\S*', _query),
+    'H': ('version', r'\S+', _version),
+    's': ('status', r'[0-9]+', int),
+    'B': ('size', r'[0-9]+', int),
+    'b': ('size', r'\S+', _size),
+    'f': ('referrer', r'.*', _dash_to_none),
+    'a': ('agent', r'.*', None),
+    'T': ('duration', r'[0-9]+', _seconds_to_ns),
+    'D': ('duration', r'[0-9]+', _us_to_ns),
+    'M': ('duration', r'[0-9]+', _ms_to_ns),
+    'L': ('duration', r'[0-9.]+', _seconds_to_ns),
+    'p': ('pid', r'<[0-9]+>', _pid),
+}
+
+# Request headers with a dedicated field, keyed on the lower-cased header name.
+_request_headers = {
+    'referer': ('referrer', r'.*', _dash_to_none),
+    'referrer': ('referrer', r'.*', _dash_to_none),
+    'user-agent': ('agent', r'.*', None),
+    'x-request-id': ('request_id', r'\S+', _dash_to_none),
+}
+
+_time_units = {
+    's': _seconds_to_ns,
+    'ms': _ms_to_ns,
+    'us': _us_to_ns,
+}
+
+
+def _header_directive(namespace, name, quoted):
+    field = '{0}.{1}'.format(namespace, name.lower().replace('-', '_'))
+    return field, r'.*' if quoted else r'\S+', _dash_to_none
+
+
+def _resolve_directive(code, arg, gunicorn, quoted):
+    """Returns the (field, regex, converter) spec for a single format directive."""
+    if code == 'i':
+        if arg is None:
+            raise ValueError('Request header directive requires a header name')
+        spec = _request_headers.get(arg.lower())
+        if spec is not None:
+            return spec
+        return _header_directive('http.request.headers', arg, quoted)
+    if code == 'o' and arg is not None:
+        return _header_directive('http.response.headers', arg, quoted)
+    if code == 'e' and arg is not None:
+        return _header_directive('labels', arg, quoted)
+    if code == 'T' and arg is not None and not gunicorn:
+        if arg not in _time_units:
+            raise ValueError('Unsupported time unit in %{{{0}}}T'.format(arg))
+        return 'duration', r'[0-9]+', _time_units[arg]
+    directives = _gunicorn_directives if gunicorn else _apache_directives
+    if arg is not None or code not in directives:
+        raise ValueError('Unsupported log format directive: {0}'.format(code if arg is None else
+                                                                       '{{{0}}}{1}'.format(arg, code)))
+    return directives[code]
+
+
+def _literal_to_regex(literal):
+    return ''.join(r'\s+' if part.isspace() else re.escape(part)
+                   for part in _WHITESPACE_RE.split(literal) if part)
+
+
+def _compile(log_format):
+    gunicorn = '%(' in log_format
+    regex_parts = []
+    captures = []
+    field_mappings = dict(_ecs_field_mappings)
+    position = 0
+    for directive in _DIRECTIVE_RE.finditer(log_format):
+        literal = log_format[position:directive.start()]
+        regex_parts.append(_literal_to_regex(literal))
+        position = directive.end()
+        code = directive.group('g_code') or directive.group('a_code')
+        arg = directive.group('g_arg') if directive.group('g_code') else directive.group('a_arg')
+        if code == '%':
+            regex_parts.append('%')
+            continue
+        quoted = directive.start() > 0 and log_format[directive.start() - 1] == '"'
+        field, pattern, converter = _resolve_directive(code, arg, gunicorn, quoted)
+        if field is None or any(field == captured for captured, _ in captures):
+            # Uncaptured, or a repeat of a field that is already captured: match it without a group.
+            regex_parts.append(re.sub(r'\((?!\?)', '(?:', pattern))
+            continue
+        if '(' not in pattern.replace(r'\(', ''):
+            pattern = '({0})'.format(pattern)
+        regex_parts.append(pattern)
+        captures.append((field, converter))
+        if field not in _raw_fields:
+            field_mappings.setdefault(field, field)
+    regex_parts.append(_literal_to_regex(log_format[position:]))
+    pattern = re.compile(''.join(regex_parts) + r'\s*\Z')
+    return pattern, tuple(captures), field_mappings
+
+
+class LogFormatParser:
+    """
+    Parser for access log lines written using an Apache ``LogFormat`` or gunicorn ``access_log_format`` string.
+
+    The format string is compiled once into a single regular expression and a list of typed field converters, so
+    parsing a line only costs a regex match. Gunicorn style formats (``%(h)s``, ``%({x-request-id}i)s``) are
+    detected by the presence of ``%(``; anything else is treated as an Apache ``LogFormat``.
+
+    Captured fields use the same names as ``structlog_extensions.utils._parse_log_into_fields`` (``host``,
+    ``request``, ``status``, ...) and ``field_mappings`` maps them to their ECS field names. Durations (``%D``,
+    ``%T``, ``%{ms}T`` and gunicorn's ``%(D)s``, ``%(T)s``, ``%(M)s``, ``%(L)s``) are converted to nanoseconds
+    for ``event.duration``. Other request/response headers map to ``http.request.headers.*`` and
+    ``http.response.headers.*``.
+
+    Attributes:
+        log_format (str): The format string the parser was compiled from.
+        pattern (re.Pattern): The compiled line pattern.
+        field_mappings (dict): Field name to ECS field name, including any header fields captured by the format.
+
+    Raises:
+        ValueError: If the format contains a directive that can't be parsed back out of a log line.
+
+    Example:
+        .. code-block:: python
+
+            parser = LogFormatParser('%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(L)s')
+            fields = parser.parse(log_line)
+    """
+
+    def __init__(self, log_format=COMBINED_LOG_FORMAT):
+        self.log_format = log_format
+        self.pattern, self._captures, self.field_mappings = _compile(log_format)
+        self._match = self.pattern.match
+
+    def parse(self, log_line):
+        """
+        Parses a log line into its fields.
+
+        Args:
+            log_line (str): Access log line
+
+        Returns:
+            dict: Field name to typed value, or an empty dict if the line doesn't match the format.
+        """
+        match = self._match(log_line)
+        if match is None:
+            return dict()
+        fields = dict()
+        for (field, converter), value in zip(self._captures, match.groups()):
+            fields[field] = value if converter is None else converter(value)
+        return fields
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.log_format)
+
+
+def _rightmost(pattern, reversed_line, end):
+    """
+    Returns the rightmost match of a reversed ``pattern`` that starts (on the original line) before ``end`` as the
+    original positions of its last and first character, or None.
+    """
+    length = len(reversed_line)
+    match = pattern.search(reversed_line, length - end)
+    if match is None:
+        return None
+    return length - 1 - match.start(), length - match.end()
+
+
+class CombinedLogScanner(LogFormatParser):
+    """
+    Parser for the Combined log format (and gunicorn's default ``access_log_format``, which has the same layout) that
+    runs in time linear in the line length.
+
+    The Combined format regular expression has four greedy groups (``%t``, ``%r`` and the two quoted headers), so a
+    malformed line can make it backtrack through every combination of their possible ends. The scanner finds the same
+    ends directly, working from the end of the line: the user agent ends at the last quote, the referrer at the
+    rightmost ``"<whitespace>"`` before it, the request at the rightmost quote followed by a status code and size
+    that fit before the referrer, and the timestamp at the rightmost ``]<whitespace>"`` before the request. Every
+    step is a single regular expression search of the reversed line, over a part of it no other step searches, and
+    none of them can backtrack; the result is the match the Combined format regular expression would find.
+
+    Lines longer than ``max_line_length`` and lines that can't be Combined log lines (no closing quote, leading
+    whitespace, fewer than four fields) are rejected before scanning. Referrer and user agent values longer than
+    ``max_field_length`` are cut off at that length and their field names listed in a comma separated ``truncated``
+    field (``labels.truncated``). Lines containing a newline are rejected.
+
+    Attributes:
+        log_format (str, optional): ``COMBINED_LOG_FORMAT`` or ``GUNICORN_LOG_FORMAT``. Default is the Apache
+                                    Combined log format.
+        max_line_length (int, optional): Longest line that is parsed. Default 65536.
+        max_field_length (int, optional): Length referrer and user agent values are truncated to. Default 8192.
+
+    Raises:
+        ValueError: If ``log_format`` isn't one of the supported formats.
+    """
+
+    def __init__(self, log_format=COMBINED_LOG_FORMAT, max_line_length=65536, max_field_length=8192):
+        if log_format not in _scanned_formats:
+            raise ValueError('CombinedLogScanner only parses {0}'.format(' and '.join(map(repr, _scanned_formats))))
+        if max_line_length < 1 or max_field_length < 1:
+            raise ValueError('max_line_length and max_field_length must be at least 1')
+        super().__init__(log_format)
+        self.max_line_length = max_line_length
+        self.max_field_length = max_field_length
+
+    def parse(self, log_line):
+        """
+        Parses a log line into its fields.
+
+        Args:
+            log_line (str): Access log line
+
+        Returns:
+            dict: Field name to typed value, or an empty dict if the line doesn't match the format.
+        """
+        line = log_line
+        end = len(line.rstrip())
+        agent_close = end - 1
+        if (agent_close < 0 or end > self.max_line_length or line[agent_close] != '"' or line[0].isspace()
+                or line.find('\n', 0, end) != -1):
+            return dict()
+        fields = line.split(None, 3)
+        if len(fields) < 4 or fields[3][:1] != '[':
+            return dict()
+        time_start = len(line) - len(fields[3]) + 1
+        reversed_line = line[::-1]
+
+        # "<referrer>"<whitespace>"<agent>": the rightmost closing quote of a referrer.
+        headers = _rightmost(_REVERSED_HEADERS_RE, reversed_line, agent_close)
+        if headers is None:
+            return dict()
+        agent_open, referrer_close = headers
+
+        # "<request>"<whitespace><status><whitespace><size><whitespace>"<referrer>": the rightmost request end with
+        # a status and size that leave room for the referrer.
+        status_size = _rightmost(_REVERSED_STATUS_SIZE_RE, reversed_line, referrer_close)
+        if status_size is None:
+            return dict()
+        status_size = _STATUS_SIZE_RE.match(line, status_size[1])
+        request_close = status_size.start()
+
+        # [<time>]<whitespace>"<request>": the rightmost end of a non-empty timestamp before a non-empty request.
+        request = _rightmost(_REVERSED_REQUEST_RE, reversed_line, request_close - 1)
+        if request is None or request[1] <= time_start:
+            return dict()
+        request_open, time_close = request
+
+        referrer = line[status_size.end():referrer_close]
+        agent = line[agent_open + 1:agent_close]
+        truncated = []
+        if len(referrer) > self.max_field_length:
+            referrer = referrer[:self.max_field_length]
+            truncated.append('referrer')
+        if len(agent) > self.max_field_length:
+            agent = agent[:self.max_field_length]
+            truncated.append('agent')
+        result = {'host': fields[0],
+                  'user': _dash_to_none(fields[2]),
+                  'time': line[time_start:time_close],
+                  'request': line[request_open + 1:request_close],
+                  'status': int(status_size.group(1)),
+                  'size': _size(status_size.group(2)),
+                  'referrer': _dash_to_none(referrer),
+                  'agent': agent}
+        if truncated:
+            result['truncated'] = ','.join(truncated)
+        return result
+
+
+_scanned_formats = (COMBINED_LOG_FORMAT, GUNICORN_LOG_FORMAT)
+
+
+@lru_cache(maxsize=32)
+def compile_log_format(log_format=COMBINED_LOG_FORMAT):
+    """
+    Returns a (cached) ``LogFormatParser`` for the given format string.
+
+    The Combined log format and gunicorn's default ``access_log_format`` get a ``CombinedLogScanner``, which parses
+    the same fields in linear time.
+
+    Args:
+        log_format (str, optional): Apache ``LogFormat`` or gunicorn ``access_log_format`` string.
+            Default is the Apache Combined log format.
+
+    Returns:
+        LogFormatParser: Compiled parser for the format.
+    """
+    if log_format in _scanned_formats:
+        return CombinedLogScanner(log_format)
+    return LogFormatParser(log_format)
@@ -0,0 +1,309 @@
+"""
+structlog_extensions.metrics
+
+This module aggregates access log events into periodic request/error/duration (RED) metric summaries.
+"""
+import os
+import re
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from datetime import datetime, timezone
+import structlog
+from .logformat import COMBINED_LOG_FORMAT, compile_log_format
+from .utils import _parse_request_section
+
+DEFAULT_DURATION_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+OVERFLOW_PATH = '__overflow__'
+
+_aggregators = weakref.WeakSet()
+
+_default_path_rules = (
+    (re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'), ':uuid'),
+    (re.compile(r'^[0-9]+$'), ':id'),
+    (re.compile(r'^[0-9a-fA-F]{16,}$'), ':hash'),
+)
+
+
+class PathTemplateNormalizer:
+    """
+    Turns URLs into low-cardinality path templates, for example ``/users/42/orders?page=2`` into
+    ``/users/:id/orders``.
+
+    The query string is removed and every path segment is replaced by the replacement of the first rule whose
+    regular expression matches the whole segment. The default rules replace UUIDs (``:uuid``), numbers (``:id``) and
+    long hex strings (``:hash``).
+
+    Attributes:
+        rules (list, optional): ``(regex, replacement)`` pairs applied to each path segment.
+    """
+
+    def __init__(self, rules=_default_path_rules):
+        self.rules = [(re.compile(pattern) if isinstance(pattern, str) else pattern, replacement)
+                      for pattern, replacement in rules]
+
+    def _segment(self, segment):
+        for pattern, replacement in self.rules:
+            if pattern.match(segment):
+                return replacement
+        return segment
+
+    def __call__(self, url):
+        path = url.split('?', 1)[0]
+        return '/'.join(self._segment(segment) if segment else segment for segment in path.split('/'))
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram. Histograms with the same bucket bounds can be merged exactly, for example
+    across gunicorn workers or intervals.
+
+    Attributes:
+        bounds (tuple, optional): Bucket upper bounds in milliseconds, in increasing order. A final bucket catches
+                                  everything above the last bound. Default ``DEFAULT_DURATION_BUCKETS``.
+        counts (list): Number of observations per bucket.
+        count (int): Total number of observations.
+        sum (float): Sum of all observations in milliseconds.
+    """
+
+    def __init__(self, bounds=DEFAULT_DURATION_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, milliseconds):
+        self.counts[bisect_left(self.bounds, milliseconds)] += 1
+        self.count += 1
+        self.sum += milliseconds
+
+    def merge(self, other):
+        """
+        Adds the observations of another histogram to this one.
+
+        Raises:
+            ValueError: If the histograms have different bucket bounds.
+        """
+        if other.bounds != self.bounds:
+            raise ValueError('Can only merge histograms with the same bucket bounds')
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def as_dict(self):
+        return {'bounds': list(self.bounds), 'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+
+class _Aggregate:
+    __slots__ = ('requests', 'bytes', 'histogram')
+
+    def __init__(self, bounds):
+        self.requests = 0
+        self.bytes = 0
+        self.histogram = LatencyHistogram(bounds)
+
+
+def _structlog_emitter(logger_name):
+    def emit(summary):
+        structlog.get_logger(logger_name).info('access_log_summary', **summary)
+    return emit
+
+
+class AccessLogAggregator:
+    """
+    Folds access log events into per-interval RED metric aggregates instead of rendering every line.
+
+    Events from ``target_logger`` are grouped by ``http.request.method``, path template (see
+    ``PathTemplateNormalizer``) and ``http.response.status_code``. For each key the aggregator keeps the request
+    count, total ``http.response.body.bytes`` and, when ``event.duration`` is available (see the ``log_format``
+    argument of ``CombinedLogParser``), a ``LatencyHistogram``. When an interval ends, one summary event per key is
+    passed to ``emit``. Once ``max_keys`` distinct keys are seen in an interval, further keys are folded into a
+    single overflow key with ``url.path`` set to ``OVERFLOW_PATH``.
+
+    Use it as a ``logging`` filter on the access log handler. The raw line is parsed with a light-weight parser (no
+    user agent or timestamp handling) and folded records are dropped unless ``passthrough`` is set. It can't be a
+    processor in a ``ProcessorFormatter``'s ``foreign_pre_chain``, which has no way of dropping an event.
+
+    A background thread emits the summaries when an interval ends, even when no further requests arrive. Call
+    ``flush_aggregators`` from gunicorn's ``worker_exit`` hook so the last, partial interval of a worker is emitted
+    too; ``close()`` does the same for one aggregator.
+
+    Summary events hold ``event.kind`` ('metric'), ``event.dataset``, ``event.start``, ``event.end``, the key fields,
+    ``labels.overflow`` for the overflow key and ``metrics.requests``, ``metrics.bytes`` and
+    ``metrics.duration.{bounds,counts,count,sum}`` (milliseconds).
+
+    Attributes:
+        target_logger (str, optional): Name of the access logger. Default 'gunicorn.access'.
+        interval (float, optional): Length of an aggregation interval in seconds. Default 60.
+        max_keys (int, optional): Maximum number of keys per interval. Default 1000.
+        path_normalizer (callable, optional): Function turning ``url.original`` into a path template.
+                                              Default ``PathTemplateNormalizer()``.
+        duration_buckets (tuple, optional): Histogram bucket upper bounds in milliseconds.
+        emit (callable, optional): Function called with each summary event dict. Default logs it through
+                                   ``structlog.get_logger(summary_logger)``.
+        summary_logger (str, optional): Logger name used by the default ``emit``. Default
+                                        'structlog_extensions.metrics'.
+        passthrough (bool, optional): Keep the individual events as well. Default False.
+        log_format (str, optional): Format of the raw lines. Default is the Apache Combined log format.
+        timer (bool, optional): Emit the summaries from a background thread when an interval ends. Without it they
+                                are only emitted by the first request of a later interval or by ``flush()``.
+                                Default True.
+    """
+
+    def __init__(self, target_logger='gunicorn.access', interval=60, max_keys=1000, path_normalizer=None,
+                 duration_buckets=DEFAULT_DURATION_BUCKETS, emit=None, summary_logger='structlog_extensions.metrics',
+                 passthrough=False, log_format=COMBINED_LOG_FORMAT, timer=True):
+        self.target_logger = target_logger
+        self.interval = interval
+        self.max_keys = max_keys
+        self.path_normalizer = path_normalizer or PathTemplateNormalizer()
+        self.duration_buckets = tuple(duration_buckets)
+        self.emit = emit or _structlog_emitter(summary_logger)
+        self.passthrough = passthrough
+        self.log_parser = compile_log_format(log_format)
+        self.overflowed = 0
+        self._lock = threading.Lock()
+        self._aggregates = dict()
+        self._window_start = None
+        self.timer = timer
+        self._timer_pid = None
+        self._stop = None
+        _aggregators.add(self)
+
+    def _start_timer(self):
+        # Started by the first request of every process, so forked gunicorn workers get their own thread.
+        with self._lock:
+            if self._timer_pid == os.getpid():
+                return
+            self._timer_pid = os.getpid()
+            self._stop = threading.Event()
+        thread = threading.Thread(target=self._run_timer, args=(self._stop,), name='AccessLogAggregator',
+                                  daemon=True)
+        thread.start()
+
+    def _run_timer(self, stop):
+        while not stop.wait(self._seconds_left()):
+            self._expire(time.time())
+
+    def _seconds_left(self):
+        now = time.time()
+        with self._lock:
+            if self._window_start is None:
+                return self.interval - now % self.interval
+            return max(0.0, self._window_start + self.interval - now)
+
+    def _expire(self, now):
+        with self._lock:
+            if self._window_start is None or now < self._window_start + self.interval:
+                return
+            summaries = self._drain()
+            self._window_start = None
+        self._emit(summaries)
+
+    def add(self, method, url, status, body_bytes=None, duration=None, now=None):
+        """
+        Folds one request into the current interval.
+
+        Args:
+            method (str): HTTP method
+            url (str): Original URL
+            status (int): Response status code
+            body_bytes (int, optional): Response body size
+            duration (int, optional): Request duration in nanoseconds
+            now (float, optional): Current time as a Unix timestamp. Default ``time.time()``.
+        """
+        if self.timer and self._timer_pid != os.getpid():
+            self._start_timer()
+        now = time.time() if now is None else now
+        summaries = None
+        with self._lock:
+            if self._window_start is None:
+                self._window_start = now - now % self.interval
+            elif now >= self._window_start + self.interval:
+                summaries = self._drain()
+                self._window_start = now - now % self.interval
+            key = (method, self.path_normalizer(url) if url is not None else None, status)
+            aggregate = self._aggregates.get(key)
+            if aggregate is None:
+                if len(self._aggregates) >= self.max_keys:
+                    key = (None, OVERFLOW_PATH, None)
+                    self.overflowed += 1
+                    aggregate = self._aggregates.get(key)
+                if aggregate is None:
+                    aggregate = self._aggregates[key] = _Aggregate(self.duration_buckets)
+            aggregate.requests += 1
+            aggregate.bytes += body_bytes or 0
+            if duration is not None:
+                aggregate.histogram.add(duration / 1000000.0)
+        if summaries:
+            self._emit(summaries)
+
+    def _drain(self):
+        start = self._window_start
+        summaries = []
+        for (method, path, status), aggregate in self._aggregates.items():
+            summary = {'event.kind': 'metric',
+                       'event.dataset': '{0}.summary'.format(self.target_logger),
+                       'event.start': datetime.fromtimestamp(start, timezone.utc).isoformat(),
+                       'event.end': datetime.fromtimestamp(start + self.interval, timezone.utc).isoformat(),
+                       'http.request.method': method,
+                       'url.path': path,
+                       'http.response.status_code': status,
+                       'metrics.requests': aggregate.requests,
+                       'metrics.bytes': aggregate.bytes}
+            if path == OVERFLOW_PATH:
+                summary['labels.overflow'] = True
+            if aggregate.histogram.count:
+                for name, value in aggregate.histogram.as_dict().items():
+                    summary['metrics.duration.{0}'.format(name)] = value
+            summaries.append(summary)
+        self._aggregates = dict()
+        return summaries
+
+    def _emit(self, summaries):
+        for summary in summaries:
+            self.emit(summary)
+
+    def flush(self):
+        """Emits the summaries of the current interval straight away and starts a new one."""
+        with self._lock:
+            summaries = self._drain()
+            self._window_start = None
+        self._emit(summaries)
+
+    def close(self):
+        """Stops the background thread and emits the summaries of the current interval."""
+        if self._stop is not None and self._timer_pid == os.getpid():
+            self._stop.set()
+        self._timer_pid = None
+        self.flush()
+
+    def filter(self, record):
+        """Folds a raw access log record, for use as a ``logging`` filter. Lines that don't parse are kept."""
+        if record.name != self.target_logger:
+            return True
+        fields = self.log_parser.parse(record.getMessage())
+        if 'status' not in fields:
+            return True
+        if 'request' in fields:
+            fields.update(_parse_request_section(fields['request']))
+        self.add(fields.get('method'), fields.get('url', fields.get('path')), fields['status'], fields.get('size'),
+                 fields.get('duration'))
+        return self.passthrough
+
+
+def flush_aggregators():
+    """
+    Emits the summaries of the current interval of every ``AccessLogAggregator`` in the current process.
+
+    Intended for gunicorn's ``worker_exit`` server hook, before the handlers are flushed:
+
+    .. code-block:: python
+
+        def worker_exit(server, worker):
+            structlog_extensions.metrics.flush_aggregators()
+            structlog_extensions.handlers.flush_queued_handlers()
+    """
+    for aggregator in list(_aggregators):
+        aggregator.flush()
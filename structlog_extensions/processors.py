@@ -3,8 +3,19 @@ structlog_extensions.processors
 
 This module contains processors for structlog.
 """
+import fnmatch
+import json
+import random
+import re
+import threading
+import time
 import structlog
-from .utils import convert_combined_log_to_ecs, unflatten_dict
+from .jsonstream import FlatJSONSerializer, resolve_json_backend
+from .utils import convert_combined_log_to_ecs, unflatten_dict, NestingPlanCache, _parse_user_agent_section
+from .logformat import compile_log_format, COMBINED_LOG_FORMAT
+from .useragent import IndexedUserAgentParser, UserAgentCache, UserAgentTable
+from .timestamps import CoarseClock
+from .fields import FieldProjection
 import logging
 
 
@@ -73,30 +84,122 @@ class NestedDictJSONRenderer(structlog.processors.JSONRenderer):
             }
 
     Notes:
-        In cases where a root key has a value assigned and potential subkeys exist, the behaviour of this processor
-        could be difficult to predict since it uses a deep merge that will perform overwriting in the order the keys
-        are supplied by the event_dict. To prevent this happening, use the `clean_fields` attribute to specify the
-        conflicting keys that should be removed from the event_dict prior to expansion.
+        In cases where a root key has a value assigned and potential subkeys exist, the subkeys win regardless of the
+        order of the keys in the event_dict: ``{'event': 'GET /', 'event.original': '...'}`` renders as
+        ``{"event": {"original": "..."}}``. A dict value at the root key is merged with the subkeys, with the subkeys
+        taking precedence on conflicts. To keep such a root value, rename it in an earlier processor; to drop it
+        explicitly, use the `clean_keys` attribute to specify the conflicting keys that should be removed from the
+        event_dict prior to expansion.
+
+        The nesting for each distinct set of keys is worked out once and cached (see ``utils.NestingPlanCache``).
 
     Attributes:
         separator (str, optional): Namespace separator. Default = '_'
         clean_keys (list, optional): List of keys to remove from log event prior to expansion. Intended for use when the original
                              log event has key names that might overlap with the root names of nested keys.
+        plan_cache_size (int, optional): Maximum number of distinct key sets to cache nesting plans for. Default 256.
+        streaming (bool, optional): Write the nested JSON directly from the flat keys using a per key set template
+                                    (see ``jsonstream.FlatJSONSerializer``) instead of building nested dicts first.
+                                    The output is identical; events with conflicting keys are rendered the regular
+                                    way. Only available with the default ``json.dumps`` serializer and no dumps
+                                    arguments other than ``default`` and ``ensure_ascii``. Default False.
+        backend (str, optional): JSON backend to use instead of an explicit ``serializer``: ``'auto'`` (orjson when
+                                 installed, otherwise json), ``'orjson'`` or ``'json'``. See
+                                 ``jsonstream.resolve_json_backend``. Default None (use ``serializer``).
+        as_bytes (bool, optional): Return UTF-8 encoded ``bytes`` instead of ``str``, for use with
+                                   ``structlog.BytesLoggerFactory``. Default False.
+        static_fields (dict, optional): Flat fields added to every event, for values that never change in the process
+                                        such as ``service.name``, ``service.version`` or ``host.hostname``. The
+                                        output is equivalent JSON to that of events containing these fields (whose
+                                        own fields take precedence on equal keys), but every top level object of
+                                        them is nested and serialized once, when the renderer is created, and the
+                                        rendered text is spliced into each line. Objects that an event also has
+                                        fields in (for example a static ``event.dataset`` and the event's
+                                        ``event.original``) are merged with those and rendered per event. The key
+                                        order may differ: the spliced objects come first, followed by the rendered
+                                        event. Can't be used with the ``indent`` and ``sort_keys`` dumps arguments.
+                                        Default None.
     """
 
-    def __init__(self, *args, clean_keys=None, separator='_', **kwargs):
+    def __init__(self, *args, clean_keys=None, separator='_', plan_cache_size=256, streaming=False, backend=None,
+                 as_bytes=False, static_fields=None, **kwargs):
         self.clean_fields = clean_keys
         self.separator = separator
+        self.plan_cache = NestingPlanCache(separator, maxsize=plan_cache_size)
+        self.as_bytes = as_bytes
+        self.backend = None
+        if backend is not None:
+            if args or 'serializer' in kwargs:
+                raise ValueError('backend and serializer can not be used together')
+            self.backend, kwargs['serializer'] = resolve_json_backend(backend)
         super().__init__(*args, **kwargs)
+        self.streaming_serializer = None
+        if streaming:
+            if self._dumps is not json.dumps or not set(self._dumps_kw) <= {'default', 'ensure_ascii'}:
+                raise ValueError('streaming requires the json.dumps serializer without formatting arguments')
+            self.streaming_serializer = FlatJSONSerializer(separator, maxsize=plan_cache_size,
+                                                           default=self._dumps_kw['default'],
+                                                           ensure_ascii=self._dumps_kw.get('ensure_ascii', True))
+        self.static_fields = None
+        if static_fields:
+            if self._dumps_kw.get('indent') is not None or self._dumps_kw.get('sort_keys'):
+                raise ValueError('static_fields can not be used with the indent or sort_keys arguments')
+            self.static_fields = dict(static_fields)
+            self._static_roots = dict()
+            for key, value in self.static_fields.items():
+                self._static_roots.setdefault(key.split(separator, 1)[0], []).append((key, value))
+            self._static_fragments = {root: self._dumps({root: nested}, **self._dumps_kw)[1:-1]
+                                      for root, nested in unflatten_dict(self.static_fields, separator).items()}
+            one = self._dumps({'a': 0}, **self._dumps_kw)
+            two = self._dumps({'a': 0, 'b': 0}, **self._dumps_kw)
+            self._item_separator = two[len(one) - 1:two.index('"b"' if isinstance(two, str) else b'"b"')]
+            self._static_splices = dict()
+            self._static_splices_size = plan_cache_size
+
+    def _static_splice(self, keys):
+        """
+        Works out and caches the static fields that have to be rendered with an event with the given keys (those
+        sharing a top level object with it) and the pre-rendered text of the others.
+        """
+        separator = self.separator
+        event_roots = {key.split(separator, 1)[0] for key in keys}
+        shared = [item for root, items in self._static_roots.items() if root in event_roots for item in items]
+        fragments = [fragment for root, fragment in self._static_fragments.items() if root not in event_roots]
+        splice = (dict(shared), self._item_separator.join(fragments) if fragments else None)
+        if len(self._static_splices) >= self._static_splices_size:
+            self._static_splices.pop(next(iter(self._static_splices)), None)
+        self._static_splices[keys] = splice
+        return splice
+
+    def _spliced(self, rendered, fragment):
+        if fragment is None:
+            return rendered
+        if len(rendered) == 2:
+            return rendered[:1] + fragment + rendered[1:]
+        return rendered[:1] + fragment + self._item_separator + rendered[1:]
 
     def __call__(self, logger, name, event_dict):
         if self.clean_fields:
             for field in self.clean_fields:
                 event_dict.pop(field, None)
+        fragment = None
+        if self.static_fields is not None:
+            splice = self._static_splices.get(tuple(event_dict))
+            shared, fragment = splice if splice is not None else self._static_splice(tuple(event_dict))
+            if shared:
+                event_dict = {**shared, **event_dict}
+        if self.streaming_serializer is not None:
+            rendered = self.streaming_serializer(event_dict)
+            if rendered is not None:
+                rendered = self._spliced(rendered, fragment)
+                return rendered.encode('utf-8') if self.as_bytes else rendered
         try:
-            nested_dict = unflatten_dict(event_dict, self.separator)
+            nested_dict = self.plan_cache.unflatten(event_dict)
         finally:
-            return super().__call__(logger,name,nested_dict)
+            rendered = self._spliced(super().__call__(logger,name,nested_dict), fragment)
+            if isinstance(rendered, bytes) != self.as_bytes:
+                rendered = rendered.encode('utf-8') if self.as_bytes else rendered.decode('utf-8')
+            return rendered
 
 
 class CombinedLogParser:
@@ -106,6 +209,29 @@ class CombinedLogParser:
 
     Attributes:
         target_logger (str): Name of the logger object that is logging combined log output.
+        log_format (str, optional): Apache ``LogFormat`` or gunicorn ``access_log_format`` string describing the
+                                    log lines. Default is the Apache Combined log format. The format is compiled
+                                    once when the processor is created.
+        ua_cache_size (int, optional): Number of distinct user agent strings to keep parsed results for. Default 1024.
+                                       Set to 0 to disable caching.
+        ua_cache (UserAgentCache): The user agent cache, or None when caching is disabled. Use
+                                   ``ua_cache.stats()`` to read the hit, miss and eviction counters.
+        ua_table (str, optional): Path of a precomputed ``useragent.UserAgentTable`` file (see
+                                  ``python -m structlog_extensions build-ua-table``). The table is memory mapped, so
+                                  all workers share one copy; user agents missing from it are parsed as usual.
+        indexed_ua_parser (bool, optional): Parse user agents missing from the cache and table with a
+                                            ``useragent.IndexedUserAgentParser``, which only runs the ua-parser
+                                            regexes whose literal text occurs in the string. Default False.
+        coarse_clock_tick (float, optional): When set, ``event.created`` is rendered at most once per this many
+                                             seconds instead of for every line.
+        fields (list, optional): ECS fields (or namespaces, such as ``'user_agent'``) to add to the event. Parsing
+                                 stages that only produce unselected fields are skipped, for example no user agent
+                                 parsing without any ``user_agent.*`` field. Default None (all fields).
+        exclude_fields (list, optional): ECS fields or namespaces to leave out. Default None.
+        lazy (bool, optional): Add the ``user_agent.*`` fields as ``fields.LazyField`` placeholders that are only
+                               parsed when the renderer reads them, so events dropped by a later processor never pay
+                               for user agent parsing. Use ``fields.resolve_lazy_fields`` before processors that need
+                               the plain values. Default False.
 
     Example:
         Creating and using a parser instance with structlog:
@@ -140,8 +266,26 @@ class CombinedLogParser:
             logger.warning(
                 '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 "http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"')
     """
-    def __init__(self, target_logger):
+    def __init__(self, target_logger, log_format=COMBINED_LOG_FORMAT, ua_cache_size=1024, ua_table=None,
+                 indexed_ua_parser=False, coarse_clock_tick=None, fields=None, exclude_fields=None, lazy=False):
         self.target_logger = target_logger
+        self.log_format = log_format
+        self.log_parser = compile_log_format(log_format)
+        self._user_agent_parser = IndexedUserAgentParser() if indexed_ua_parser else _parse_user_agent_section
+        self.ua_table = UserAgentTable(ua_table, fallback=self._user_agent_parser) if ua_table else None
+        if self.ua_table is not None:
+            self._user_agent_parser = self.ua_table
+        if ua_cache_size:
+            self.ua_cache = UserAgentCache(ua_cache_size, parser=self._user_agent_parser)
+            self._user_agent_parser = self.ua_cache
+        else:
+            self.ua_cache = None
+        self.clock = CoarseClock(coarse_clock_tick) if coarse_clock_tick else None
+        if fields is None and not exclude_fields:
+            self.projection = None
+        else:
+            self.projection = FieldProjection(fields, exclude_fields)
+        self.lazy = lazy
 
     def __call__(self, logger, method_name, event_dict):
         try:
@@ -157,10 +301,231 @@ class CombinedLogParser:
                     severity = 0
                 original_event = event_dict['event']
                 ecs_fields = convert_combined_log_to_ecs(log_line=original_event, dataset=logger_name,
-                                                         severity=severity)
+                                                         severity=severity, parser=self.log_parser,
+                                                         user_agent_parser=self._user_agent_parser,
+                                                         clock=self.clock, projection=self.projection,
+                                                         lazy=self.lazy)
                 event_dict.update(ecs_fields)
         finally:
             return event_dict
 
 
+_request_status_re = re.compile(r'"\S+ (\S+)[^"]*" ([0-9]{3}) ')
+_status_class_re = re.compile(r'[1-5]xx\Z')
+
+
+class SamplingRule:
+    """
+    Rule deciding which share of matching access log events an ``AccessLogSampler`` keeps.
+
+    A rule matches an event when all of its conditions match; a rule without conditions matches every event.
+
+    Attributes:
+        rate (float, optional): Probability of keeping a matching event, from 0 (drop all) to 1 (keep all).
+                                Default 1.
+        status (int, str or list, optional): Response status code(s) to match. Strings of the form ``'5xx'`` match
+                                             a whole class; other strings raise ValueError. Default None (any
+                                             status).
+        path (str or list, optional): Glob pattern(s) the URL path (without query string) must match, for example
+                                      ``'/static/*'``. Default None (any path).
+        pattern (str, optional): Regular expression searched for in the raw log line. Default None.
+        rate_limit (float, optional): Maximum number of kept events per second, enforced with a token bucket. Events
+                                      it keeps are tagged with the share of sampled events that got a token over
+                                      the last one to two seconds. Default None (unlimited).
+        burst (int, optional): Token bucket size. Default ``rate_limit`` (one second worth of events).
+        name (str, optional): Name of the rule in ``AccessLogSampler.stats()``. Default is a description of the
+                              conditions. Rules with the same name are still counted separately.
+    """
+
+    def __init__(self, rate=1.0, status=None, path=None, pattern=None, rate_limit=None, burst=None, name=None):
+        if not 0 <= rate <= 1:
+            raise ValueError('rate must be between 0 and 1')
+        self.rate = rate
+        self.status = status
+        self.path = path
+        self.pattern = pattern
+        self.rate_limit = rate_limit
+        self.burst = burst if burst is not None else rate_limit
+        self.name = name or ' '.join('{0}={1}'.format(key, value) for key, value in
+                                     (('status', status), ('path', path), ('pattern', pattern))
+                                     if value is not None) or 'default'
+        statuses = [] if status is None else [status] if isinstance(status, (int, str)) else list(status)
+        self._statuses = frozenset(code for code in statuses if isinstance(code, int))
+        for code in statuses:
+            if isinstance(code, str) and _status_class_re.match(code) is None:
+                raise ValueError("status strings must name a status class such as '5xx', not {0!r}".format(code))
+        self._status_classes = frozenset(int(code[0]) for code in statuses if isinstance(code, str))
+        paths = [] if path is None else [path] if isinstance(path, str) else list(path)
+        self._path_re = re.compile('|'.join(fnmatch.translate(glob) for glob in paths)) if paths else None
+        self._pattern_re = re.compile(pattern) if pattern is not None else None
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        # Token requests and grants in the current and the previous second, for the rate limited keep ratio.
+        self._window_start = self._refilled
+        self._window = [0, 0]
+        self._previous_window = [0, 0]
+
+    def matches(self, log_line, status, path):
+        if self.status is not None:
+            if status is None or (status not in self._statuses and status // 100 not in self._status_classes):
+                return False
+        if self._path_re is not None and (path is None or self._path_re.match(path) is None):
+            return False
+        if self._pattern_re is not None and (log_line is None or self._pattern_re.search(log_line) is None):
+            return False
+        return True
+
+    def take_token(self):
+        if self.rate_limit is None:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate_limit)
+        self._refilled = now
+        if now - self._window_start >= 1:
+            self._previous_window = self._window if now - self._window_start < 2 else [0, 0]
+            self._window = [0, 0]
+            self._window_start = now
+        self._window[0] += 1
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        self._window[1] += 1
+        return True
+
+    def limit_ratio(self):
+        """Share of the recently sampled events that got a token, 1 without a rate limit."""
+        if self.rate_limit is None:
+            return 1.0
+        requested = self._window[0] + self._previous_window[0]
+        return (self._window[1] + self._previous_window[1]) / requested if requested else 1.0
+
+
+class AccessLogSampler:
+    """
+    Samples and rate limits high-volume access log events before they are fully parsed and rendered.
+
+    The first matching ``SamplingRule`` decides whether an event from ``target_logger`` is kept; events matching no
+    rule are kept with ``default_rate``. Kept events with an effective keep rate below 1 get a ``sample_rate_field``
+    so downstream counts can be reweighted (each kept event stands for ``1 / rate`` events). The effective rate is
+    the rule's ``rate`` times the share of events its ``rate_limit`` let through recently. Events dropped by a rate
+    limit are counted in ``stats()``.
+
+    Status and path are taken from the ECS fields when ``CombinedLogParser`` has already run, otherwise they are
+    picked out of the raw log line with a single cheap regex, so placing the sampler before the parser saves the
+    full parse of every dropped line.
+
+    The sampler works both as a structlog processor (dropped events raise ``structlog.DropEvent``) and as a
+    ``logging`` filter. Use it as a filter on the handler when access logs go through a ``ProcessorFormatter``, since
+    its ``foreign_pre_chain`` can't drop events; the decision is stored on the record, and a sampler in the
+    ``foreign_pre_chain`` then only adds the sample rate field.
+
+    Attributes:
+        rules (list): ``SamplingRule`` objects, tried in order.
+        target_logger (str, optional): Name of the access logger. Default 'gunicorn.access'.
+        default_rate (float, optional): Keep rate for events matching no rule. Default 1.
+        sample_rate_field (str, optional): Name of the field holding the keep rate. Default 'event.sample_rate'.
+        seed (int, optional): Seed for the random sampling decisions.
 
+    Example:
+        .. code-block:: python
+
+            sampler = AccessLogSampler([SamplingRule(status='5xx'),
+                                        SamplingRule(rate=0, path='/healthz'),
+                                        SamplingRule(rate=0.01, status='2xx', rate_limit=100)])
+
+            pre_chain = [
+                structlog.stdlib.add_log_level,
+                structlog.stdlib.add_logger_name,
+                sampler,
+                structlog_extensions.processors.CombinedLogParser("gunicorn.access"),
+            ]
+            handler.addFilter(sampler)
+    """
+    _record_attribute = 'structlog_extensions_sample_rate'
+
+    def __init__(self, rules, target_logger='gunicorn.access', default_rate=1.0, sample_rate_field='event.sample_rate',
+                 seed=None):
+        self.rules = list(rules)
+        self.target_logger = target_logger
+        self.default_rule = SamplingRule(rate=default_rate, name='default')
+        self.sample_rate_field = sample_rate_field
+        self._random = random.Random(seed).random
+        self._lock = threading.Lock()
+        rules = self.rules + [self.default_rule]
+        # Counters are kept per rule; rules that share a name are told apart by their position in stats().
+        names = [rule.name for rule in rules]
+        self._names = [name if names.count(name) == 1 else '{0} #{1}'.format(name, position)
+                       for position, name in enumerate(names, 1)]
+        self._counters = [{'matched': 0, 'kept': 0, 'sampled_out': 0, 'rate_limited': 0} for _ in rules]
+
+    def decide(self, log_line, status=None, path=None):
+        """
+        Decides whether to keep an access log event.
+
+        Args:
+            log_line (str): The raw log line (may be None when ``status`` and ``path`` are given).
+            status (int, optional): Response status code, extracted from the log line if not given.
+            path (str, optional): URL path or original URL, extracted from the log line if not given.
+
+        Returns:
+            float: The effective keep rate of the matching rule, or None if the event should be dropped.
+        """
+        if (status is None or path is None) and log_line is not None:
+            match = _request_status_re.search(log_line)
+            if match is not None:
+                path = match.group(1) if path is None else path
+                status = int(match.group(2)) if status is None else status
+        if path is not None:
+            path = path.split('?', 1)[0]
+        position, rule = next(((position, rule) for position, rule in enumerate(self.rules)
+                               if rule.matches(log_line, status, path)), (len(self.rules), self.default_rule))
+        with self._lock:
+            counters = self._counters[position]
+            counters['matched'] += 1
+            if rule.rate < 1 and (rule.rate == 0 or self._random() >= rule.rate):
+                counters['sampled_out'] += 1
+                return None
+            if not rule.take_token():
+                counters['rate_limited'] += 1
+                return None
+            counters['kept'] += 1
+            return rule.rate * rule.limit_ratio()
+
+    def filter(self, record):
+        if record.name != self.target_logger:
+            return True
+        rate = self.decide(record.getMessage())
+        if rate is None:
+            return False
+        setattr(record, self._record_attribute, rate)
+        return True
+
+    def __call__(self, logger, method_name, event_dict):
+        record = event_dict.get("_record")
+        if record is None:
+            logger_name = logger.name
+        else:
+            logger_name = record.name
+        if logger_name != self.target_logger:
+            return event_dict
+        rate = getattr(record, self._record_attribute, None)
+        if rate is None:
+            event = event_dict.get('event')
+            rate = self.decide(event if isinstance(event, str) else None,
+                               event_dict.get('http.response.status_code'), event_dict.get('url.original'))
+            if rate is None:
+                raise structlog.DropEvent
+        if rate < 1:
+            event_dict[self.sample_rate_field] = rate
+        return event_dict
+
+    def stats(self):
+        """
+        Returns the per rule counters.
+
+        Returns:
+            dict: Rule name to ``matched``, ``kept``, ``sampled_out`` and ``rate_limited`` event counts. Rules with
+                  the same name are listed as ``'<name> #<position>'``, counting from 1 with the default rule last.
+        """
+        with self._lock:
+            return {name: dict(counters) for name, counters in zip(self._names, self._counters)}
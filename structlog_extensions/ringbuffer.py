@@ -0,0 +1,392 @@
+"""
+structlog_extensions.ringbuffer
+
+This module contains a shared memory transport that lets gunicorn workers hand rendered log lines to a single
+collector instead of all writing to the same stream. It is not imported by ``structlog_extensions`` itself, so
+importing the package doesn't load ``multiprocessing.shared_memory``.
+"""
+import logging
+import os
+import struct
+import sys
+import threading
+import traceback
+import zlib
+from multiprocessing import shared_memory
+
+_MAGIC = b'SXRB'
+_VERSION = 2
+_HEADER = struct.Struct('<4sIII')
+_HEADER_SIZE = 64
+_SLOT_HEADER_SIZE = 64
+_POSITION = struct.Struct('<Q')
+_HEAD, _TAIL, _WRITTEN, _DROPPED = 0, 8, 16, 24
+_RECORD = struct.Struct('<II')
+_WRAP = 0xFFFFFFFF
+
+# Ring slot of the current worker process, set by RingBufferCollector.post_fork.
+_writer = None
+# Names of the segments created by this process.
+_created = set()
+
+
+def _checksum(position, data=b''):
+    return (zlib.crc32(data) ^ position) & 0xFFFFFFFF
+
+
+def _attach_segment(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:  # pragma: no cover - Python < 3.13
+        from multiprocessing import resource_tracker
+        segment = shared_memory.SharedMemory(name)
+        # Only the creator may unlink the segment, not every process that attaches to it.
+        if segment.name not in _created:
+            resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class _Slot:
+    """
+    One single producer, single consumer byte ring in the shared memory segment.
+
+    The slot header holds the producer's ``head`` and the consumer's ``tail`` as ever increasing byte positions, so
+    the producer only writes ``head`` and the counters and the consumer only writes ``tail``. Records are a 32 bit
+    length and a 32 bit checksum followed by the data; a record that doesn't fit before the end of the ring is
+    preceded by a wrap marker (or, with fewer than 8 bytes left, by nothing) and written at the start.
+
+    Python has no memory barriers, so on weakly ordered CPUs (ARM) the consumer can see a new ``head`` before the
+    record it publishes. The checksum covers the record's absolute position and data: a record (or wrap marker)
+    that isn't fully visible yet, or is left over from an earlier lap, fails the check, and the consumer stops there
+    and reads it on the next pass.
+    """
+    __slots__ = ('buffer', 'offset', 'data', 'capacity', 'pid', 'lock')
+
+    def __init__(self, buffer, offset, size):
+        self.buffer = buffer
+        self.offset = offset
+        self.data = offset + _SLOT_HEADER_SIZE
+        self.capacity = size - _SLOT_HEADER_SIZE
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def _get(self, field):
+        return _POSITION.unpack_from(self.buffer, self.offset + field)[0]
+
+    def _set(self, field, value):
+        _POSITION.pack_into(self.buffer, self.offset + field, value)
+
+    def write(self, data):
+        """Appends a record. Returns False (and counts it as dropped) when the ring doesn't have room."""
+        capacity = self.capacity
+        head = self._get(_HEAD)
+        size = _RECORD.size + len(data)
+        position = head % capacity
+        skip = capacity - position if capacity - position < size else 0
+        if skip + size > capacity - (head - self._get(_TAIL)):
+            self._set(_DROPPED, self._get(_DROPPED) + 1)
+            return False
+        if skip:
+            if skip >= _RECORD.size:
+                _RECORD.pack_into(self.buffer, self.data + position, _WRAP, _checksum(head))
+            head += skip
+            position = 0
+        start = self.data + position
+        self.buffer[start + _RECORD.size:start + size] = data
+        _RECORD.pack_into(self.buffer, start, len(data), _checksum(head, data))
+        self._set(_WRITTEN, self._get(_WRITTEN) + 1)
+        # Publish the record only after it is complete.
+        self._set(_HEAD, head + size)
+        return True
+
+    def read(self, chunks):
+        """Appends the data of all complete records to ``chunks`` and frees their space. Returns the record count."""
+        capacity = self.capacity
+        head = self._get(_HEAD)
+        tail = self._get(_TAIL)
+        buffer = self.buffer
+        count = 0
+        while tail < head:
+            position = tail % capacity
+            remaining = capacity - position
+            if remaining < _RECORD.size:
+                tail += remaining
+                continue
+            start = self.data + position
+            length, checksum = _RECORD.unpack_from(buffer, start)
+            if length == _WRAP:
+                if checksum != _checksum(tail):
+                    break
+                tail += remaining
+                continue
+            if length > min(remaining, head - tail) - _RECORD.size:
+                break
+            data = bytes(buffer[start + _RECORD.size:start + _RECORD.size + length])
+            if checksum != _checksum(tail, data):
+                break
+            chunks.append(data)
+            tail += _RECORD.size + length
+            count += 1
+        self._set(_TAIL, tail)
+        return count
+
+    def stats(self):
+        head = self._get(_HEAD)
+        return {'written': self._get(_WRITTEN),
+                'dropped': self._get(_DROPPED),
+                'buffered_bytes': head - self._get(_TAIL)}
+
+
+class RingBufferCollector:
+    """
+    Collects the log lines gunicorn workers write into per-worker shared memory rings and writes them to one stream.
+
+    When many workers write JSON lines to the same stderr pipe, lines longer than ``PIPE_BUF`` can interleave and the
+    workers contend on the write calls. With this collector every worker writes its rendered lines (through a
+    ``RingBufferHandler``) into its own ring slot in a shared memory segment, without a system call or a lock shared
+    with other workers. A background thread in the master drains all slots every ``interval`` seconds and writes the
+    lines with one large write per pass.
+
+    Slots are handed out by the gunicorn server hooks: ``pre_fork`` reserves a free slot for the new worker,
+    ``post_fork`` attaches the worker to it and ``child_exit`` collects what the worker left in it (lines logged up
+    to a graceful exit are never lost) before the slot is reused. Workers that don't get a slot, because all
+    ``slots`` are in use, and the master itself write to the handler's stream as usual. A ring that is full drops
+    new lines; the counts are returned by ``stats()``.
+
+    The collector can also run in a separate process: create it with ``sidecar=True`` in the master, where it then
+    only hands out slots, and run ``RingBufferCollector.attach(name).run()`` in the sidecar.
+
+    Attributes:
+        slots (int, optional): Number of ring slots, at least the number of workers. Default 64.
+        slot_size (int, optional): Size of a ring slot in bytes. Default 1 MiB.
+        stream (file, optional): Stream the lines are written to. Default ``sys.stderr``.
+        interval (float, optional): Seconds between collection passes. Default 0.05.
+        name (str, optional): Name of the shared memory segment. Default None (generated).
+        sidecar (bool, optional): Leave collecting to another process. Default False.
+
+    Example:
+        ``gunicorn.conf.py``
+
+        .. code-block:: python
+
+            collector = structlog_extensions.ringbuffer.RingBufferCollector(slots=2 * workers)
+            on_starting = collector.on_starting
+            pre_fork = collector.pre_fork
+            post_fork = collector.post_fork
+            child_exit = collector.child_exit
+            on_exit = collector.on_exit
+
+            logconfig_dict = {
+                "handlers": {
+                    "console": {
+                        "class": "structlog_extensions.ringbuffer.RingBufferHandler",
+                        "formatter": "json_formatter",
+                    }
+                },
+                ...
+            }
+    """
+
+    def __init__(self, slots=64, slot_size=1024 * 1024, stream=None, interval=0.05, name=None, sidecar=False):
+        if slots < 1 or slot_size < _SLOT_HEADER_SIZE + 256:
+            raise ValueError('slots must be at least 1 and slot_size at least {0}'.format(_SLOT_HEADER_SIZE + 256))
+        # New segments are zero filled, which is an empty ring for every slot.
+        segment = shared_memory.SharedMemory(name, create=True, size=_HEADER_SIZE + slots * slot_size)
+        _HEADER.pack_into(segment.buf, 0, _MAGIC, _VERSION, slots, slot_size)
+        _created.add(segment.name)
+        self._open(segment, stream, interval, sidecar)
+        self._owner = os.getpid()
+
+    def _open(self, segment, stream, interval, sidecar):
+        _, _, self.slots, self.slot_size = _HEADER.unpack_from(segment.buf, 0)
+        self._segment = segment
+        self.name = segment.name
+        self.stream = stream
+        self.interval = interval
+        self.sidecar = sidecar
+        self._owner = None
+        self._rings = [_Slot(segment.buf, _HEADER_SIZE + slot * self.slot_size, self.slot_size)
+                       for slot in range(self.slots)]
+        self._free = list(range(self.slots))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.collected = 0
+        self.writes = 0
+        self.unassigned = 0
+
+    @classmethod
+    def attach(cls, name, stream=None, interval=0.05):
+        """
+        Attaches to the segment of a collector created in another process, to collect from it there.
+
+        Args:
+            name (str): Name of the shared memory segment (the creating collector's ``name``).
+            stream (file, optional): Stream the lines are written to. Default ``sys.stderr``.
+            interval (float, optional): Seconds between collection passes. Default 0.05.
+
+        Returns:
+            RingBufferCollector: A collector that doesn't hand out slots.
+
+        Raises:
+            ValueError: If the segment isn't a ring buffer segment.
+        """
+        segment = _attach_segment(name)
+        magic, version = _HEADER.unpack_from(segment.buf, 0)[:2]
+        if magic != _MAGIC or version != _VERSION:
+            segment.close()
+            raise ValueError('{0} is not a ring buffer segment'.format(name))
+        collector = cls.__new__(cls)
+        collector._open(segment, stream, interval, sidecar=False)
+        return collector
+
+    def collect(self):
+        """
+        Drains all slots and writes their lines to the stream with a single write.
+
+        Returns:
+            int: Number of lines written.
+        """
+        with self._lock:
+            chunks = []
+            count = 0
+            for ring in self._rings:
+                count += ring.read(chunks)
+            if chunks:
+                stream = self.stream or sys.stderr
+                stream.flush()
+                getattr(stream, 'buffer', stream).write(b''.join(chunks))
+                stream.flush()
+                self.collected += count
+                self.writes += 1
+            return count
+
+    def run(self):
+        """Collects every ``interval`` seconds until ``stop()`` is called, then collects once more."""
+        while not self._stop.wait(self.interval):
+            self._collect_safely()
+        self._collect_safely()
+
+    def _collect_safely(self):
+        try:
+            self.collect()
+        except Exception:
+            if logging.raiseExceptions:
+                traceback.print_exc()
+
+    def start(self):
+        """Starts collecting on a background thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the background thread after a last collection pass."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """
+        Stops collecting, collects the remaining lines (unless a sidecar collects) and releases the segment. The
+        process that created the segment also removes it.
+        """
+        self.stop()
+        if not self.sidecar:
+            self.collect()
+        self._rings = []
+        self._segment.close()
+        if self._owner == os.getpid():
+            self._segment.unlink()
+            _created.discard(self.name)
+
+    def on_starting(self, server):
+        """gunicorn ``on_starting`` hook: starts collecting in the master, unless a sidecar collects."""
+        if not self.sidecar:
+            self.start()
+
+    def pre_fork(self, server, worker):
+        """gunicorn ``pre_fork`` hook: reserves a slot for the worker about to be forked."""
+        with self._lock:
+            worker.ring_slot = self._free.pop(0) if self._free else None
+            if worker.ring_slot is None:
+                self.unassigned += 1
+
+    def post_fork(self, server, worker):
+        """gunicorn ``post_fork`` hook: makes the worker's ``RingBufferHandler`` write into its slot."""
+        global _writer
+        slot = getattr(worker, 'ring_slot', None)
+        _writer = None if slot is None else self._rings[slot]
+        if _writer is not None:
+            _writer.pid = os.getpid()
+            _writer.lock = threading.Lock()
+        # The collector thread of the master isn't running in the worker.
+        self._thread = None
+
+    def child_exit(self, server, worker):
+        """gunicorn ``child_exit`` hook: collects the lines the worker left behind and frees its slot."""
+        if not self.sidecar:
+            self.collect()
+        slot = getattr(worker, 'ring_slot', None)
+        if slot is not None:
+            with self._lock:
+                self._free.append(slot)
+
+    def on_exit(self, server):
+        """gunicorn ``on_exit`` hook: collects the remaining lines and removes the segment."""
+        self.close()
+
+    def stats(self):
+        """
+        Returns the collector counters.
+
+        Returns:
+            dict: ``slots`` and ``assigned`` slots, lines ``written`` to and ``dropped`` by full rings,
+            ``buffered_bytes`` waiting to be collected, ``collected`` lines, stream ``writes`` and ``unassigned``
+            workers that got no slot.
+        """
+        totals = {'written': 0, 'dropped': 0, 'buffered_bytes': 0}
+        for ring in self._rings:
+            for key, value in ring.stats().items():
+                totals[key] += value
+        totals.update(slots=self.slots, assigned=self.slots - len(self._free), collected=self.collected,
+                      writes=self.writes, unassigned=self.unassigned)
+        return totals
+
+
+class RingBufferHandler(logging.StreamHandler):
+    """
+    Handler that writes formatted records into the worker's ``RingBufferCollector`` slot.
+
+    Records are formatted in the worker (for example by a ``ProcessorFormatter`` with a ``NestedDictJSONRenderer``)
+    and copied into shared memory; the collector writes them out. In processes without a slot (the gunicorn master,
+    or workers started when all slots were taken) records are written to ``stream`` like a ``logging.StreamHandler``.
+
+    Attributes:
+        stream (file, optional): Stream used without a slot. Default ``sys.stderr``.
+        dropped (int): Number of records dropped in this process because its ring was full.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.dropped = 0
+
+    def emit(self, record):
+        writer = _writer
+        if writer is None or writer.pid != os.getpid():
+            super().emit(record)
+            return
+        try:
+            message = self.format(record)
+            if isinstance(message, str):
+                data = (message + self.terminator).encode('utf-8')
+            else:
+                data = message + self.terminator.encode('utf-8')
+            with writer.lock:
+                written = writer.write(data)
+            if not written:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,117 @@
+"""
+structlog_extensions.timestamps
+
+This module contains cached conversions of access log timestamps into ISO 8601 strings.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+_months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+_tzinfos = dict()
+
+
+def offset_tzinfo(offset):
+    """
+    Returns a (cached) fixed offset tzinfo for an access log timezone offset.
+
+    Args:
+        offset (str): Offset formatted as ``+HHMM`` or ``-HHMM``
+
+    Returns:
+        datetime.tzinfo: ``pytz.FixedOffset`` for the offset.
+    """
+    tzinfo = _tzinfos.get(offset)
+    if tzinfo is None:
+        # Imported on first use to keep importing the package cheap.
+        import pytz
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        tzinfo = _tzinfos[offset] = pytz.FixedOffset(-minutes if offset[0] == '-' else minutes)
+    return tzinfo
+
+
+def parse_combined_timestamp(timestamp):
+    """
+    Parses an access log timestamp formatted as ``day/month/year:hour:minute:second zone``.
+
+    The fixed width Apache layout (``10/Oct/2000:13:55:36 -0700``) is sliced directly, anything else falls back
+    to ``datetime.strptime``.
+
+    Args:
+        timestamp (str): Access log timestamp
+
+    Returns:
+        datetime.datetime: Timezone aware datetime.
+
+    Raises:
+        ValueError: If the timestamp can't be parsed.
+    """
+    if (len(timestamp) == 26 and timestamp[2] == '/' and timestamp[6] == '/' and timestamp[11] == ':'
+            and timestamp[20] == ' '):
+        month = _months.get(timestamp[3:6])
+        if month is not None:
+            return datetime(int(timestamp[7:11]), month, int(timestamp[0:2]), int(timestamp[12:14]),
+                            int(timestamp[15:17]), int(timestamp[18:20]), tzinfo=offset_tzinfo(timestamp[21:]))
+    dt = datetime.strptime(timestamp[0:-6], '%d/%b/%Y:%H:%M:%S')
+    return dt.replace(tzinfo=offset_tzinfo(timestamp[-5:]))
+
+
+class TimestampCache:
+    """
+    Cache of rendered ISO 8601 strings per distinct access log timestamp.
+
+    Access log timestamps have a resolution of one second, so under load thousands of consecutive lines share the
+    same value. The cache is simply emptied when it reaches ``maxsize``; because timestamps arrive roughly in
+    order, old entries are of no further use anyway.
+
+    Attributes:
+        maxsize (int): Maximum number of timestamps to keep rendered strings for.
+        hits (int): Number of timestamps answered from the cache.
+        misses (int): Number of timestamps parsed and rendered.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._rendered = dict()
+
+    def __call__(self, timestamp):
+        iso_timestamp = self._rendered.get(timestamp)
+        if iso_timestamp is None:
+            self.misses += 1
+            iso_timestamp = parse_combined_timestamp(timestamp).isoformat()
+            if len(self._rendered) >= self.maxsize:
+                self._rendered.clear()
+            self._rendered[timestamp] = iso_timestamp
+        else:
+            self.hits += 1
+        return iso_timestamp
+
+
+class CoarseClock:
+    """
+    Clock returning the current UTC time as an ISO 8601 string, reformatted at most once per ``tick`` seconds.
+
+    Useful for ``event.created``, where a resolution of a few milliseconds is plenty and formatting the current
+    time for every event is measurable overhead.
+
+    Attributes:
+        tick (float, optional): Seconds a rendered time string is reused for. Default 0.001.
+    """
+
+    def __init__(self, tick=0.001):
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._expires = 0.0
+        self._rendered = None
+
+    def __call__(self):
+        now = time.time()
+        if now >= self._expires:
+            with self._lock:
+                if now >= self._expires:
+                    self._rendered = datetime.fromtimestamp(now, timezone.utc).isoformat()
+                    self._expires = now + self.tick
+        return self._rendered
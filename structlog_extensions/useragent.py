@@ -0,0 +1,462 @@
+"""
+structlog_extensions.useragent
+
+This module contains helpers that speed up resolving user agent strings into ECS ``user_agent.*`` fields.
+"""
+import gzip
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+from collections import Counter, OrderedDict
+from .logformat import COMBINED_LOG_FORMAT, compile_log_format
+from .utils import _parse_user_agent_section, _user_agent_fields, _user_agent_section
+
+try:
+    from re import _constants as _sre, _parser as _sre_parse
+except ImportError:  # pragma: no cover - Python < 3.11
+    import sre_constants as _sre
+    import sre_parse as _sre_parse
+
+_TABLE_MAGIC = b'SXUA'
+_TABLE_VERSION = 1
+_TABLE_HEADER = struct.Struct('<4sII4x')
+_TABLE_HASH = struct.Struct('<Q')
+_TABLE_ENTRY = struct.Struct('<II')
+_TABLE_FIELDS = _user_agent_fields
+_FIELD_SEPARATOR = '\x00'
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7f]')
+
+
+class UserAgentCache:
+    """
+    Thread-safe, size-bounded LRU cache of ``user_agent.*`` ECS fields keyed on the raw user agent string.
+
+    Parsing a user agent means running ua-parser's list of regexes over it, which dominates the cost of parsing an
+    access log line. Real traffic only has a small number of distinct user agents, so caching the parsed fields
+    avoids nearly all of that work. The least recently used entry is evicted once ``maxsize`` is reached.
+
+    Notes:
+        The returned dicts are shared between calls and must be treated as read-only. ``convert_combined_log_to_ecs``
+        only copies their items into the event.
+
+    Attributes:
+        maxsize (int): Maximum number of user agent strings kept in the cache.
+        parser (callable, optional): Function resolving a user agent string on a cache miss.
+                                     Default ``utils._parse_user_agent_section``.
+
+    Example:
+        .. code-block:: python
+
+            ua_cache = UserAgentCache(maxsize=2048)
+            fields = ua_cache('Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) Gecko/20100101 Firefox/54.0')
+            ua_cache.stats()  # {'hits': 0, 'misses': 1, 'evictions': 0, 'size': 1, 'maxsize': 2048}
+    """
+
+    def __init__(self, maxsize=1024, parser=_parse_user_agent_section):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.parser = parser
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, agent_string):
+        with self._lock:
+            fields = self._entries.get(agent_string)
+            if fields is not None:
+                self._entries.move_to_end(agent_string)
+                self.hits += 1
+                return fields
+            self.misses += 1
+        # Parse outside the lock so a slow miss doesn't block hits on other threads.
+        fields = self.parser(agent_string)
+        with self._lock:
+            self._entries[agent_string] = fields
+            self._entries.move_to_end(agent_string)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return fields
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: ``hits``, ``misses``, ``evictions``, current ``size`` and ``maxsize``.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize}
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+def _agent_hash(agent_string):
+    digest = hashlib.blake2b(agent_string.encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+    return _TABLE_HASH.unpack(digest)[0]
+
+
+class UserAgentTable:
+    """
+    Read-only, memory mapped lookup table of precomputed ``user_agent.*`` ECS fields.
+
+    The table file is created with ``build_user_agent_table`` (or ``python -m structlog_extensions build-ua-table``)
+    and maps user agent string hashes to the fields ``utils._parse_user_agent_section`` produces. Because the file is
+    memory mapped, every gunicorn worker on a host shares the same page cached copy and starts with all known user
+    agents resolved. Strings that aren't in the table are parsed with ``fallback``.
+
+    Attributes:
+        path (str): Path of the table file.
+        fallback (callable, optional): Function resolving user agent strings missing from the table.
+                                       Default ``utils._parse_user_agent_section``.
+        hits (int): Number of lookups answered from the table.
+        misses (int): Number of lookups passed on to ``fallback``.
+
+    Raises:
+        ValueError: If the file isn't a user agent table.
+
+    Example:
+        .. code-block:: python
+
+            ua_table = UserAgentTable('/var/lib/myapp/user_agents.table')
+            fields = ua_table('Googlebot-Image/1.0')
+    """
+
+    def __init__(self, path, fallback=_parse_user_agent_section):
+        self.path = path
+        self.fallback = fallback
+        self.hits = 0
+        self.misses = 0
+        with open(path, 'rb') as table_file:
+            self._map = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count = _TABLE_HEADER.unpack_from(self._map, 0)
+        if magic != _TABLE_MAGIC or version != _TABLE_VERSION:
+            self._map.close()
+            raise ValueError('{0} is not a user agent table'.format(path))
+        self._hashes_offset = _TABLE_HEADER.size
+        self._entries_offset = self._hashes_offset + self._count * _TABLE_HASH.size
+
+    def get(self, agent_string):
+        """
+        Looks up a user agent string in the table.
+
+        Args:
+            agent_string (str): Raw user agent string
+
+        Returns:
+            dict: The ``user_agent.*`` fields, or None if the string isn't in the table.
+        """
+        key = _agent_hash(agent_string)
+        table = self._map
+        hash_at = _TABLE_HASH.unpack_from
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if hash_at(table, self._hashes_offset + middle * _TABLE_HASH.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self._count and hash_at(table, self._hashes_offset + low * _TABLE_HASH.size)[0] == key:
+            offset, length = _TABLE_ENTRY.unpack_from(table, self._entries_offset + low * _TABLE_ENTRY.size)
+            values = table[offset:offset + length].decode('utf-8', 'surrogateescape').split(_FIELD_SEPARATOR)
+            if values[0] == agent_string:
+                return dict(zip(_TABLE_FIELDS, values))
+            low += 1
+        return None
+
+    def __call__(self, agent_string):
+        fields = self.get(agent_string)
+        if fields is None:
+            self.misses += 1
+            return self.fallback(agent_string)
+        self.hits += 1
+        return fields
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        """Unmaps the table file."""
+        self._map.close()
+
+
+def _required_literals(parsed):
+    """
+    Returns the literal strings a match of a parsed regex must contain.
+
+    Returns:
+        list: Requirements, each a tuple of alternative literals of which at least one is part of every match.
+    """
+    requirements = []
+    run = []
+
+    def end_run():
+        if run:
+            requirements.append((''.join(run),))
+            del run[:]
+
+    for op, av in parsed:
+        if op is _sre.LITERAL:
+            run.append(chr(av))
+            continue
+        end_run()
+        if op is _sre.SUBPATTERN:
+            requirements.extend(_required_literals(av[-1]))
+        elif op in (_sre.MAX_REPEAT, _sre.MIN_REPEAT, getattr(_sre, 'POSSESSIVE_REPEAT', None)):
+            if av[0] >= 1:
+                requirements.extend(_required_literals(av[2]))
+        elif op is getattr(_sre, 'ATOMIC_GROUP', None):
+            requirements.extend(_required_literals(av))
+        elif op is _sre.BRANCH:
+            alternatives = []
+            for branch in av[1]:
+                best = _best_requirement(_required_literals(branch))
+                if best is None:
+                    break
+                alternatives.extend(best)
+            else:
+                requirements.append(tuple(alternatives))
+        # Anything else (character sets, lookarounds, anchors, ...) doesn't add a requirement.
+    end_run()
+    return requirements
+
+
+def _best_requirement(requirements):
+    """Returns the requirement whose shortest alternative is longest, or None."""
+    return max(requirements, key=lambda alternatives: min(map(len, alternatives)), default=None)
+
+
+def _ngrams(text, size):
+    return {text[position:position + size] for position in range(len(text) - size + 1)}
+
+
+class _LiteralIndex:
+    """
+    Token index of the literals required by a list of ua-parser regexes.
+
+    Each literal is filed under one of its trigrams (bigram for two character literals), the one shared by the
+    fewest literals. Looking up a string intersects its trigrams and bigrams with the index, so only literals whose
+    key occurs in the string are tested with a substring search. Case-insensitive literals are lowercased and looked
+    up in the lowercased string.
+    """
+
+    def __init__(self, literals):
+        counts = Counter(gram for _, literal in literals for gram in _ngrams(literal, min(len(literal), 3)))
+        self.sensitive = dict()
+        self.insensitive = dict()
+        for literal_id, (ignore_case, literal) in enumerate(literals):
+            key = min(sorted(_ngrams(literal, min(len(literal), 3))), key=counts.__getitem__)
+            index = self.insensitive if ignore_case else self.sensitive
+            index.setdefault(key, []).append((literal_id, literal))
+
+    def present(self, agent_string):
+        """Returns the ids of the indexed literals that occur in the string."""
+        found = set()
+        for text, index in ((agent_string, self.sensitive), (agent_string.lower(), self.insensitive)):
+            keys = index.keys()
+            for key in (_ngrams(text, 3) & keys) | (_ngrams(text, 2) & keys):
+                for literal_id, literal in index[key]:
+                    if literal in text:
+                        found.add(literal_id)
+        return found
+
+
+class _IndexedDomain:
+    """
+    ua-parser parsers of one domain (user agent, OS or device) and the literals each of them requires.
+
+    A parser is a candidate for a string when all of its required literals are present. Parsers are filed under
+    the requirement whose literals the fewest other parsers of the domain require, so common fragments such as
+    ``) AppleWebKit`` don't turn most parsers into candidates.
+    """
+
+    def __init__(self, parsers, literal_ids):
+        self.parsers = parsers
+        self.always = []
+        self.case_insensitive = []
+        self.requirements = [None] * len(parsers)
+        for position, parser in enumerate(parsers):
+            pattern = parser.user_agent_re
+            ignore_case = bool(pattern.flags & re.IGNORECASE) or '(?i' in pattern.pattern
+            requirements = [alternatives for alternatives in
+                            _required_literals(_sre_parse.parse(pattern.pattern, pattern.flags))
+                            if min(map(len, alternatives)) >= 2]
+            if not requirements:
+                self.always.append(position)
+                continue
+            if ignore_case:
+                # Under re.IGNORECASE a few non-ASCII characters (such as the Kelvin sign) match ASCII letters,
+                # which a lowercased substring test doesn't see, so these only use the index for ASCII strings.
+                self.case_insensitive.append(position)
+            self.requirements[position] = tuple(
+                tuple(literal_ids.setdefault((ignore_case, literal.lower() if ignore_case else literal), len(literal_ids))
+                      for literal in alternatives)
+                for alternatives in requirements)
+        frequency = Counter(literal_id for requirements in self.requirements if requirements
+                            for alternatives in requirements for literal_id in alternatives)
+        self.by_literal = dict()
+        for position, requirements in enumerate(self.requirements):
+            if requirements:
+                rarest = min(requirements, key=lambda alternatives: sum(map(frequency.__getitem__, alternatives)))
+                for literal_id in rarest:
+                    self.by_literal.setdefault(literal_id, []).append(position)
+
+    def candidates(self, agent_string, present):
+        """Returns the parsers that can match the string, in their original order."""
+        positions = set(self.always)
+        if _NON_ASCII_RE.search(agent_string) is not None:
+            positions.update(self.case_insensitive)
+        by_literal = self.by_literal
+        requirements = self.requirements
+        for literal_id in present:
+            for position in by_literal.get(literal_id, ()):
+                if position not in positions and all(not present.isdisjoint(alternatives)
+                                                     for alternatives in requirements[position]):
+                    positions.add(position)
+        parsers = self.parsers
+        return [parsers[position] for position in sorted(positions)]
+
+
+class IndexedUserAgentParser:
+    """
+    Resolves user agent strings into ``user_agent.*`` fields like ``utils._parse_user_agent_section``, without
+    running ua-parser's full list of regexes one by one.
+
+    When the index is built, every ua-parser regex is analysed for the literal text any match must contain (for
+    example ``Chrome/`` or ``Googlebot``) and the literals are indexed by trigram. Parsing a string finds the
+    literals it contains through the index and only runs the regexes whose literals are all present, in ua-parser's
+    order and with ua-parser's own replacement logic, so the first match and the resulting fields are identical.
+    Regexes without a usable literal are always run. This helps the long tail of unique user agents that a
+    ``UserAgentCache`` can't absorb; use it as the cache's ``parser``.
+
+    The index takes about half a second to build and is built on first use, so call the parser once at startup
+    (for example in a gunicorn ``post_fork`` hook) to keep that out of the first request.
+
+    Example:
+        .. code-block:: python
+
+            ua_cache = UserAgentCache(maxsize=2048, parser=IndexedUserAgentParser())
+    """
+
+    def __init__(self):
+        self._domains = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        from ua_parser import user_agent_parser
+        from user_agents import parsers
+        self._parse_browser = parsers.parse_browser
+        self._parse_operating_system = parsers.parse_operating_system
+        self._parse_device = parsers.parse_device
+        literal_ids = dict()
+        domains = (_IndexedDomain(user_agent_parser.USER_AGENT_PARSERS, literal_ids),
+                   _IndexedDomain(user_agent_parser.OS_PARSERS, literal_ids),
+                   _IndexedDomain(user_agent_parser.DEVICE_PARSERS, literal_ids))
+        self._index = _LiteralIndex(list(literal_ids))
+        self._domains = domains
+
+    def __call__(self, agent_string):
+        if self._domains is None:
+            with self._lock:
+                if self._domains is None:
+                    self._build()
+        user_agent_domain, os_domain, device_domain = self._domains
+        present = self._index.present(agent_string)
+
+        family = v1 = v2 = v3 = None
+        for parser in user_agent_domain.candidates(agent_string, present):
+            family, v1, v2, v3 = parser.Parse(agent_string)
+            if family:
+                break
+        browser = self._parse_browser(family or 'Other', v1 or None, v2 or None, v3 or None)
+
+        os = os_v1 = os_v2 = os_v3 = os_v4 = None
+        for parser in os_domain.candidates(agent_string, present):
+            os, os_v1, os_v2, os_v3, os_v4 = parser.Parse(agent_string)
+            if os:
+                break
+        operating_system = self._parse_operating_system(os or 'Other', os_v1, os_v2, os_v3, os_v4)
+
+        device = brand = model = None
+        for parser in device_domain.candidates(agent_string, present):
+            device, brand, model = parser.Parse(agent_string)
+            if device:
+                break
+        device = self._parse_device('Other' if device is None else device, brand, model)
+
+        return _user_agent_section(agent_string, browser, operating_system, device)
+
+
+def _open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='surrogateescape')
+    return open(path, 'r', encoding='utf-8', errors='surrogateescape')
+
+
+def build_user_agent_table(log_files, output_path, log_format=COMBINED_LOG_FORMAT, min_count=1):
+    """
+    Builds a ``UserAgentTable`` file from a corpus of access logs.
+
+    Every distinct user agent string seen at least ``min_count`` times is parsed once and written to the table.
+    The table is written to a temporary file first and then moved into place, so running workers never see a
+    partially written table.
+
+    Args:
+        log_files (list): Paths of the access log files to scan. Files ending in ``.gz`` are decompressed.
+        output_path (str): Path of the table file to write.
+        log_format (str, optional): Format of the log lines. Default is the Apache Combined log format.
+        min_count (int, optional): Minimum number of occurrences for a user agent to be included. Default 1.
+
+    Returns:
+        int: Number of user agent strings written to the table.
+    """
+    parser = compile_log_format(log_format)
+    agents = Counter()
+    for path in log_files:
+        with _open_log(path) as log_file:
+            for line in log_file:
+                agent = parser.parse(line.rstrip('\n')).get('agent')
+                if agent is not None:
+                    agents[agent] += 1
+    records = []
+    for agent, count in agents.items():
+        if count < min_count:
+            continue
+        fields = _parse_user_agent_section(agent)
+        values = [fields[name] for name in _TABLE_FIELDS]
+        if any(_FIELD_SEPARATOR in value for value in values):
+            continue
+        records.append((_agent_hash(agent), _FIELD_SEPARATOR.join(values).encode('utf-8', 'surrogateescape')))
+    records.sort(key=lambda record: record[0])
+
+    data_offset = _TABLE_HEADER.size + len(records) * (_TABLE_HASH.size + _TABLE_ENTRY.size)
+    temp_path = '{0}.tmp{1}'.format(output_path, os.getpid())
+    with open(temp_path, 'wb') as table_file:
+        table_file.write(_TABLE_HEADER.pack(_TABLE_MAGIC, _TABLE_VERSION, len(records)))
+        for key, _ in records:
+            table_file.write(_TABLE_HASH.pack(key))
+        offset = data_offset
+        for _, data in records:
+            table_file.write(_TABLE_ENTRY.pack(offset, len(data)))
+            offset += len(data)
+        for _, data in records:
+            table_file.write(data)
+    os.replace(temp_path, output_path)
+    return len(records)
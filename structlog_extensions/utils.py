@@ -1,23 +1,32 @@
 import re
-from user_agents import parse
-from deepmerge import  always_merger
-import pytz
 from datetime import datetime, timezone
+from operator import itemgetter
+from .logformat import COMBINED_LOG_FORMAT, CombinedLogScanner, _ecs_field_mappings
+from .timestamps import TimestampCache, parse_combined_timestamp
+from .events import EcsAccessEvent, _schema
+from .fields import lazy_fields
 
 
-_ecs_field_mappings = {'host':'source.ip',
-                       'user': 'user.name',
-                       'event': 'event.original',
-                       'method': 'http.request.method',
-                       'referrer': 'http.request.referrer',
-                       'size': 'http.response.body.bytes',
-                       'status': 'http.response.status_code',
-                       'time': '@timestamp',
-                       'url': 'url.original',
-                       'version': 'http.version'}
+_combined_log_parser = CombinedLogScanner(COMBINED_LOG_FORMAT)
+_user_agents_parse = None
+_timestamp_cache = TimestampCache()
+_user_agent_fields = ('user_agent.original',
+                      'user_agent.name',
+                      'user_agent.os.name',
+                      'user_agent.os.version',
+                      'user_agent.os.full',
+                      'user_agent.device.name',
+                      'user_agent.version')
+_request_fields = ('http.request.method', 'url.original', 'http.version', 'event.action')
+# Fields _build_ecs_fields adds after the parsed and user agent fields, in order.
+_added_fields = ('message', 'event.original', 'event.dataset', 'ecs.version', 'event.created', '@timestamp',
+                 'event.severity')
+_compact_plans = dict()
+_COMPACT_PLAN_CACHE_SIZE = 256
 
 
-def convert_combined_log_to_ecs(log_line, dataset, severity=0):
+def convert_combined_log_to_ecs(log_line, dataset, severity=0, parser=None, user_agent_parser=None, clock=None,
+                                projection=None, lazy=False, compact=False):
     """
     Converts a combined log entry into a dict containing the log entry key/values
     with the key names using Elastic Common schema element names.
@@ -26,55 +35,222 @@ def convert_combined_log_to_ecs(log_line, dataset, severity=0):
         log_line (str): Combined log entry
         dataset (str): source of the log entry (for example 'apache.access')
         severity (int, optional): severity of the source log event
+        parser (LogFormatParser, optional): Parser for the log line layout. Default is the Apache Combined log format.
+                                            Custom formats must include at least ``%t`` and either ``%r`` or ``%m``.
+        user_agent_parser (callable, optional): Function turning a user agent string into ``user_agent.*`` fields,
+                                                for example a ``useragent.UserAgentCache``. Default parses every
+                                                user agent string.
+        clock (callable, optional): Function returning the current time as an ISO string for ``event.created``,
+                                    for example a ``timestamps.CoarseClock``. Default formats the current time for
+                                    every call.
+        projection (FieldProjection, optional): Fields to return. Parsing stages whose fields aren't selected (the
+                                                request line, user agent, timestamps) are skipped entirely, so a
+                                                malformed request line only rejects the entry when request fields
+                                                are selected. Default None (all fields).
+        lazy (bool, optional): Return the ``user_agent.*`` fields as ``fields.LazyField`` placeholders that parse the
+                               user agent when they're first read, for example by the renderer. Default False.
+        compact (bool, optional): Return an ``events.EcsAccessEvent`` instead of a dict, which takes a fraction of
+                                  the memory when many converted entries are held. Without a ``projection`` the
+                                  event is filled straight from the parsed fields, without building the dict first.
+                                  Default False.
 
     Returns:
         dict: Dictionary of key/value pairs with the key names using ECS namespaced names.
+
+    Raises:
+        ValueError: If the log line doesn't match the log format.
+    """
+    if parser is None:
+        parser = _combined_log_parser
+    if user_agent_parser is None:
+        user_agent_parser = _parse_user_agent_section
+    result = parser.parse(log_line)
+    if not result:
+        raise ValueError('Log line does not match log format {0!r}'.format(parser.log_format))
+    if projection is None or projection.selects('event.created'):
+        created = datetime.now(timezone.utc).isoformat() if clock is None else clock()
+    else:
+        created = None
+    if compact and projection is None:
+        return _build_compact_event(log_line, result, dataset, severity, parser.field_mappings,
+                                    _parse_request_section, user_agent_parser, combined_log_timestring_to_iso,
+                                    created, lazy)
+    ecs_fields = _build_ecs_fields(log_line, result, dataset, severity, parser.field_mappings, _parse_request_section,
+                                   user_agent_parser, combined_log_timestring_to_iso, created, projection, lazy)
+    return EcsAccessEvent.from_dict(ecs_fields) if compact else ecs_fields
+
+
+def convert_combined_log_to_ecs_batch(log_lines, dataset, severity=0, parser=None, user_agent_parser=None, clock=None,
+                                      columnar=False, projection=None, compact=False):
     """
-    result = _parse_log_into_fields(log_line)
-    request_fields = _parse_request_section(result['request'])
-    result.update(request_fields)
-    user_agent_fields = _parse_user_agent_section(result['agent'])
-    message = '"{0}" {1} {2}'.format(result['request'], result['status'], result['size'])
-    ecs_fields = _convert_field_names_to_ecs(result)
-    ecs_fields.update(user_agent_fields)
+    Converts a batch of combined log entries, resolving every distinct request line, user agent and timestamp in
+    the batch only once.
+
+    Each converted entry is identical to what ``convert_combined_log_to_ecs`` returns for the line, except that
+    ``event.created`` is taken once for the whole batch.
+
+    Args:
+        log_lines (iterable): Combined log entries
+        dataset (str): source of the log entries (for example 'apache.access')
+        severity (int, optional): severity of the source log events
+        parser (LogFormatParser, optional): Parser for the log line layout. Default is the Apache Combined log format.
+        user_agent_parser (callable, optional): Function turning a user agent string into ``user_agent.*`` fields.
+        clock (callable, optional): Function returning the current time as an ISO string for ``event.created``.
+        columnar (bool, optional): Return a dict of ECS field name to list of values (one per converted line)
+                                   instead of a list of dicts. Default False.
+        projection (FieldProjection, optional): Fields to return, see ``convert_combined_log_to_ecs``.
+        compact (bool, optional): Return ``events.EcsAccessEvent`` objects instead of dicts. Default False.
+
+    Returns:
+        list: One ECS dict per line, or None for lines that can't be converted. With ``columnar=True`` a dict of
+        lists is returned instead, leaving out the lines that can't be converted.
+    """
+    if parser is None:
+        parser = _combined_log_parser
+    if user_agent_parser is None:
+        user_agent_parser = _parse_user_agent_section
+    created = datetime.now(timezone.utc).isoformat() if clock is None else clock()
+    parse_request = _memoize(_parse_request_section)
+    parse_user_agent = _memoize(user_agent_parser)
+    convert_timestamp = _memoize(combined_log_timestring_to_iso)
+    field_mappings = parser.field_mappings
+    converted = []
+    for log_line in log_lines:
+        result = parser.parse(log_line)
+        try:
+            if not result:
+                raise ValueError('Log line does not match log format')
+            if compact and not columnar and projection is None:
+                ecs_fields = _build_compact_event(log_line, result, dataset, severity, field_mappings, parse_request,
+                                                  parse_user_agent, convert_timestamp, created)
+            else:
+                ecs_fields = _build_ecs_fields(log_line, result, dataset, severity, field_mappings, parse_request,
+                                               parse_user_agent, convert_timestamp, created, projection)
+                if compact and not columnar:
+                    ecs_fields = EcsAccessEvent.from_dict(ecs_fields)
+        except (ValueError, KeyError):
+            ecs_fields = None
+        converted.append(ecs_fields)
+    if not columnar:
+        return converted
+    columns = dict()
+    row_count = 0
+    for ecs_fields in converted:
+        if ecs_fields is None:
+            continue
+        for name, value in ecs_fields.items():
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = [None] * row_count
+            column.append(value)
+        row_count += 1
+        for column in columns.values():
+            if len(column) < row_count:
+                column.append(None)
+    return columns
+
+
+def _memoize(function):
+    results = dict()
+
+    def memoized(key):
+        try:
+            return results[key]
+        except KeyError:
+            value = results[key] = function(key)
+            return value
+
+    return memoized
+
+
+def _build_ecs_fields(log_line, result, dataset, severity, field_mappings, parse_request, parse_user_agent,
+                      convert_timestamp, created, projection=None, lazy=False):
+    needs_request = projection is None or projection.selects_any(_request_fields)
+    if 'request' in result and needs_request:
+        request_fields = parse_request(result['request'])
+        result.update(request_fields)
+    message = '"{0}" {1} {2}'.format(result.get('request', '-'), result.get('status', '-'), result.get('size', '-'))
+    ecs_fields = _convert_field_names_to_ecs(result, field_mappings, action=needs_request)
+    if 'agent' in result and (projection is None or projection.selects_any(_user_agent_fields)):
+        agent = result['agent']
+        if lazy:
+            user_agent_fields = {'user_agent.original': agent}
+            user_agent_fields.update(lazy_fields(lambda: parse_user_agent(agent), _user_agent_fields[1:]))
+        else:
+            user_agent_fields = parse_user_agent(agent)
+        ecs_fields.update(user_agent_fields)
     ecs_fields['message'] = message
     ecs_fields['event.original'] = log_line
     ecs_fields['event.dataset'] = dataset
     ecs_fields['ecs.version'] = '1.0.0'
-    ecs_fields['event.created'] = datetime.now(timezone.utc).isoformat()
-    ecs_fields['@timestamp'] = combined_log_timestring_to_iso(ecs_fields['@timestamp'])
+    ecs_fields['event.created'] = created
+    if projection is None or projection.selects('@timestamp'):
+        ecs_fields['@timestamp'] = convert_timestamp(ecs_fields['@timestamp'])
     ecs_fields['event.severity'] = severity
+    if projection is not None:
+        ecs_fields = projection.project(ecs_fields)
     return ecs_fields
 
 
-def _parse_log_into_fields(log_line):
-    parts = [
-        r'(?P<host>\S+)',  # host %h
-        r'\S+',  # indent %l (unused)
-        r'(?P<user>\S+)',  # user %u
-        r'\[(?P<time>.+)\]',  # time %t
-        r'"(?P<request>.+)"',  # request "%r"
-        r'(?P<status>[0-9]+)',  # status %>s
-        r'(?P<size>\S+)',  # size %b (careful, can be '-')
-        r'"(?P<referrer>.*)"',  # referrer "%{Referrer}i"
-        r'"(?P<agent>.*)"',  # user agent "%{User-agent}i"
-    ]
-    pattern = re.compile(r'\s+'.join(parts) + r'\s*\Z')
-    match = pattern.match(log_line)
-    if match:
-        fields = match.groupdict()
-        if fields["user"] == "-":
-            fields["user"] = None
-        fields["status"] = int(fields["status"])
-        if fields["size"] == "-":
-            fields["size"] = 0
-        else:
-            fields["size"] = int(fields["size"])
-        if fields["referrer"] == "-":
-            fields["referrer"] = None
-        return fields
+class _CompactPlan:
+    """
+    Where each field of a compact event comes from, for one set of parsed, request and user agent field names.
+
+    ``getter`` picks the event's values, in ``_build_ecs_fields`` order, out of the list of parsed, request and user
+    agent values followed by the ``_added_fields`` values; ``time_index`` is the position of the raw timestamp in
+    that list.
+    """
+    __slots__ = ('field_mappings', 'schema', 'getter', 'time_index')
+
+    def __init__(self, keys, field_mappings):
+        result_keys, request_keys, user_agent_keys = keys
+        merged = dict()
+        for index, key in enumerate(result_keys + request_keys):
+            merged[key] = index
+        ecs_fields = {field_mappings[key]: index for key, index in merged.items() if key in field_mappings}
+        ecs_fields['event.action'] = ecs_fields['http.request.method']
+        offset = len(result_keys) + len(request_keys)
+        for position, key in enumerate(user_agent_keys, offset):
+            ecs_fields[key] = position
+        self.time_index = ecs_fields['@timestamp']
+        for position, key in enumerate(_added_fields, offset + len(user_agent_keys)):
+            ecs_fields[key] = position
+        self.field_mappings = field_mappings
+        self.schema = _schema(tuple(ecs_fields))
+        self.getter = itemgetter(*ecs_fields.values())
+
+
+def _build_compact_event(log_line, result, dataset, severity, field_mappings, parse_request, parse_user_agent,
+                         convert_timestamp, created, lazy=False):
+    """
+    Same as ``EcsAccessEvent.from_dict(_build_ecs_fields(...))`` without a projection, but fills the event's values
+    straight from the parsed fields using a plan cached per key set, without building the intermediate dicts.
+    """
+    request_fields = parse_request(result['request']) if 'request' in result else {}
+    if 'agent' not in result:
+        user_agent_fields = {}
+    elif lazy:
+        agent = result['agent']
+        user_agent_fields = {'user_agent.original': agent}
+        user_agent_fields.update(lazy_fields(lambda: parse_user_agent(agent), _user_agent_fields[1:]))
     else:
-        return dict()
+        user_agent_fields = parse_user_agent(result['agent'])
+    keys = (tuple(result), tuple(request_fields), tuple(user_agent_fields))
+    plan = _compact_plans.get(keys)
+    if plan is None or plan.field_mappings is not field_mappings:
+        plan = _CompactPlan(keys, field_mappings)
+        if len(_compact_plans) >= _COMPACT_PLAN_CACHE_SIZE:
+            _compact_plans.pop(next(iter(_compact_plans)), None)
+        _compact_plans[keys] = plan
+    message = '"{0}" {1} {2}'.format(result.get('request', '-'), result.get('status', '-'), result.get('size', '-'))
+    values = [*result.values(), *request_fields.values(), *user_agent_fields.values(),
+              message, log_line, dataset, '1.0.0', created, None, severity]
+    values[-2] = convert_timestamp(values[plan.time_index])
+    return EcsAccessEvent._from_schema(plan.schema, plan.getter(values))
+
+
+def _parse_log_into_fields(log_line):
+    return _combined_log_parser.parse(log_line)
 
 
 def _parse_request_section(request_string):
@@ -90,43 +266,173 @@ def _parse_request_section(request_string):
         return dict()
 
 
+def parse(agent_string):
+    """
+    Parses a user agent string with ``user_agents.parse``.
+
+    user_agents compiles the large ua-parser regex set when it is imported, so it is only imported on first use
+    (or by ``warmup``).
+    """
+    global _user_agents_parse
+    if _user_agents_parse is None:
+        from user_agents import parse as user_agents_parse
+        _user_agents_parse = user_agents_parse
+    return _user_agents_parse(agent_string)
+
+
+def warmup():
+    """
+    Loads the dependencies and fills the caches that are otherwise set up when the first access log line is parsed.
+
+    Call it in the gunicorn master (for example from the ``on_starting`` server hook) so forked
+    workers share the result copy-on-write, or in ``post_fork`` to move the cost out of the first request.
+    """
+    parse('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.186 Safari/537.36')
+    combined_log_timestring_to_iso(datetime.now().astimezone().strftime('%d/%b/%Y:%H:%M:%S %z'))
+
+
 def _parse_user_agent_section(agent_string):
     user_agent = parse(agent_string)
+    return _user_agent_section(agent_string, user_agent.browser, user_agent.os, user_agent.device)
+
+
+def _user_agent_section(agent_string, browser, os, device):
     result = dict()
     result['user_agent.original'] = agent_string
-    result['user_agent.name'] = user_agent.browser.family
-    result['user_agent.os.name'] = user_agent.os.family
-    result['user_agent.os.version'] = user_agent.os.version_string
-    result['user_agent.os.full'] = ' '.join([user_agent.os.family, user_agent.os.version_string])
-    result['user_agent.device.name'] = user_agent.device.family
-    result['user_agent.version'] = user_agent.browser.version_string
+    result['user_agent.name'] = browser.family
+    result['user_agent.os.name'] = os.family
+    result['user_agent.os.version'] = os.version_string
+    result['user_agent.os.full'] = ' '.join([os.family, os.version_string])
+    result['user_agent.device.name'] = device.family
+    result['user_agent.version'] = browser.version_string
     return result
 
 
-def _convert_field_names_to_ecs(parsed_fields):
-    ecs_fields = {_ecs_field_mappings[key]:value for (key,value) in parsed_fields.items() if key in _ecs_field_mappings}
-    ecs_fields['event.action'] = ecs_fields['http.request.method']
+def _convert_field_names_to_ecs(parsed_fields, field_mappings=_ecs_field_mappings, action=True):
+    ecs_fields = {field_mappings[key]:value for (key,value) in parsed_fields.items() if key in field_mappings}
+    if action:
+        ecs_fields['event.action'] = ecs_fields['http.request.method']
     return ecs_fields
 
 def unflatten_dict(flat_dict, separator='.'):
     """
     Turns a dict with key names defining a namespace into a nested dictionary
 
+    Conflicts are resolved deterministically, independent of key order: when a key is both a value and the parent of
+    other keys (for example ``event`` and ``event.original``), the nested keys win. A non-dict value at the parent is
+    discarded; a dict value is merged with the nested keys, with the nested keys taking precedence. The nesting for
+    each key set and separator is cached (see ``NestingPlanCache``), so repeated calls with the same keys are cheap.
+
     Args:
-        flat_dict (dict): The dict cont
+        flat_dict (dict): The dict containing the flat, namespaced keys
         separator (str, optional): The separator used to split name elements. Default '.'
 
     Returns:
         dict: A nested dictionary structure created from the original flat dict.
     """
-    expanded_dict = dict()
-    for key, value in flat_dict.items():
-        field_hierarchy = key.split(separator)
-        for field in reversed(field_hierarchy):
-            item = { field: value}
-            value = item
-        always_merger.merge(expanded_dict,value)
-    return expanded_dict
+    return _build_nested(_unflatten_plans.plan(tuple(flat_dict), separator), list(flat_dict.values()))
+
+
+def _compile_nesting_plan(keys, separator):
+    """
+    Compiles the key path trie for a tuple of flat keys into a nesting plan.
+
+    The plan is a tuple of ``(name, value_index, children)`` entries in order of first appearance, where
+    ``value_index`` is the position of the key's value (or None for intermediate objects) and ``children`` is the
+    plan for the nested object (or None for leaves).
+    """
+    root = dict()
+    for index, key in enumerate(keys):
+        node = root
+        path = key.split(separator)
+        for name in path[:-1]:
+            node = node.setdefault(name, [None, dict()])[1]
+        entry = node.setdefault(path[-1], [None, dict()])
+        entry[0] = index
+
+    def freeze(node):
+        return tuple((name, value_index, freeze(children) if children else None)
+                     for name, (value_index, children) in node.items())
+
+    return freeze(root)
+
+
+def _build_nested(plan, values):
+    nested = dict()
+    for name, value_index, children in plan:
+        if children is None:
+            nested[name] = values[value_index]
+        else:
+            child = _build_nested(children, values)
+            if value_index is not None and isinstance(values[value_index], dict):
+                child = _merge_nested(values[value_index], child)
+            nested[name] = child
+    return nested
+
+
+def _merge_nested(base, override):
+    merged = dict(base)
+    for name, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(name), dict):
+            value = _merge_nested(merged[name], value)
+        merged[name] = value
+    return merged
+
+
+class NestingPlanCache:
+    """
+    Size-bounded cache of compiled nesting plans, keyed on the exact sequence of keys in an event dict.
+
+    Events produced by the same code path (for example ``CombinedLogParser``) have the same keys every time, so the
+    key path trie only has to be worked out once per key set. The oldest plan is dropped once ``maxsize`` plans are
+    cached, so events with free-form keys can't grow memory without limit.
+
+    Attributes:
+        separator (str, optional): The separator used to split name elements. Default '.'
+        maxsize (int, optional): Maximum number of cached plans. Default 256.
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of plans compiled.
+    """
+
+    def __init__(self, separator='.', maxsize=256):
+        self.separator = separator
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._plans = dict()
+
+    def plan(self, keys, separator=None):
+        """
+        Returns the (cached) nesting plan for a tuple of flat keys.
+
+        Args:
+            keys (tuple): The flat keys
+            separator (str, optional): Separator to use instead of the cache's own; plans are then cached per key set
+                                       and separator. Default None.
+        """
+        cache_key = keys if separator is None else (keys, separator)
+        plan = self._plans.get(cache_key)
+        if plan is None:
+            self.misses += 1
+            plan = _compile_nesting_plan(keys, self.separator if separator is None else separator)
+            if len(self._plans) >= self.maxsize:
+                self._plans.pop(next(iter(self._plans)), None)
+            self._plans[cache_key] = plan
+        else:
+            self.hits += 1
+        return plan
+
+    def unflatten(self, flat_dict):
+        """
+        Same as ``unflatten_dict``, using a cached plan for the dict's keys.
+        """
+        return _build_nested(self.plan(tuple(flat_dict)), list(flat_dict.values()))
+
+    def __len__(self):
+        return len(self._plans)
+
+
+_unflatten_plans = NestingPlanCache(maxsize=1024)
 
 
 def _parse_datetime(timestamp):
@@ -141,9 +447,7 @@ def _parse_datetime(timestamp):
     Due to problems parsing the timezone (`%z`) with `datetime.strptime`, the
     timezone will be obtained using the `pytz` library.
     '''
-    dt = datetime.strptime(timestamp[0:-6], '%d/%b/%Y:%H:%M:%S')
-    dt_tz = int(timestamp[-5:-2]) * 60 + int(timestamp[-2:])
-    return dt.replace(tzinfo=pytz.FixedOffset(dt_tz))
+    return parse_combined_timestamp(timestamp)
 
 
 def combined_log_timestring_to_iso(timestamp):
@@ -155,6 +459,5 @@ def combined_log_timestring_to_iso(timestamp):
     Returns:
         str: iso standard datetime string
     """
-    dt = _parse_datetime(timestamp)
-    return dt.isoformat()
+    return _timestamp_cache(timestamp)
 
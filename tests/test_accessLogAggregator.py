@@ -0,0 +1,92 @@
+from unittest import TestCase
+import logging
+import time
+from structlog_extensions.metrics import AccessLogAggregator, LatencyHistogram, PathTemplateNormalizer, OVERFLOW_PATH, \
+    flush_aggregators
+
+_line = '127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET {0} HTTP/1.1" {1} 140 "-" "curl/7.1"'
+
+
+class TestAccessLogAggregator(TestCase):
+    def setUp(self):
+        self.summaries = []
+        self.aggregator = AccessLogAggregator(interval=60, max_keys=3, emit=self.summaries.append,
+                                              timer=False)
+
+    def test_path_template(self):
+        normalize = PathTemplateNormalizer()
+        self.assertEqual(normalize('/users/42/orders?page=2'), '/users/:id/orders')
+        self.assertEqual(normalize('/files/3f2504e0-4f89-11d3-9a0c-0305e82c3301'), '/files/:uuid')
+        self.assertEqual(normalize('/blob/0123456789abcdef0123'), '/blob/:hash')
+        self.assertEqual(normalize('/'), '/')
+        custom = PathTemplateNormalizer([(r'^v[0-9]+$', ':version')])
+        self.assertEqual(custom('/api/v2/users'), '/api/:version/users')
+
+    def test_histogram_merge(self):
+        first = LatencyHistogram((10, 100))
+        second = LatencyHistogram((10, 100))
+        for milliseconds in (1, 10, 50):
+            first.add(milliseconds)
+        second.add(500)
+        first.merge(second)
+        self.assertEqual(first.counts, [2, 1, 1])
+        self.assertEqual(first.count, 4)
+        self.assertEqual(first.sum, 561)
+        with self.assertRaises(ValueError):
+            first.merge(LatencyHistogram((10,)))
+
+    def test_interval_summaries(self):
+        self.aggregator.add('get', '/users/1', 200, 100, 20000000, now=120)
+        self.aggregator.add('get', '/users/2?x=1', 200, 50, 2000000, now=130)
+        self.aggregator.add('get', '/users/3', 500, None, now=150)
+        self.assertEqual(self.summaries, [])
+        self.aggregator.add('post', '/login', 302, 0, now=185)
+        self.assertEqual(len(self.summaries), 2)
+        ok = self.summaries[0]
+        self.assertEqual(ok['url.path'], '/users/:id')
+        self.assertEqual(ok['http.response.status_code'], 200)
+        self.assertEqual(ok['metrics.requests'], 2)
+        self.assertEqual(ok['metrics.bytes'], 150)
+        self.assertEqual(ok['metrics.duration.count'], 2)
+        self.assertEqual(ok['metrics.duration.counts'][:3], [1, 0, 1])
+        self.assertEqual(ok['event.start'], '1970-01-01T00:02:00+00:00')
+        self.assertEqual(ok['event.end'], '1970-01-01T00:03:00+00:00')
+        self.assertEqual(ok['event.kind'], 'metric')
+        self.assertNotIn('metrics.duration.count', self.summaries[1])
+        self.aggregator.flush()
+        self.assertEqual(self.summaries[2]['http.request.method'], 'post')
+
+    def test_overflow(self):
+        for index in range(10):
+            self.aggregator.add('get', '/route{0}'.format(index), 200, now=0)
+        self.aggregator.flush()
+        self.assertEqual(len(self.summaries), 4)
+        overflow = self.summaries[-1]
+        self.assertEqual(overflow['url.path'], OVERFLOW_PATH)
+        self.assertTrue(overflow['labels.overflow'])
+        self.assertEqual(overflow['metrics.requests'], 7)
+        self.assertEqual(self.aggregator.overflowed, 7)
+
+    def test_timer(self):
+        aggregator = AccessLogAggregator(interval=0.2, emit=self.summaries.append)
+        aggregator.add('get', '/', 200, 10, 1000000)
+        deadline = time.time() + 5
+        while not self.summaries and time.time() < deadline:
+            time.sleep(0.01)
+        aggregator.close()
+        self.assertEqual(self.summaries[0]['metrics.requests'], 1)
+        self.assertEqual(self.summaries[0]['metrics.duration.sum'], 1.0)
+
+    def test_flush_aggregators(self):
+        self.aggregator.add('get', '/', 200, now=0)
+        flush_aggregators()
+        self.assertEqual(len(self.summaries), 1)
+
+    def test_filter(self):
+        record = logging.LogRecord('gunicorn.access', logging.INFO, __file__, 1, _line.format('/a/7', 404), None, None)
+        self.assertFalse(self.aggregator.filter(record))
+        garbage = logging.LogRecord('gunicorn.access', logging.INFO, __file__, 1, 'garbage', None, None)
+        self.assertTrue(self.aggregator.filter(garbage))
+        self.aggregator.flush()
+        self.assertEqual(self.summaries[0]['url.path'], '/a/:id')
+        self.assertEqual(self.summaries[0]['metrics.bytes'], 140)
@@ -0,0 +1,106 @@
+from unittest import TestCase
+import io
+import json
+import logging
+import structlog
+import structlog_extensions
+from structlog_extensions.processors import AccessLogSampler, SamplingRule
+
+_line = '127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET {0} HTTP/1.1" {1} 140 "-" "curl/7.1"'
+
+
+class TestAccessLogSampler(TestCase):
+    def setUp(self):
+        self.logger = logging.Logger("gunicorn.access")
+        self.sampler = AccessLogSampler([SamplingRule(status='5xx', name='errors'),
+                                         SamplingRule(rate=0, path='/healthz', name='health'),
+                                         SamplingRule(rate=0.1, status=[200, 204], name='ok')], seed=1)
+
+    def _sample(self, path, status):
+        try:
+            return self.sampler(self.logger, 'info', {'event': _line.format(path, status)})
+        except structlog.DropEvent:
+            return None
+
+    def test_rules(self):
+        self.assertEqual(self._sample('/', 503), {'event': _line.format('/', 503)})
+        self.assertIsNone(self._sample('/healthz?full=1', 200))
+        kept = [event_dict for event_dict in (self._sample('/', 200) for _ in range(1000)) if event_dict]
+        self.assertTrue(50 < len(kept) < 150)
+        self.assertEqual(kept[0]['event.sample_rate'], 0.1)
+        self.assertIsNotNone(self._sample('/', 404))
+        stats = self.sampler.stats()
+        self.assertEqual(stats['health']['sampled_out'], 1)
+        self.assertEqual(stats['ok']['matched'], 1000)
+        self.assertEqual(stats['ok']['kept'], len(kept))
+        self.assertEqual(stats['default']['kept'], 1)
+
+    def test_parsed_fields(self):
+        event_dict = {'event': 'not a log line', 'http.response.status_code': 500, 'url.original': '/'}
+        self.assertIs(self.sampler(self.logger, 'info', event_dict), event_dict)
+        with self.assertRaises(structlog.DropEvent):
+            self.sampler(self.logger, 'info', {'event': 'x', 'http.response.status_code': 200, 'url.original': '/healthz'})
+
+    def test_other_loggers_untouched(self):
+        self.assertEqual(self.sampler(logging.Logger("app"), 'info', {'event': _line.format('/healthz', 200)}),
+                         {'event': _line.format('/healthz', 200)})
+
+    def test_rate_limit(self):
+        sampler = AccessLogSampler([SamplingRule(rate_limit=1, burst=5, name='limited')])
+        for _ in range(20):
+            sampler.decide(_line.format('/', 200))
+        self.assertEqual(sampler.stats()['limited']['kept'], 5)
+        self.assertEqual(sampler.stats()['limited']['rate_limited'], 15)
+
+    def test_rate_limited_sample_rate(self):
+        sampler = AccessLogSampler([SamplingRule(rate_limit=1, burst=5, name='limited')])
+        rates = [sampler.decide(_line.format('/', 200)) for _ in range(20)]
+        self.assertEqual(rates[:5], [1.0] * 5)
+        self.assertEqual(rates[5:], [None] * 15)
+        self.assertIsNone(sampler.decide(_line.format('/', 200), 200, '/'))
+        event_dict = {'event': 'x', 'http.response.status_code': 200, 'url.original': '/'}
+        sampler.rules[0]._tokens = 1
+        self.assertAlmostEqual(sampler(self.logger, 'info', event_dict)['event.sample_rate'], 6 / 22)
+
+    def test_sampled_and_rate_limited(self):
+        sampler = AccessLogSampler([SamplingRule(rate=0.5, rate_limit=1, burst=1)], seed=0)
+        rates = [rate for rate in (sampler.decide(_line.format('/', 200)) for _ in range(100)) if rate is not None]
+        self.assertEqual(len(rates), 1)
+        self.assertEqual(rates[0], 0.5)
+
+    def test_rules_with_same_name(self):
+        sampler = AccessLogSampler([SamplingRule(rate_limit=1, burst=2, status=200),
+                                    SamplingRule(rate=0, status=200),
+                                    SamplingRule(status=404)])
+        for _ in range(3):
+            sampler.decide(_line.format('/', 200))
+        sampler.decide(_line.format('/', 404))
+        stats = sampler.stats()
+        self.assertEqual(sorted(stats), ['default', 'status=200 #1', 'status=200 #2', 'status=404'])
+        self.assertEqual(stats['status=200 #1']['kept'], 2)
+        self.assertEqual(stats['status=200 #1']['rate_limited'], 1)
+        self.assertEqual(stats['status=200 #2']['matched'], 0)
+        self.assertEqual(stats['status=404']['kept'], 1)
+
+    def test_filter_with_processor_formatter(self):
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.addFilter(self.sampler)
+        handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+            processor=structlog_extensions.processors.NestedDictJSONRenderer(separator='.', clean_keys=['event']),
+            foreign_pre_chain=[self.sampler, structlog_extensions.processors.CombinedLogParser('gunicorn.access')]))
+        self.logger.addHandler(handler)
+        self.logger.info(_line.format('/healthz', 200))
+        self.logger.info(_line.format('/', 500))
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['http']['response']['status_code'], 500)
+
+    def test_status_strings(self):
+        rule = SamplingRule(status=['4xx', 500])
+        self.assertTrue(rule.matches(None, 404, None))
+        self.assertTrue(rule.matches(None, 500, None))
+        self.assertFalse(rule.matches(None, 503, None))
+        for status in ('404', 'abc', '5XX', 'xx', ['2xx', '200']):
+            with self.assertRaises(ValueError):
+                SamplingRule(status=status)
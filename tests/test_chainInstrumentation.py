@@ -0,0 +1,72 @@
+from unittest import TestCase
+import io
+import logging
+import structlog
+from structlog_extensions.instrumentation import ChainInstrumentation
+from structlog_extensions.processors import CombinedLogParser, NestedDictJSONRenderer
+
+_line = ('127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 '
+         '"http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"')
+
+
+def _failing(logger, method_name, event_dict):
+    if event_dict.get('fail'):
+        raise RuntimeError('fail')
+    return event_dict
+
+
+def _dropping(logger, method_name, event_dict):
+    raise structlog.DropEvent
+
+
+class TestChainInstrumentation(TestCase):
+    def setUp(self):
+        self.snapshots = []
+        self.instrumentation = ChainInstrumentation(sample_every=2, emit=self.snapshots.append)
+
+    def test_counts(self):
+        failing, dropping = self.instrumentation.wrap([_failing, _dropping])
+        logger = logging.Logger('app')
+        for _ in range(5):
+            with self.assertRaises(structlog.DropEvent):
+                dropping(logger, 'info', failing(logger, 'info', {}))
+        with self.assertRaises(RuntimeError):
+            failing(logger, 'info', {'fail': True})
+        stages = self.instrumentation.snapshot()['stages']
+        self.assertEqual(stages['_failing']['calls'], 6)
+        self.assertEqual(stages['_failing']['exceptions'], 1)
+        self.assertEqual(stages['_dropping']['dropped'], 5)
+        self.assertGreater(stages['_failing']['max_us'], 0)
+        self.instrumentation.reset()
+        self.assertEqual(self.instrumentation.snapshot()['stages']['_failing']['calls'], 0)
+
+    def test_formatter_chain(self):
+        parser = CombinedLogParser('gunicorn.access')
+        pre_chain = self.instrumentation.wrap([structlog.stdlib.add_log_level, parser])
+        renderer = self.instrumentation.wrap([NestedDictJSONRenderer(separator='.')])[0]
+        stream = io.StringIO()
+        handler = self.instrumentation.wrap_handler(logging.StreamHandler(stream))
+        handler.setFormatter(structlog.stdlib.ProcessorFormatter(processor=renderer, foreign_pre_chain=pre_chain))
+        logger = logging.Logger('gunicorn.access')
+        logger.addHandler(handler)
+        for _ in range(4):
+            logger.info(_line)
+        self.assertEqual(len(stream.getvalue().splitlines()), 4)
+        stages = self.instrumentation.snapshot()['stages']
+        self.assertEqual(set(stages), {'add_log_level', 'CombinedLogParser', 'NestedDictJSONRenderer',
+                                       'handler:StreamHandler'})
+        self.assertEqual(stages['CombinedLogParser']['calls'], 4)
+        self.assertEqual(stages['CombinedLogParser']['caches']['ua_cache']['hit_rate'], 0.75)
+        self.assertIn('timestamp_cache', stages['CombinedLogParser']['caches'])
+        self.assertEqual(stages['NestedDictJSONRenderer']['caches']['plan_cache']['misses'], 1)
+        self.assertEqual(stages['handler:StreamHandler']['calls'], 4)
+
+    def test_duplicate_names_and_self_log(self):
+        instrumentation = ChainInstrumentation(sample_every=1, log_interval=0, emit=self.snapshots.append)
+        first, second = instrumentation.wrap([_failing, _failing])
+        self.assertEqual(second.stats.name, '_failing#2')
+        first(None, 'info', {})
+        self.assertEqual(len(self.snapshots), 1)
+        self.assertEqual(self.snapshots[0]['stages']['_failing']['calls'], 1)
+        with self.assertRaises(ValueError):
+            ChainInstrumentation(sample_every=0)
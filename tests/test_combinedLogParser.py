@@ -82,4 +82,9 @@ class TestCombinedLogParser(TestCase):
         logger.warning(
             '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 "http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"')
 
-
+    def test_indexed_ua_parser(self):
+        indexed = structlog_extensions.processors.CombinedLogParser("gunicorn.access", indexed_ua_parser=True)
+        result = indexed(self.logger, self.method_name, dict(self.valid_event_dict))
+        expected = self.logparser(self.logger, self.method_name, dict(self.valid_event_dict))
+        for name in ('user_agent.name', 'user_agent.version', 'user_agent.os.full', 'user_agent.device.name'):
+            self.assertEqual(result[name], expected[name])
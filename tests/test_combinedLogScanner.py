@@ -0,0 +1,118 @@
+from unittest import TestCase
+import random
+import time
+from structlog_extensions.logformat import CombinedLogScanner, LogFormatParser, compile_log_format, \
+    COMBINED_LOG_FORMAT, GUNICORN_LOG_FORMAT
+from structlog_extensions.utils import _parse_log_into_fields, convert_combined_log_to_ecs
+
+_line = '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 ' \
+        '"http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"'
+
+_pathological = [
+    '1 - - [' + '] "a" 1 1 "' * 200,
+    '1 - - [x] "' + '" 1 1 "' * 300,
+    '1 - - [' + '] "' * 500 + ' x',
+]
+
+
+def _mutations(count, seed=0):
+    """Valid lines with random characters inserted, deleted and replaced."""
+    rng = random.Random(seed)
+    alphabet = ' \t"[]-0123a'
+    for _ in range(count):
+        line = list(_line)
+        for _ in range(rng.randint(1, 12)):
+            position = rng.randrange(len(line))
+            operation = rng.random()
+            if operation < 0.4:
+                line.insert(position, rng.choice(alphabet))
+            elif operation < 0.7:
+                del line[position]
+            else:
+                line[position] = rng.choice(alphabet)
+        yield ''.join(line)
+
+
+def _parse(parser, line):
+    try:
+        return parser.parse(line)
+    except ValueError:
+        return ValueError
+
+
+class TestCombinedLogScanner(TestCase):
+    def setUp(self):
+        self.scanner = CombinedLogScanner()
+
+    def test_combined_format(self):
+        self.assertEqual(self.scanner.parse(_line), LogFormatParser().parse(_line))
+        self.assertEqual(list(self.scanner.parse(_line)), list(LogFormatParser().parse(_line)))
+
+    def test_same_fields_as_regex(self):
+        regex = LogFormatParser()
+        matched = 0
+        for line in _mutations(20000):
+            expected = _parse(regex, line)
+            self.assertEqual(_parse(self.scanner, line), expected, line)
+            matched += bool(expected)
+        self.assertGreater(matched, 1000)
+
+    def test_same_fields_as_regex_quote_heavy(self):
+        regex = LogFormatParser()
+        rng = random.Random(1)
+        pieces = ['"', ' ', '[', ']', '1', '-', 'a', '] "', '" 1 1 "', '" "', '" 2 - "', '\t']
+        for _ in range(20000):
+            line = 'h - u [' + ''.join(rng.choice(pieces) for _ in range(rng.randint(5, 30)))
+            self.assertEqual(_parse(self.scanner, line), _parse(regex, line), line)
+
+    def test_dashes_and_trailing_whitespace(self):
+        line = '10.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 304 - "-" "curl/7.1" \n'
+        fields = self.scanner.parse(line)
+        self.assertIsNone(fields['user'])
+        self.assertIsNone(fields['referrer'])
+        self.assertEqual(fields['size'], 0)
+        self.assertEqual(fields['agent'], 'curl/7.1')
+
+    def test_rejects(self):
+        for line in ['', 'garbage', ' ' + _line, _line[:-1], _line.replace('[', '(', 1), _line.replace(' 200 ', ' ok '),
+                     _line.replace('" "', '"'), _line.replace('] "', ']"'), _line.replace('"GET', '"\nGET')]:
+            self.assertEqual(self.scanner.parse(line), {}, line)
+
+    def test_max_line_length(self):
+        self.assertEqual(CombinedLogScanner(max_line_length=len(_line) - 1).parse(_line), {})
+        self.assertTrue(CombinedLogScanner(max_line_length=len(_line)).parse(_line))
+
+    def test_truncation(self):
+        fields = CombinedLogScanner(max_field_length=10).parse(_line)
+        self.assertEqual(fields['referrer'], 'http://www')
+        self.assertEqual(fields['agent'], 'Mozilla/4.')
+        self.assertEqual(fields['truncated'], 'referrer,agent')
+        self.assertNotIn('truncated', CombinedLogScanner(max_field_length=33).parse(_line))
+        self.assertEqual(CombinedLogScanner(max_field_length=33).parse(_line)['referrer'],
+                         'http://www.example.com/start.html')
+
+    def test_truncated_label(self):
+        long_agent = _line.replace('Mozilla', 'x' * 10000)
+        ecs = convert_combined_log_to_ecs(long_agent, 'apache.access')
+        self.assertEqual(ecs['labels.truncated'], 'agent')
+        self.assertEqual(len(ecs['user_agent.original']), 8192)
+
+    def test_pathological_lines(self):
+        for line in _pathological:
+            self.assertEqual(self.scanner.parse(line), {})
+            started = time.perf_counter()
+            for _ in range(100):
+                self.scanner.parse(line)
+            self.assertLess(time.perf_counter() - started, 0.5)
+
+    def test_compile_log_format(self):
+        self.assertIsInstance(compile_log_format(COMBINED_LOG_FORMAT), CombinedLogScanner)
+        self.assertIsInstance(compile_log_format(GUNICORN_LOG_FORMAT), CombinedLogScanner)
+        self.assertNotIsInstance(compile_log_format('%h %l %u %t "%r" %>s %b'), CombinedLogScanner)
+        self.assertEqual(_parse_log_into_fields(_line), self.scanner.parse(_line))
+
+    def test_invalid_configuration(self):
+        with self.assertRaises(ValueError):
+            CombinedLogScanner('%h %l %u %t "%r" %>s %b')
+        with self.assertRaises(ValueError):
+            CombinedLogScanner(max_field_length=0)
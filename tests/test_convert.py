@@ -0,0 +1,63 @@
+from unittest import TestCase
+import gzip
+import io
+import json
+import os
+import tempfile
+from structlog_extensions.__main__ import main
+from structlog_extensions.convert import convert_log_files
+
+_line = '127.0.0.{0} - - [05/Feb/2012:17:11:{1:02d} +0000] "GET /page/{0} HTTP/1.1" 200 {0} "-" "curl/7.{0}"\n'
+
+
+class TestConvert(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.lines = [_line.format(index, index % 60) for index in range(200)]
+        self.lines.insert(50, 'garbage\n')
+        self.plain_path = os.path.join(self.directory.name, 'access.log')
+        with open(self.plain_path, 'w') as log_file:
+            log_file.writelines(self.lines)
+            log_file.write(_line.format(999, 0).rstrip('\n'))
+        self.gzip_path = os.path.join(self.directory.name, 'access.log.gz')
+        with gzip.open(self.gzip_path, 'wt') as log_file:
+            log_file.writelines(self.lines)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _convert(self, paths, **kwargs):
+        output = io.BytesIO()
+        stats = convert_log_files(paths, output, chunk_size=512, **kwargs)
+        return [json.loads(line) for line in output.getvalue().decode('utf-8').splitlines()], stats
+
+    def test_ordered_nested_output(self):
+        documents, stats = self._convert([self.plain_path, self.gzip_path], processes=1)
+        self.assertEqual(stats['lines'], 403)
+        self.assertEqual(stats['unparseable'], 2)
+        self.assertEqual(len(documents), 401)
+        self.assertEqual([document['source']['ip'] for document in documents[:3]],
+                         ['127.0.0.0', '127.0.0.1', '127.0.0.2'])
+        self.assertEqual(documents[200]['url']['original'], '/page/999')
+        self.assertEqual(documents[0]['event']['dataset'], 'apache.access')
+
+    def test_flat_output(self):
+        documents, _ = self._convert([self.gzip_path], processes=1, nested=False)
+        self.assertEqual(documents[3]['http.response.body.bytes'], 3)
+
+    def test_process_pool_matches_single_process(self):
+        single, _ = self._convert([self.plain_path, self.gzip_path], processes=1)
+        pooled, stats = self._convert([self.plain_path, self.gzip_path], processes=2)
+        for document in single + pooled:
+            document['event'].pop('created')
+        self.assertEqual(single, pooled)
+        self.assertEqual(stats['unparseable'], 2)
+
+    def test_cli(self):
+        output_path = os.path.join(self.directory.name, 'access.ndjson')
+        self.assertEqual(main(['convert', '--processes', '1', '--dataset', 'gunicorn.access', '-o', output_path,
+                               self.plain_path]), 0)
+        with open(output_path) as output:
+            documents = [json.loads(line) for line in output]
+        self.assertEqual(len(documents), 201)
+        self.assertEqual(documents[0]['event']['dataset'], 'gunicorn.access')
@@ -0,0 +1,40 @@
+from unittest import TestCase
+import structlog_extensions.utils as utils
+
+_agents = ['Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) Gecko/20100101 Firefox/54.0', 'Googlebot-Image/1.0', '-']
+
+
+def _clock():
+    return '2020-01-01T00:00:00+00:00'
+
+
+class TestConvertBatch(TestCase):
+    def setUp(self):
+        self.lines = ['10.0.0.{0} - - [05/Feb/2012:17:11:{1:02d} -0700] "GET /{2} HTTP/1.1" 200 {0} "-" "{3}"'.format(
+            index, index % 3, index % 4, _agents[index % 3]) for index in range(30)]
+        self.lines[7] = 'not a log line'
+        self.lines[11] = '10.0.0.1 - - [05/Feb/2012:17:11:00 -0700] "NotARequest" 400 0 "-" "-"'
+
+    def test_matches_per_line(self):
+        batch = utils.convert_combined_log_to_ecs_batch(self.lines, 'apache.access', severity=20, clock=_clock)
+        self.assertEqual(len(batch), len(self.lines))
+        for line, ecs_fields in zip(self.lines, batch):
+            try:
+                expected = utils.convert_combined_log_to_ecs(line, 'apache.access', severity=20, clock=_clock)
+            except (ValueError, KeyError):
+                expected = None
+            self.assertEqual(ecs_fields, expected)
+            if expected is not None:
+                self.assertEqual(list(ecs_fields), list(expected))
+        self.assertIsNone(batch[7])
+        self.assertIsNone(batch[11])
+
+    def test_columnar(self):
+        columns = utils.convert_combined_log_to_ecs_batch(self.lines, 'apache.access', clock=_clock, columnar=True)
+        self.assertEqual(len(columns['source.ip']), 28)
+        self.assertEqual(columns['http.response.body.bytes'][:3], [0, 1, 2])
+        self.assertEqual(set(len(column) for column in columns.values()), {28})
+
+    def test_empty(self):
+        self.assertEqual(utils.convert_combined_log_to_ecs_batch([], 'apache.access'), [])
+        self.assertEqual(utils.convert_combined_log_to_ecs_batch([], 'apache.access', columnar=True), {})
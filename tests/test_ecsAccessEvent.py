@@ -0,0 +1,81 @@
+from unittest import TestCase
+import json
+import pickle
+from structlog_extensions.events import EcsAccessEvent
+from structlog_extensions.jsonstream import FlatJSONSerializer
+from structlog_extensions.logformat import LogFormatParser
+from structlog_extensions.utils import convert_combined_log_to_ecs, convert_combined_log_to_ecs_batch, unflatten_dict
+
+_line = ('127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 '
+         '"http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"')
+
+
+class TestEcsAccessEvent(TestCase):
+    def setUp(self):
+        self.fields = convert_combined_log_to_ecs(_line, 'apache.access')
+        self.event = EcsAccessEvent.from_dict(self.fields)
+
+    def test_mapping(self):
+        self.assertEqual(self.event, self.fields)
+        self.assertEqual(len(self.event), len(self.fields))
+        self.assertEqual(list(self.event), list(self.fields))
+        self.assertEqual(self.event['http.response.status_code'], 200)
+        self.assertIsNone(self.event.get('missing'))
+        self.assertIn('url.original', self.event)
+        with self.assertRaises(KeyError):
+            self.event['missing']
+        event_dict = {'event': _line}
+        event_dict.update(self.event)
+        self.assertEqual(event_dict['source.ip'], '127.0.0.1')
+        self.assertEqual(dict(self.event), self.fields)
+        self.assertEqual(EcsAccessEvent(('a', 'b'), (1, 2)), {'a': 1, 'b': 2})
+        with self.assertRaises(ValueError):
+            EcsAccessEvent(('a',), (1, 2))
+
+    def test_views(self):
+        self.assertEqual(self.event.keys() & {'url.original', 'missing'}, {'url.original'})
+        self.assertEqual(self.event.keys(), self.fields.keys())
+        self.assertEqual(list(self.event.values()), list(self.fields.values()))
+        self.assertIn(('source.ip', '127.0.0.1'), self.event.items())
+        self.assertEqual(set(self.event.items()) - set(self.fields.items()), set())
+        self.assertEqual(len(self.event.values()), len(self.fields))
+
+    def test_shared_schema(self):
+        other = EcsAccessEvent.from_dict(convert_combined_log_to_ecs(_line, 'apache.access'))
+        self.assertIs(other._schema, self.event._schema)
+        copy = pickle.loads(pickle.dumps(self.event))
+        self.assertEqual(copy, self.event)
+        self.assertIs(copy._schema, self.event._schema)
+
+    def test_consumers(self):
+        self.assertEqual(unflatten_dict(self.event), unflatten_dict(self.fields))
+        serializer = FlatJSONSerializer('.')
+        self.assertEqual(serializer(self.event), serializer(self.fields))
+        self.assertEqual(json.loads(serializer(self.event))['http']['response']['status_code'], 200)
+
+    def test_compact_conversion(self):
+        event = convert_combined_log_to_ecs(_line, 'apache.access', compact=True)
+        self.assertIsInstance(event, EcsAccessEvent)
+        self.assertEqual(event['url.original'], '/apache_pb.gif')
+        converted = convert_combined_log_to_ecs_batch([_line, 'garbage'], 'apache.access', compact=True)
+        self.assertIsInstance(converted[0], EcsAccessEvent)
+        self.assertIsNone(converted[1])
+
+    def test_compact_conversion_matches_dict(self):
+        created = '2020-01-01T00:00:00+00:00'
+        parser = LogFormatParser('%h %l %u %t "%r" %>s %b %D "%{User-Agent}i"')
+        cases = [(_line, None),
+                 ('10.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 304 - 1500 "curl/7.1"', parser)]
+        for line, line_parser in cases:
+            for lazy in (False, True):
+                expected = convert_combined_log_to_ecs(line, 'apache.access', parser=line_parser, lazy=lazy,
+                                                       clock=lambda: created)
+                event = convert_combined_log_to_ecs(line, 'apache.access', parser=line_parser, lazy=lazy,
+                                                    clock=lambda: created, compact=True)
+                self.assertEqual(list(event.keys()), list(expected))
+                self.assertEqual(event.to_dict(), expected)
+        for compact in (False, True):
+            with self.assertRaises(KeyError):
+                convert_combined_log_to_ecs(_line.replace('HTTP/1.0', 'x'), 'apache.access', compact=compact)
+        batch = convert_combined_log_to_ecs_batch([_line], 'apache.access', compact=True)
+        self.assertEqual(list(batch[0]), list(convert_combined_log_to_ecs_batch([_line], 'apache.access')[0]))
@@ -0,0 +1,82 @@
+from unittest import TestCase, skipIf
+from datetime import timedelta
+import io
+import json
+import logging
+import structlog
+import structlog_extensions
+from structlog_extensions.utils import convert_combined_log_to_ecs
+
+try:
+    from gunicorn.config import Config
+    from structlog_extensions.glogging import EcsLogger
+except ImportError:
+    Config = None
+
+
+class _Response:
+    status = '200 OK'
+    sent = 2326
+    headers = [('Content-Type', 'image/gif')]
+
+
+class _Request:
+    headers = [('USER-AGENT', 'Mozilla/4.08 [en] (Win98; I ;Nav)')]
+
+
+_environ = {'REQUEST_METHOD': 'GET',
+            'RAW_URI': '/apache_pb.gif?x=1',
+            'PATH_INFO': '/apache_pb.gif',
+            'QUERY_STRING': 'x=1',
+            'SERVER_PROTOCOL': 'HTTP/1.0',
+            'REMOTE_ADDR': '127.0.0.1',
+            'HTTP_REFERER': 'http://www.example.com/start.html',
+            'HTTP_USER_AGENT': 'Mozilla/4.08 [en] (Win98; I ;Nav)',
+            'HTTP_AUTHORIZATION': 'Basic ZnJhbms6c2VjcmV0'}
+
+_line = ('127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif?x=1 HTTP/1.0" 200 2326 '
+         '"http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"')
+
+
+@skipIf(Config is None, 'gunicorn is not installed')
+class TestEcsLogger(TestCase):
+    def setUp(self):
+        cfg = Config()
+        cfg.set('accesslog', '-')
+        self.logger = EcsLogger(cfg)
+        self.stream = io.StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+            processor=structlog_extensions.processors.NestedDictJSONRenderer(separator='.'),
+            foreign_pre_chain=[structlog_extensions.processors.CombinedLogParser('gunicorn.access')]))
+        self.logger.access_log.handlers = [handler]
+
+    def tearDown(self):
+        self.logger.access_log.handlers = []
+
+    def test_same_fields_as_parser(self):
+        ecs_fields = self.logger.ecs_fields(_Response(), _Request(), _environ, timedelta(seconds=1, microseconds=5))
+        parsed = convert_combined_log_to_ecs(_line, 'gunicorn.access', logging.INFO)
+        for name in ('event.original', '@timestamp', 'event.created'):
+            parsed.pop(name)
+        self.assertEqual({name: ecs_fields[name] for name in parsed}, parsed)
+        self.assertEqual(ecs_fields['event.duration'], 1000005000)
+        self.assertEqual(ecs_fields['url.path'], '/apache_pb.gif')
+        self.assertEqual(ecs_fields['url.query'], 'x=1')
+
+    def test_access(self):
+        self.logger.access(_Response(), _Request(), _environ, timedelta(milliseconds=3))
+        document = json.loads(self.stream.getvalue())
+        self.assertEqual(document['http']['response']['status_code'], 200)
+        self.assertEqual(document['event']['duration'], 3000000)
+        self.assertEqual(document['user_agent']['os']['name'], 'Windows')
+        self.assertEqual(document['logger'], 'gunicorn.access')
+
+    def test_empty_body(self):
+        response = _Response()
+        response.status = 204
+        response.sent = 0
+        ecs_fields = self.logger.ecs_fields(response, _Request(), dict(_environ, HTTP_X_REQUEST_ID='abc'),
+                                            timedelta())
+        self.assertEqual(ecs_fields['http.response.body.bytes'], 0)
+        self.assertEqual(ecs_fields['http.request.id'], 'abc')
@@ -0,0 +1,251 @@
+from unittest import TestCase
+import base64
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import structlog
+import structlog_extensions
+from structlog_extensions.handlers import ElasticsearchBulkHandler
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.requests.append((self.path, dict(self.headers), body))
+            respond = self.server.responses.pop(0) if self.server.responses else self.server.default_response
+        status, payload = respond(body)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _accepted(body):
+    lines = body.splitlines()
+    return 200, {'errors': False, 'items': [{'create': {'status': 201}} for _ in lines[::2]]}
+
+
+def _unavailable(body):
+    return 503, {'error': 'unavailable'}
+
+
+def _item_statuses(*statuses):
+    def respond(body):
+        return 200, {'errors': True, 'items': [{'create': {'status': status}} for status in statuses]}
+    return respond
+
+
+class TestElasticsearchBulkHandler(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.responses = []
+        self.server.default_response = _accepted
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.logger = logging.Logger('test.elasticsearch')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _handler(self, url=None, **kwargs):
+        kwargs.setdefault('flush_interval', 60)
+        kwargs.setdefault('backoff', 0.01)
+        handler = ElasticsearchBulkHandler(url or self.url, **kwargs)
+        handler.setFormatter(logging.Formatter('{"message": "%(message)s"}'))
+        self.logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def _documents(self):
+        documents = []
+        for _, _, body in self.server.requests:
+            lines = body.splitlines()
+            documents.extend(json.loads(line)['message'] for line in lines[1::2])
+        return documents
+
+    def _log(self, *messages):
+        for message in messages:
+            self.logger.info(message)
+
+    def test_sends_bulk_requests(self):
+        handler = self._handler(index='logs', batch_size=2)
+        self._log('one', 'two', 'three')
+        self.assertTrue(handler.flush(timeout=5))
+        self.assertEqual(self._documents(), ['one', 'two', 'three'])
+        path, headers, body = self.server.requests[0]
+        self.assertEqual(path, '/_bulk')
+        self.assertEqual(headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(body.splitlines()[0], b'{"create":{"_index":"logs"}}')
+        self.assertTrue(body.endswith(b'\n'))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(handler.stats()['sent'], 3)
+
+    def test_batch_bytes(self):
+        handler = self._handler(batch_bytes=40)
+        self._log('one', 'two', 'three')
+        handler.flush(timeout=5)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self._documents(), ['one', 'two', 'three'])
+
+    def test_flush_interval(self):
+        self._handler(flush_interval=0.05)
+        self._log('one')
+        deadline = time.monotonic() + 5
+        while not self.server.requests and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self._documents(), ['one'])
+
+    def test_index_and_credentials_from_url(self):
+        handler = self._handler(url=self.url.replace('//', '//user:secret@') + '/logs/', op_type='index')
+        self._log('one')
+        handler.flush(timeout=5)
+        path, headers, body = self.server.requests[0]
+        self.assertEqual(path, '/logs/_bulk')
+        self.assertEqual(headers['Authorization'], 'Basic ' + base64.b64encode(b'user:secret').decode('ascii'))
+        self.assertEqual(body.splitlines()[0], b'{"index":{}}')
+
+    def test_retries_unavailable(self):
+        self.server.responses = [_unavailable, _unavailable]
+        handler = self._handler()
+        self._log('one')
+        handler.flush(timeout=5)
+        self.assertEqual(self._documents(), ['one', 'one', 'one'])
+        stats = handler.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['dropped']), (1, 2, 0))
+
+    def test_retries_rejected_documents_only(self):
+        self.server.responses = [_item_statuses(201, 429, 400)]
+        handler = self._handler()
+        self._log('one', 'two', 'three')
+        handler.flush(timeout=5)
+        self.assertEqual(self._documents(), ['one', 'two', 'three', 'two'])
+        stats = handler.stats()
+        self.assertEqual((stats['sent'], stats['rejected'], stats['retries']), (2, 1, 1))
+
+    def test_retries_documents_missing_from_response(self):
+        self.server.responses = [_item_statuses(201), lambda body: (200, {'errors': True})]
+        handler = self._handler()
+        self._log('one', 'two', 'three')
+        handler.flush(timeout=5)
+        self.assertEqual(self._documents(), ['one', 'two', 'three', 'two', 'three', 'two', 'three'])
+        stats = handler.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['dropped']), (3, 2, 0))
+
+    def test_client_error_is_not_retried(self):
+        self.server.responses = [lambda body: (400, {'error': 'bad request'})]
+        handler = self._handler()
+        self._log('one')
+        handler.flush(timeout=5)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(handler.stats()['rejected'], 1)
+
+    def test_drops_without_spill_path(self):
+        self.server.default_response = _unavailable
+        handler = self._handler(max_retries=1)
+        self._log('one')
+        handler.flush(timeout=5)
+        self.assertEqual(handler.stats()['dropped'], 1)
+
+    def test_spills_and_replays(self):
+        spill_path = os.path.join(self.directory.name, 'bulk-{pid}.ndjson')
+        self.server.default_response = _unavailable
+        handler = self._handler(max_retries=1, spill_path=spill_path)
+        self._log('one', 'two')
+        handler.flush(timeout=5)
+        spill_file = spill_path.format(pid=os.getpid())
+        with open(spill_file, 'rb') as spilled:
+            self.assertEqual(len(spilled.read().splitlines()), 4)
+        self.assertEqual(handler.stats()['spilled'], 2)
+
+        self.server.default_response = _accepted
+        del self.server.requests[:]
+        self._log('three')
+        handler.flush(timeout=5)
+        self.assertEqual(self._documents(), ['three', 'one', 'two'])
+        self.assertEqual(handler.stats()['replayed'], 2)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_replays_spill_files_of_other_processes(self):
+        spill_path = os.path.join(self.directory.name, 'bulk-{pid}.ndjson')
+        for pid, message in ((1, 'exited'), (2, 'recycled')):
+            with open(spill_path.format(pid=pid), 'wb') as spill_file:
+                spill_file.write(b'{"create":{}}\n{"message": "' + message.encode('ascii') + b'"}\n')
+        handler = self._handler(spill_path=spill_path)
+        self._log('one')
+        handler.flush(timeout=5)
+        self.assertEqual(self._documents(), ['one', 'exited', 'recycled'])
+        self.assertEqual(handler.stats()['replayed'], 2)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_endpoint_down(self):
+        self.server.shutdown()
+        self.server.server_close()
+        spill_path = os.path.join(self.directory.name, 'bulk.ndjson')
+        handler = self._handler(max_retries=2, spill_path=spill_path)
+        self._log('one')
+        handler.flush(timeout=5)
+        stats = handler.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['spilled']), (0, 2, 1))
+
+    def test_capacity(self):
+        handler = self._handler(capacity_bytes=110)
+        self._log('one', 'two', 'three', 'four', 'five')
+        self.assertEqual(handler.stats()['dropped'], 2)
+        handler.flush(timeout=5)
+        self.assertEqual(self._documents(), ['one', 'two', 'three'])
+
+    def test_close_sends_buffered_documents(self):
+        handler = self._handler()
+        self._log('one')
+        handler.close()
+        self.assertEqual(self._documents(), ['one'])
+        self._log('two')
+        self.assertEqual(handler.stats()['dropped'], 1)
+
+    def test_flush_queued_handlers(self):
+        self._handler()
+        self._log('one')
+        self.assertTrue(structlog_extensions.handlers.flush_queued_handlers(timeout=5))
+        self.assertEqual(self._documents(), ['one'])
+
+    def test_processor_formatter(self):
+        handler = ElasticsearchBulkHandler(self.url, index='logs')
+        handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+            processor=structlog_extensions.processors.NestedDictJSONRenderer(separator='.'),
+            foreign_pre_chain=[structlog.stdlib.add_log_level]))
+        self.addCleanup(handler.close)
+        self.logger.addHandler(handler)
+        self.logger.info('one')
+        handler.flush(timeout=5)
+        document = json.loads(self.server.requests[0][2].splitlines()[1])
+        self.assertEqual(document, {'event': 'one', 'level': 'info'})
+
+    def test_invalid_configuration(self):
+        with self.assertRaises(ValueError):
+            ElasticsearchBulkHandler('ftp://localhost')
+        with self.assertRaises(ValueError):
+            ElasticsearchBulkHandler(self.url, op_type='update')
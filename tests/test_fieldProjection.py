@@ -0,0 +1,62 @@
+from unittest import TestCase
+from unittest import mock
+import json
+import logging
+import structlog_extensions
+import structlog_extensions.utils as utils
+from structlog_extensions.fields import FieldProjection, LazyField, resolve_lazy_fields
+
+
+class TestFieldProjection(TestCase):
+    def setUp(self):
+        self.logger = logging.Logger("gunicorn.access")
+        self.line = '127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET / HTTP/1.1" 200 140 "-" ' \
+                    '"Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) Gecko/20100101 Firefox/54.0"'
+
+    def _parse(self, **kwargs):
+        logparser = structlog_extensions.processors.CombinedLogParser("gunicorn.access", ua_cache_size=0, **kwargs)
+        return logparser(self.logger, "info", {'event': self.line})
+
+    def test_selectors(self):
+        projection = FieldProjection(include=['http', 'user_agent.name'], exclude=['http.request.referrer'])
+        self.assertTrue(projection.selects('http.response.status_code'))
+        self.assertTrue(projection.selects('user_agent.name'))
+        self.assertFalse(projection.selects('http.request.referrer'))
+        self.assertFalse(projection.selects('user_agent.os.name'))
+        self.assertFalse(projection.selects('httpx'))
+
+    def test_include_skips_user_agent_parsing(self):
+        with mock.patch.object(utils, 'parse') as parse:
+            event_dict = self._parse(fields=['@timestamp', 'http.response', 'url'])
+        parse.assert_not_called()
+        self.assertEqual(set(event_dict), {'event', '@timestamp', 'http.response.status_code',
+                                           'http.response.body.bytes', 'url.original'})
+        self.assertEqual(event_dict['@timestamp'], '2012-02-05T17:11:55+00:00')
+
+    def test_exclude(self):
+        event_dict = self._parse(exclude_fields=['user_agent', 'event.created'])
+        self.assertNotIn('user_agent.name', event_dict)
+        self.assertNotIn('event.created', event_dict)
+        self.assertEqual(event_dict['http.request.method'], 'get')
+
+    def test_projected_fields_match_full_conversion(self):
+        full = self._parse()
+        projected = self._parse(fields=['source', 'user_agent'])
+        for name, value in projected.items():
+            self.assertEqual(value, full[name])
+
+    def test_lazy_user_agent(self):
+        with mock.patch.object(utils, 'parse', wraps=utils.parse) as parse:
+            event_dict = self._parse(lazy=True)
+            self.assertIsInstance(event_dict['user_agent.name'], LazyField)
+            parse.assert_not_called()
+            renderer = structlog_extensions.processors.NestedDictJSONRenderer(separator='.', clean_keys=['event'])
+            rendered = json.loads(renderer(self.logger, "info", event_dict))
+            self.assertEqual(parse.call_count, 1)
+        self.assertEqual(rendered['user_agent']['name'], 'Firefox')
+        self.assertEqual(rendered['user_agent']['os']['full'], 'Windows 7')
+
+    def test_resolve_lazy_fields(self):
+        event_dict = resolve_lazy_fields(self.logger, "info", self._parse(lazy=True))
+        self.assertEqual(event_dict['user_agent.name'], 'Firefox')
+        self.assertIs(type(event_dict['user_agent.version']), str)
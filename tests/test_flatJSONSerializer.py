@@ -0,0 +1,66 @@
+from unittest import TestCase
+import datetime
+import json
+import logging
+import structlog
+import structlog_extensions
+from structlog_extensions.jsonstream import FlatJSONSerializer
+from structlog_extensions.utils import unflatten_dict
+
+
+class TestFlatJSONSerializer(TestCase):
+    def setUp(self):
+        self.renderer = structlog_extensions.processors.NestedDictJSONRenderer(separator='.')
+        self.streaming_renderer = structlog_extensions.processors.NestedDictJSONRenderer(separator='.',
+                                                                                         streaming=True)
+
+    def assertSameOutput(self, event_dict):
+        self.assertEqual(self.streaming_renderer(None, 'info', dict(event_dict)),
+                         self.renderer(None, 'info', dict(event_dict)))
+
+    def test_combined_log_event(self):
+        logparser = structlog_extensions.processors.CombinedLogParser("gunicorn.access")
+        event_dict = logparser(logging.Logger("gunicorn.access"), "info", {
+            'event': '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 '
+                     '"http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"',
+            'level': 'info', 'logger': 'gunicorn.access'})
+        event_dict.pop('event')
+        self.assertSameOutput(event_dict)
+
+    def test_value_types(self):
+        self.assertSameOutput({'a.str': 'café "quoted" \n', 'a.int': 3, 'a.float': 1.5, 'a.nan': float('nan'),
+                               'a.inf': float('-inf'), 'a.true': True, 'a.false': False, 'a.none': None,
+                               'b.list': [1, 'two', None], 'b.dict': {'x': {'y': 1}},
+                               'c.time': datetime.datetime(2020, 1, 1), 'c.object': object, '100%.key': 'x'})
+
+    def test_ensure_ascii(self):
+        serializer = FlatJSONSerializer(ensure_ascii=False)
+        event_dict = {'user.name': 'Jürgen', 'message': '☃'}
+        self.assertEqual(serializer(event_dict), json.dumps(unflatten_dict(event_dict), ensure_ascii=False))
+
+    def test_empty_and_single(self):
+        self.assertSameOutput({})
+        self.assertSameOutput({'a.b.c': 1})
+
+    def test_conflict_falls_back(self):
+        self.assertIsNone(FlatJSONSerializer()({'event': 'x', 'event.original': 'y'}))
+        self.assertSameOutput({'event': 'x', 'event.original': 'y'})
+
+    def test_unsupported_arguments(self):
+        with self.assertRaises(ValueError):
+            structlog_extensions.processors.NestedDictJSONRenderer(separator='.', streaming=True, sort_keys=True)
+
+    def test_chain_processor(self):
+        structlog.configure(
+            processors=[
+                structlog_extensions.processors.NestedDictJSONRenderer(clean_keys=['event'], separator='_',
+                                                                       streaming=True),
+            ],
+            context_class=dict,
+            logger_factory=structlog.stdlib.LoggerFactory(),
+            wrapper_class=structlog.stdlib.BoundLogger,
+            cache_logger_on_first_use=True,
+        )
+
+        logger = structlog.get_logger(__name__)
+        logger.warning('Test', event_original='Test', event_action='test', service_name='structlog_extensions')
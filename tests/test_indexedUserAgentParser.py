@@ -0,0 +1,146 @@
+from unittest import TestCase
+import random
+import re
+import structlog_extensions.utils as utils
+from structlog_extensions.useragent import IndexedUserAgentParser, _required_literals, _sre, _sre_parse
+
+_CATEGORY_CHARACTERS = {_sre.CATEGORY_DIGIT: '0123456789', _sre.CATEGORY_NOT_DIGIT: 'a /;(',
+                        _sre.CATEGORY_WORD: 'a0_', _sre.CATEGORY_NOT_WORD: ' /;(',
+                        _sre.CATEGORY_SPACE: ' ', _sre.CATEGORY_NOT_SPACE: 'a0/;('}
+
+
+def _literals(pattern):
+    return _required_literals(_sre_parse.parse(pattern))
+
+
+def _in_set(character, items):
+    for op, arg in items:
+        if op is _sre.LITERAL and ord(character) == arg:
+            return True
+        if op is _sre.RANGE and arg[0] <= ord(character) <= arg[1]:
+            return True
+        if op is _sre.CATEGORY and character in _CATEGORY_CHARACTERS.get(arg, ''):
+            return True
+    return False
+
+
+def _sample(items, rng, groups):
+    """Generates a string matching a parsed regex, choosing branches and repeat counts at random."""
+    text = []
+    for op, arg in items:
+        if op is _sre.LITERAL:
+            text.append(chr(arg))
+        elif op is _sre.NOT_LITERAL or op is _sre.ANY:
+            text.append('y' if arg == ord('x') else 'x')
+        elif op is _sre.IN:
+            if arg[0][0] is _sre.NEGATE:
+                text.append(next(character for character in ' x/;(0' if not _in_set(character, arg[1:])))
+            else:
+                choice, value = rng.choice(arg)
+                if choice is _sre.LITERAL:
+                    text.append(chr(value))
+                elif choice is _sre.RANGE:
+                    text.append(chr(rng.randint(*value)))
+                else:
+                    text.append(_CATEGORY_CHARACTERS[value][0])
+        elif op is _sre.BRANCH:
+            text.append(_sample(rng.choice(arg[1]), rng, groups))
+        elif op is _sre.SUBPATTERN:
+            sub = _sample(arg[-1], rng, groups)
+            if arg[0]:
+                groups[arg[0]] = sub
+            text.append(sub)
+        elif op is _sre.MAX_REPEAT or op is _sre.MIN_REPEAT:
+            low, high, sub = arg
+            text.extend(_sample(sub, rng, groups) for _ in range(min(high, low + rng.randint(0, 2))))
+        elif op is _sre.GROUPREF:
+            text.append(groups.get(arg, ''))
+    return ''.join(text)
+
+
+def _regex_corpus(seed=3, attempts=4):
+    """
+    Returns a user agent for (nearly) every regex of ua-parser's user agent, OS and device lists, generated from the
+    regex itself, and the number of regexes covered.
+    """
+    from ua_parser import user_agent_parser
+    rng = random.Random(seed)
+    agents = []
+    parsers = user_agent_parser.USER_AGENT_PARSERS + user_agent_parser.OS_PARSERS + user_agent_parser.DEVICE_PARSERS
+    for parser in parsers:
+        pattern = parser.user_agent_re
+        tree = _sre_parse.parse(pattern.pattern, pattern.flags)
+        for _ in range(attempts):
+            agent = 'Mozilla/5.0 (' + _sample(tree, rng, dict()) + ')'
+            if pattern.search(agent):
+                agents.append(agent)
+                break
+    return agents, len(parsers)
+
+
+class TestRequiredLiterals(TestCase):
+    def test_literal_runs(self):
+        self.assertEqual(_literals(r'(Firefox)/(\d+)\.(\d+)'), [('Firefox',), ('/',), ('.',)])
+
+    def test_branch(self):
+        self.assertEqual(_literals(r'(?:Chrome|Opera)/(\d+)'), [('Chrome', 'Opera'), ('/',)])
+
+    def test_optional_parts_are_not_required(self):
+        self.assertEqual(_literals(r'(?:Mobile )?Safari(?:/\d+)*'), [('Safari',)])
+
+    def test_branch_without_literal(self):
+        self.assertEqual(_literals(r'(?:Opera|\d+)Mini'), [('Mini',)])
+
+
+class TestIndexedUserAgentParser(TestCase):
+    agents = [
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.186 '
+        'Safari/537.36',
+        'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 1.1.4322)',
+        'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) Gecko/20100101 Firefox/54.0',
+        'Mozilla/5.0 (iPhone; CPU iPhone OS 13_2_3 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+        'Version/13.0.3 Mobile/15E148 Safari/604.1',
+        'Mozilla/5.0 (Linux; Android 10; SM-G973F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.106 '
+        'Mobile Safari/537.36',
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 '
+        'Safari/605.1.15',
+        'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+        'Mozilla/5.0 (Linux; U; Android 4.0.3; ko-kr; LG-L160L Build/IML74K) AppleWebkit/534.30 (KHTML, like Gecko) '
+        'Version/4.0 Mobile Safari/534.30',
+        'Opera/9.80 (J2ME/MIDP; Opera Mini/9.80 (S60; SymbOS; Opera Mobi/23.348; U; en) Presto/2.5.25 Version/10.54',
+        'Googlebot-Image/1.0',
+        'curl/7.64.1',
+        'python-requests/2.25.1',
+        'hjkhsdfjkhjrkf',
+        'MOZILLA/5.0 (WINDOWS NT 10.0) GOOGLEBOT',
+        'Mozilla/5.0 (Kindle; Android 4.4) Silk/3.47',
+        '',
+    ]
+
+    def setUp(self):
+        self.parser = IndexedUserAgentParser()
+
+    def test_same_fields_as_parser(self):
+        for agent in self.agents:
+            self.assertEqual(self.parser(agent), utils._parse_user_agent_section(agent), agent)
+
+    def test_same_fields_as_parser_for_mutated_agents(self):
+        rng = random.Random(7)
+        tokens = [token for agent in self.agents for token in re.split(r'([ ;()/])', agent) if token]
+        for _ in range(300):
+            agent = ''.join(rng.choice(tokens) for _ in range(rng.randrange(1, 12)))
+            self.assertEqual(self.parser(agent), utils._parse_user_agent_section(agent), agent)
+
+    def test_same_fields_as_parser_for_every_regex(self):
+        # Agents generated from each ua-parser regex often match an earlier regex first, which checks that the
+        # index keeps ua-parser's order as well as its candidates.
+        agents, regexes = _regex_corpus()
+        self.assertGreater(len(agents), regexes * 0.9)
+        for agent in agents:
+            self.assertEqual(self.parser(agent), utils._parse_user_agent_section(agent), agent)
+
+    def test_index_is_built_once(self):
+        self.parser(self.agents[0])
+        domains = self.parser._domains
+        self.parser(self.agents[1])
+        self.assertIs(self.parser._domains, domains)
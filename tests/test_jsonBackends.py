@@ -0,0 +1,69 @@
+from unittest import TestCase, skipIf
+import datetime
+import io
+import json
+import structlog
+import structlog_extensions
+from structlog_extensions.jsonstream import orjson, resolve_json_backend
+
+
+class TestJSONBackends(TestCase):
+    def setUp(self):
+        self.event_dict = {'http.version': '1.1', 'user.name': 'Jürgen', 'event.created': datetime.datetime(2020, 1, 1),
+                           'error.object': ValueError('boom'), 'labels.count': 3}
+
+    def test_resolve_json_backend(self):
+        self.assertEqual(resolve_json_backend('json'), ('json', json.dumps))
+        self.assertEqual(resolve_json_backend('auto')[0], 'json' if orjson is None else 'orjson')
+        with self.assertRaises(ValueError):
+            resolve_json_backend('yaml')
+
+    def test_json_backend_bytes(self):
+        renderer = structlog_extensions.processors.NestedDictJSONRenderer(separator='.', backend='json', as_bytes=True)
+        rendered = renderer(None, 'info', dict(self.event_dict))
+        self.assertIsInstance(rendered, bytes)
+        self.assertEqual(rendered.decode('utf-8'),
+                         structlog_extensions.processors.NestedDictJSONRenderer(separator='.')(
+                             None, 'info', dict(self.event_dict)))
+
+    def test_streaming_bytes(self):
+        renderer = structlog_extensions.processors.NestedDictJSONRenderer(separator='.', streaming=True, as_bytes=True)
+        self.assertIsInstance(renderer(None, 'info', {'a.b': 1}), bytes)
+
+    def test_backend_and_serializer(self):
+        with self.assertRaises(ValueError):
+            structlog_extensions.processors.NestedDictJSONRenderer(json.dumps, separator='.', backend='json')
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_matches_json(self):
+        renderers = [structlog_extensions.processors.NestedDictJSONRenderer(separator='.', backend=backend)
+                     for backend in ('json', 'orjson')]
+        rendered = [json.loads(renderer(None, 'info', dict(self.event_dict))) for renderer in renderers]
+        self.assertEqual(rendered[0], rendered[1])
+        self.assertEqual(rendered[1]['event']['created'], repr(datetime.datetime(2020, 1, 1)))
+        self.assertEqual(rendered[1]['error']['object'], repr(ValueError('boom')))
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_big_integers(self):
+        event_dict = {'labels.big': 2 ** 70, 'labels.small': -2 ** 64, 'user.name': 'Jürgen'}
+        for kwargs in ({}, {'static_fields': {'service.name': 'shop'}}):
+            renderers = [structlog_extensions.processors.NestedDictJSONRenderer(separator='.', backend=backend,
+                                                                                **kwargs)
+                         for backend in ('json', 'orjson')]
+            rendered = [json.loads(renderer(None, 'info', dict(event_dict))) for renderer in renderers]
+            self.assertEqual(rendered[0], rendered[1])
+            self.assertEqual(rendered[1]['labels']['big'], 2 ** 70)
+        _, dumps = resolve_json_backend('orjson')
+        self.assertEqual(dumps({'a': [2 ** 70]}, indent=2), json.dumps({'a': [2 ** 70]}, indent=2).encode('utf-8'))
+        with self.assertRaises(TypeError):
+            dumps({'a': object()})
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_bytes_logger(self):
+        output = io.BytesIO()
+        logger = structlog.wrap_logger(
+            structlog.BytesLogger(output),
+            processors=[structlog_extensions.processors.NestedDictJSONRenderer(separator='.', backend='orjson',
+                                                                               as_bytes=True)])
+        logger.info('Test', **{'service.name': 'structlog_extensions'})
+        self.assertEqual(json.loads(output.getvalue()), {'event': 'Test', 'service': {'name': 'structlog_extensions'}})
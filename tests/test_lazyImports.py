@@ -0,0 +1,19 @@
+from unittest import TestCase
+import subprocess
+import sys
+
+_check = ('import sys, structlog_extensions; '
+          'print(",".join(sorted(name for name in ("user_agents", "ua_parser", "pytz") if name in sys.modules)))')
+
+
+class TestLazyImports(TestCase):
+    def _imported(self, code):
+        return subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout.strip()
+
+    def test_import_defers_heavy_dependencies(self):
+        self.assertEqual(self._imported(_check), '')
+
+    def test_warmup_loads_them(self):
+        self.assertEqual(self._imported(_check.replace('print(', 'structlog_extensions.warmup(); print(', 1)),
+                         'pytz,ua_parser,user_agents')
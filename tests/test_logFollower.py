@@ -0,0 +1,152 @@
+from unittest import TestCase
+import io
+import json
+import os
+import tempfile
+from structlog_extensions.__main__ import main
+from structlog_extensions.follow import LogFollower
+
+_line = '127.0.0.1 - - [05/Feb/2012:17:11:{0:02d} +0000] "GET /page/{1} HTTP/1.1" 200 {1} "-" "curl/7.{1}"\n'
+
+
+class TestLogFollower(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'access.log')
+        self.checkpoint = os.path.join(self.directory.name, 'follow.checkpoint')
+        self.output = io.BytesIO()
+        self.written = 0
+
+    def _follower(self, **kwargs):
+        kwargs.setdefault('checkpoint', self.checkpoint)
+        kwargs.setdefault('from_beginning', True)
+        follower = LogFollower([self.path], self.output, **kwargs)
+        self.addCleanup(follower.close)
+        return follower
+
+    def _append(self, count, path=None, partial=''):
+        with open(path or self.path, 'a') as log_file:
+            for _ in range(count):
+                log_file.write(_line.format(self.written % 60, self.written))
+                self.written += 1
+            log_file.write(partial)
+
+    def _pages(self):
+        documents = [json.loads(line) for line in self.output.getvalue().decode('utf-8').splitlines()]
+        return [int(document['url']['original'].rsplit('/', 1)[1]) for document in documents]
+
+    def test_follows_appended_lines(self):
+        self._append(3)
+        follower = self._follower()
+        self.assertEqual(follower.poll(), 3)
+        self.assertEqual(follower.poll(), 0)
+        self._append(2)
+        self.assertEqual(follower.poll(), 2)
+        self.assertEqual(self._pages(), [0, 1, 2, 3, 4])
+
+    def test_partial_line_waits_for_newline(self):
+        partial = _line.format(0, 99)
+        self._append(1, partial=partial[:20])
+        follower = self._follower()
+        self.assertEqual(follower.poll(), 1)
+        with open(self.path, 'a') as log_file:
+            log_file.write(partial[20:])
+        self.assertEqual(follower.poll(), 1)
+        self.assertEqual(self._pages(), [0, 99])
+
+    def test_starts_at_end_without_checkpoint(self):
+        self._append(3)
+        follower = self._follower(from_beginning=False, checkpoint=None)
+        self.assertEqual(follower.poll(), 0)
+        self._append(1)
+        follower.poll()
+        self.assertEqual(self._pages(), [3])
+
+    def test_rotation(self):
+        self._append(2)
+        follower = self._follower()
+        follower.poll()
+        self._append(2, partial=_line.format(0, 98).rstrip('\n'))
+        os.rename(self.path, self.path + '.1')
+        self.assertEqual(follower.poll(), 2)
+        self._append(1)
+        follower.poll()
+        self.assertEqual(self._pages(), [0, 1, 2, 3, 98, 4])
+        self.assertEqual(follower.stats()['rotations'], 1)
+
+    def test_truncation(self):
+        self._append(3)
+        follower = self._follower()
+        follower.poll()
+        with open(self.path, 'w'):
+            pass
+        self._append(1)
+        follower.poll()
+        self.assertEqual(self._pages(), [0, 1, 2, 3])
+        self.assertEqual(follower.stats()['truncations'], 1)
+
+    def test_file_created_later(self):
+        follower = self._follower(from_beginning=False)
+        self.assertEqual(follower.poll(), 0)
+        self._append(2)
+        self.assertEqual(follower.poll(), 2)
+
+    def test_resumes_from_checkpoint(self):
+        self._append(3)
+        follower = self._follower()
+        follower.poll()
+        follower.close()
+        self._append(2)
+        follower = self._follower(from_beginning=False)
+        follower.poll()
+        self.assertEqual(self._pages(), [0, 1, 2, 3, 4])
+
+    def test_resumes_rotated_file_from_checkpoint(self):
+        self._append(3)
+        follower = self._follower()
+        follower.poll()
+        follower.close()
+        self._append(2)
+        os.rename(self.path, self.path + '.1')
+        self._append(1)
+        follower = self._follower()
+        follower.poll()
+        self.assertEqual(self._pages(), [0, 1, 2, 3, 4, 5])
+
+    def test_checkpoint_file(self):
+        self._append(3)
+        follower = self._follower()
+        follower.poll()
+        with open(self.checkpoint) as checkpoint_file:
+            position = json.load(checkpoint_file)[os.path.abspath(self.path)]
+        self.assertEqual(position['offset'], os.path.getsize(self.path))
+        self.assertEqual(position['inode'], os.stat(self.path).st_ino)
+
+    def test_batches(self):
+        self._append(20)
+        follower = self._follower(read_size=300)
+        self.assertEqual(follower.poll(), 20)
+        self.assertEqual(self._pages(), list(range(20)))
+
+    def test_cli(self):
+        self._append(2)
+        output_path = os.path.join(self.directory.name, 'access.ndjson')
+        with open(self.path, 'a') as log_file:
+            log_file.write('garbage\n')
+        # Interrupt the follow loop after its first poll.
+        from structlog_extensions import follow
+
+        original_poll = follow.LogFollower.poll
+
+        def poll_once(follower):
+            original_poll(follower)
+            raise KeyboardInterrupt
+
+        follow.LogFollower.poll = poll_once
+        self.addCleanup(setattr, follow.LogFollower, 'poll', original_poll)
+        self.assertEqual(main(['follow', '--from-beginning', '--checkpoint', self.checkpoint, '-o', output_path,
+                               self.path]), 0)
+        with open(output_path) as output:
+            self.assertEqual(len(output.readlines()), 2)
+        self.assertTrue(os.path.exists(self.checkpoint))
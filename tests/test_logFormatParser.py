@@ -0,0 +1,61 @@
+from unittest import TestCase
+import logging
+import structlog_extensions
+from structlog_extensions.logformat import LogFormatParser, compile_log_format, COMBINED_LOG_FORMAT
+
+
+class TestLogFormatParser(TestCase):
+    def setUp(self):
+        self.combined_line = '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326 ' \
+                             '"http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"'
+
+    def test_combined_format(self):
+        fields = LogFormatParser(COMBINED_LOG_FORMAT).parse(self.combined_line)
+        self.assertEqual(fields, {'host': '127.0.0.1',
+                                  'user': 'frank',
+                                  'time': '10/Oct/2000:13:55:36 -0700',
+                                  'request': 'GET /apache_pb.gif HTTP/1.0',
+                                  'status': 200,
+                                  'size': 2326,
+                                  'referrer': 'http://www.example.com/start.html',
+                                  'agent': 'Mozilla/4.08 [en] (Win98; I ;Nav)'})
+
+    def test_gunicorn_format_with_extras(self):
+        parser = LogFormatParser('%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(L)s '
+                                 '%({x-request-id}i)s')
+        line = '10.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.1" 200 - "-" "curl/7.1" 0.001250 abc-123'
+        fields = parser.parse(line)
+        self.assertIsNone(fields['user'])
+        self.assertIsNone(fields['referrer'])
+        self.assertEqual(fields['size'], 0)
+        self.assertEqual(fields['duration'], 1250000)
+        self.assertEqual(fields['request_id'], 'abc-123')
+        self.assertEqual(parser.field_mappings['duration'], 'event.duration')
+
+    def test_apache_duration_and_headers(self):
+        parser = LogFormatParser('%h %l %u %t "%r" %>s %b %D "%{X-Forwarded-For}i"')
+        line = '127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 304 - 1500 "1.2.3.4, 5.6.7.8"'
+        fields = parser.parse(line)
+        self.assertEqual(fields['duration'], 1500000)
+        self.assertEqual(fields['http.request.headers.x_forwarded_for'], '1.2.3.4, 5.6.7.8')
+
+    def test_no_match(self):
+        self.assertEqual(LogFormatParser().parse('Lorem ipsum dolor sit amet'), {})
+
+    def test_unsupported_directive(self):
+        with self.assertRaises(ValueError):
+            LogFormatParser('%h %{%Y}t')
+
+    def test_compile_is_cached(self):
+        self.assertIs(compile_log_format(COMBINED_LOG_FORMAT), compile_log_format(COMBINED_LOG_FORMAT))
+
+    def test_combined_log_parser_log_format(self):
+        logparser = structlog_extensions.processors.CombinedLogParser(
+            "gunicorn.access", log_format='%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s')
+        event_dict = {'event': '127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET / HTTP/1.1" 200 140 "-" "curl/7.1" 42'}
+        result = logparser(logging.Logger("gunicorn.access"), "info", event_dict)
+        self.assertEqual(result['event.duration'], 42000)
+        self.assertEqual(result['http.request.method'], 'get')
+        self.assertEqual(result['@timestamp'], '2012-02-05T17:11:55+00:00')
+        self.assertNotIn('request', result)
+        self.assertNotIn('agent', result)
@@ -0,0 +1,52 @@
+from unittest import TestCase
+import structlog_extensions
+from structlog_extensions.utils import NestingPlanCache, unflatten_dict
+
+
+class TestNestingPlan(TestCase):
+    def test_nested(self):
+        flat = {'http.request.method': 'get', 'http.request.referrer': 'http://www.example.com', 'http.version': '1.0',
+                'message': 'test'}
+        self.assertEqual(unflatten_dict(flat), {'http': {'request': {'method': 'get',
+                                                                     'referrer': 'http://www.example.com'},
+                                                         'version': '1.0'},
+                                                'message': 'test'})
+
+    def test_conflict_independent_of_order(self):
+        expected = {'event': {'original': 'raw', 'dataset': 'access'}}
+        self.assertEqual(unflatten_dict({'event': 'GET /', 'event.original': 'raw', 'event.dataset': 'access'}),
+                         expected)
+        self.assertEqual(unflatten_dict({'event.original': 'raw', 'event.dataset': 'access', 'event': 'GET /'}),
+                         expected)
+
+    def test_dict_value_merged(self):
+        flat = {'service.name': 'api', 'service': {'name': 'ignored', 'version': '1.0'}}
+        self.assertEqual(unflatten_dict(flat), {'service': {'name': 'api', 'version': '1.0'}})
+        self.assertEqual(flat['service'], {'name': 'ignored', 'version': '1.0'})
+
+    def test_custom_separator(self):
+        self.assertEqual(unflatten_dict({'a_b': 1, 'a_c': 2}, '_'), {'a': {'b': 1, 'c': 2}})
+
+    def test_plan_cache_bounded(self):
+        cache = NestingPlanCache('.', maxsize=3)
+        for index in range(10):
+            self.assertEqual(cache.unflatten({'key{0}.x'.format(index): index}), {'key{0}'.format(index): {'x': index}})
+        self.assertEqual(len(cache), 3)
+        keys = ('a.b', 'a.c')
+        self.assertIs(cache.plan(keys), cache.plan(keys))
+
+    def test_unflatten_dict_uses_plan_cache(self):
+        plans = structlog_extensions.utils._unflatten_plans
+        unflatten_dict({'cached.a': 1, 'cached.b': 2})
+        misses = plans.misses
+        self.assertEqual(unflatten_dict({'cached.a': 3, 'cached.b': 4}), {'cached': {'a': 3, 'b': 4}})
+        self.assertEqual(plans.misses, misses)
+        self.assertEqual(unflatten_dict({'cached.a': 3, 'cached.b': 4}, '_'), {'cached.a': 3, 'cached.b': 4})
+        self.assertEqual(plans.misses, misses + 1)
+
+    def test_renderer_uses_plan_cache(self):
+        renderer = structlog_extensions.processors.NestedDictJSONRenderer(separator='.')
+        for _ in range(3):
+            self.assertEqual(renderer(None, 'info', {'http.version': '1.1', 'event': 'x'}),
+                             '{"http": {"version": "1.1"}, "event": "x"}')
+        self.assertEqual(len(renderer.plan_cache), 1)
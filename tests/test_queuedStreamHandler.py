@@ -0,0 +1,136 @@
+from unittest import TestCase
+import io
+import json
+import logging
+import threading
+import structlog
+import structlog_extensions
+from structlog_extensions.handlers import QueuedStreamHandler, flush_queued_handlers
+
+
+class _GatedFormatter(logging.Formatter):
+    """Formatter that blocks until the test opens the gate, to fill up the queue deterministically."""
+
+    def __init__(self):
+        super().__init__('%(message)s')
+        self.gate = threading.Event()
+        self.thread_names = set()
+
+    def format(self, record):
+        self.gate.wait()
+        self.thread_names.add(threading.current_thread().name)
+        return super().format(record)
+
+
+class TestQueuedStreamHandler(TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.logger = logging.Logger('test.queued')
+
+    def _handler(self, **kwargs):
+        handler = QueuedStreamHandler(self.stream, **kwargs)
+        handler.setFormatter(_GatedFormatter())
+        self.logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def _fill(self, handler, count):
+        for index in range(count):
+            self.logger.warning('line %d', index)
+
+    def test_formats_off_thread(self):
+        handler = self._handler()
+        self._fill(handler, 3)
+        self.assertEqual(self.stream.getvalue(), '')
+        handler.formatter.gate.set()
+        self.assertTrue(flush_queued_handlers(timeout=5))
+        self.assertEqual(self.stream.getvalue(), 'line 0\nline 1\nline 2\n')
+        self.assertNotIn(threading.current_thread().name, handler.formatter.thread_names)
+
+    def test_drop_newest(self):
+        handler = self._handler(capacity=2, policy='drop_newest')
+        self._fill(handler, 6)
+        handler.formatter.gate.set()
+        handler.flush(timeout=5)
+        stats = handler.stats()
+        # One record may already have been taken off the queue by the worker thread.
+        self.assertIn(stats['dropped_newest'], (3, 4))
+        self.assertEqual(stats['processed'], 6 - stats['dropped_newest'])
+        self.assertTrue(self.stream.getvalue().startswith('line 0\nline 1\n'))
+
+    def test_drop_oldest(self):
+        handler = self._handler(capacity=2, policy='drop_oldest')
+        self._fill(handler, 6)
+        handler.formatter.gate.set()
+        handler.flush(timeout=5)
+        self.assertIn(handler.stats()['dropped_oldest'], (3, 4))
+        self.assertTrue(self.stream.getvalue().endswith('line 4\nline 5\n'))
+
+    def test_block_timeout(self):
+        handler = self._handler(capacity=1, policy='block', block_timeout=0.01)
+        self._fill(handler, 4)
+        handler.formatter.gate.set()
+        handler.flush(timeout=5)
+        self.assertGreater(handler.stats()['dropped_newest'], 0)
+
+    def test_close_drains(self):
+        handler = self._handler(capacity=100, workers=2)
+        handler.formatter.gate.set()
+        self._fill(handler, 50)
+        handler.close()
+        self.assertEqual(len(self.stream.getvalue().splitlines()), 50)
+        self.logger.warning('after close')
+        self.assertTrue(self.stream.getvalue().endswith('after close\n'))
+
+    def test_prepares_records_on_logging_thread(self):
+        handler = self._handler()
+        values = ['before']
+        self.logger.warning('values %s', values)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed')
+        values.append('after')
+        handler.formatter.gate.set()
+        handler.flush(timeout=5)
+        output = self.stream.getvalue()
+        self.assertTrue(output.startswith("values ['before']\nfailed\nTraceback"))
+        self.assertIn('ValueError: boom', output)
+
+    def test_contextvars_in_foreign_pre_chain(self):
+        gate = threading.Event()
+
+        def wait(logger, method_name, event_dict):
+            gate.wait()
+            return event_dict
+
+        handler = QueuedStreamHandler(self.stream)
+        handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+            processor=structlog.processors.JSONRenderer(),
+            foreign_pre_chain=[wait, structlog.contextvars.merge_contextvars]))
+        self.addCleanup(handler.close)
+        self.logger.addHandler(handler)
+        self.addCleanup(structlog.contextvars.clear_contextvars)
+        structlog.contextvars.bind_contextvars(request_id='r1')
+        self.logger.warning('one')
+        structlog.contextvars.bind_contextvars(request_id='r2')
+        gate.set()
+        handler.flush(timeout=5)
+        self.assertEqual(json.loads(self.stream.getvalue()), {'event': 'one', 'request_id': 'r1'})
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            QueuedStreamHandler(self.stream, policy='ignore')
+
+    def test_combined_log_pipeline(self):
+        handler = QueuedStreamHandler(self.stream)
+        handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+            processor=structlog_extensions.processors.NestedDictJSONRenderer(separator='.', clean_keys=['event']),
+            foreign_pre_chain=[structlog.stdlib.add_logger_name,
+                               structlog_extensions.processors.CombinedLogParser('gunicorn.access')]))
+        self.addCleanup(handler.close)
+        logger = logging.Logger('gunicorn.access')
+        logger.addHandler(handler)
+        logger.info('127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET / HTTP/1.1" 200 140 "-" "curl/7.1"')
+        handler.flush(timeout=5)
+        self.assertEqual(json.loads(self.stream.getvalue())['http']['response']['status_code'], 200)
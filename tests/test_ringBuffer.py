@@ -0,0 +1,186 @@
+from unittest import TestCase, skipUnless
+import io
+import json
+import logging
+import multiprocessing
+import os
+import structlog
+import structlog_extensions
+from structlog_extensions import ringbuffer
+from structlog_extensions.ringbuffer import RingBufferCollector, RingBufferHandler
+
+
+class _Worker:
+    """Stands in for a gunicorn worker object in the server hooks."""
+
+
+def _log_lines(collector, worker, count):
+    collector.post_fork(None, worker)
+    logger = logging.Logger('test.ringbuffer')
+    handler = RingBufferHandler()
+    handler.setFormatter(logging.Formatter('{"worker": %(worker)d, "line": %(line)d, "padding": "%(message)s"}'))
+    logger.addHandler(handler)
+    for line in range(count):
+        logger.info('x' * (line % 300), extra={'worker': os.getpid(), 'line': line})
+    logging.shutdown()
+
+
+class TestRingBuffer(TestCase):
+    def setUp(self):
+        self.output = io.BytesIO()
+        self.collector = RingBufferCollector(slots=2, slot_size=1024, stream=self.output)
+        self.addCleanup(self.collector.close)
+        self.addCleanup(setattr, ringbuffer, '_writer', None)
+        self.fallback = io.StringIO()
+        self.handler = RingBufferHandler(self.fallback)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.Logger('test.ringbuffer')
+        self.logger.addHandler(self.handler)
+
+    def _attach(self):
+        worker = _Worker()
+        self.collector.pre_fork(None, worker)
+        self.collector.post_fork(None, worker)
+        return worker
+
+    def _lines(self):
+        return self.output.getvalue().decode('utf-8').splitlines()
+
+    def test_collects_lines(self):
+        self._attach()
+        self.logger.info('one')
+        self.logger.info('two')
+        self.assertEqual(self.output.getvalue(), b'')
+        self.assertEqual(self.collector.collect(), 2)
+        self.assertEqual(self.output.getvalue(), b'one\ntwo\n')
+        self.assertEqual(self.collector.stats()['writes'], 1)
+        self.assertEqual(self.fallback.getvalue(), '')
+
+    def test_without_slot_writes_to_stream(self):
+        self.logger.info('one')
+        self.assertEqual(self.fallback.getvalue(), 'one\n')
+        self.assertEqual(self.collector.collect(), 0)
+
+    def test_wraps_around(self):
+        self._attach()
+        expected = []
+        for index in range(200):
+            message = '{0} {1}'.format(index, 'x' * (index % 97))
+            self.logger.info(message)
+            expected.append(message)
+            if index % 7 == 0:
+                self.collector.collect()
+        self.collector.collect()
+        self.assertEqual(self._lines(), expected)
+        self.assertEqual(self.collector.stats()['dropped'], 0)
+
+    def test_waits_for_records_that_are_not_visible_yet(self):
+        self._attach()
+        ring = ringbuffer._writer
+        self.logger.info('one')
+        # What a consumer on a weakly ordered CPU may see: the new head, but not yet the record's last byte.
+        last = ring.data + ring._get(ringbuffer._HEAD) - 1
+        ring.buffer[last] = 0
+        self.assertEqual(self.collector.collect(), 0)
+        ring.buffer[last] = ord('\n')
+        self.assertEqual(self.collector.collect(), 1)
+        self.assertEqual(self._lines(), ['one'])
+
+    def test_ignores_records_of_earlier_laps(self):
+        self._attach()
+        ring = ringbuffer._writer
+        self.logger.info('x' * 100)
+        self.collector.collect()
+        # Pretend the producer published one lap later without having written the record there.
+        stale = ring.capacity
+        ring._set(ringbuffer._TAIL, stale)
+        ring._set(ringbuffer._HEAD, stale + ringbuffer._RECORD.size + 101)
+        self.assertEqual(self.collector.collect(), 0)
+
+    def test_overflow(self):
+        self._attach()
+        for index in range(30):
+            self.logger.info('{0:02d} {1}'.format(index, 'x' * 90))
+        self.logger.info('y' * 2000)
+        stats = self.collector.stats()
+        self.assertEqual(stats['written'] + stats['dropped'], 31)
+        self.assertEqual(stats['dropped'], self.handler.dropped)
+        self.assertGreater(stats['dropped'], 1)
+        self.collector.collect()
+        self.assertEqual(self._lines(), ['{0:02d} {1}'.format(index, 'x' * 90) for index in range(stats['written'])])
+        self.logger.info('after')
+        self.collector.collect()
+        self.assertEqual(self._lines()[-1], 'after')
+
+    def test_child_exit_collects_and_frees_slot(self):
+        first = self._attach()
+        self.logger.info('one')
+        second = _Worker()
+        self.collector.pre_fork(None, second)
+        third = _Worker()
+        self.collector.pre_fork(None, third)
+        self.assertIsNone(third.ring_slot)
+        self.assertEqual(self.collector.stats()['unassigned'], 1)
+        self.collector.child_exit(None, first)
+        self.assertEqual(self.output.getvalue(), b'one\n')
+        fourth = _Worker()
+        self.collector.pre_fork(None, fourth)
+        self.assertEqual(fourth.ring_slot, first.ring_slot)
+
+    def test_background_thread(self):
+        self._attach()
+        self.collector.on_starting(None)
+        self.logger.info('one')
+        self.collector.stop()
+        self.assertEqual(self.output.getvalue(), b'one\n')
+
+    def test_attach(self):
+        self._attach()
+        self.logger.info('one')
+        output = io.BytesIO()
+        sidecar = RingBufferCollector.attach(self.collector.name, stream=output)
+        self.addCleanup(sidecar.close)
+        self.assertEqual(sidecar.slots, 2)
+        self.assertEqual(sidecar.collect(), 1)
+        self.assertEqual(output.getvalue(), b'one\n')
+
+    def test_invalid_configuration(self):
+        with self.assertRaises(ValueError):
+            RingBufferCollector(slots=0)
+        with self.assertRaises(ValueError):
+            RingBufferCollector(slot_size=64)
+
+    def test_nested_dict_json_renderer(self):
+        self._attach()
+        self.handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+            processor=structlog_extensions.processors.NestedDictJSONRenderer(separator='.'),
+            foreign_pre_chain=[structlog.stdlib.add_log_level]))
+        self.logger.info('one')
+        self.collector.collect()
+        self.assertEqual(json.loads(self._lines()[0]), {'event': 'one', 'level': 'info'})
+
+    @skipUnless('fork' in multiprocessing.get_all_start_methods(), 'needs fork')
+    def test_workers(self):
+        collector = RingBufferCollector(slots=4, slot_size=256 * 1024, stream=io.BytesIO())
+        self.addCleanup(collector.close)
+        collector.start()
+        context = multiprocessing.get_context('fork')
+        processes = []
+        for _ in range(3):
+            worker = _Worker()
+            collector.pre_fork(None, worker)
+            process = context.Process(target=_log_lines, args=(collector, worker, 500))
+            process.start()
+            processes.append((process, worker))
+        for process, worker in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+            collector.child_exit(None, worker)
+        collector.stop()
+        stats = collector.stats()
+        lines = [json.loads(line) for line in collector.stream.getvalue().decode('utf-8').splitlines()]
+        self.assertEqual((stats['written'], stats['dropped'], stats['collected']), (1500, 0, 1500))
+        for process, _ in processes:
+            worker_lines = [line['line'] for line in lines if line['worker'] == process.pid]
+            self.assertEqual(worker_lines, list(range(500)))
+        self.assertEqual(stats['assigned'], 0)
@@ -0,0 +1,68 @@
+from unittest import TestCase, skipIf
+import json
+from structlog_extensions.jsonstream import orjson
+from structlog_extensions.processors import NestedDictJSONRenderer
+
+_static_fields = {'service.name': 'shop', 'service.version': '1.2.0', 'host.hostname': 'web-1',
+                  'event.dataset': 'apache.access', 'ecs.version': '1.0.0'}
+
+_events = [
+    {'http.request.method': 'get', 'http.response.status_code': 200, 'event.original': 'GET /', 'level': 'info'},
+    {'event': 'started', 'level': 'info', 'logger': 'app'},
+    {'service.version': '2.0.0', 'service.environment': 'test'},
+    {'host': 'overridden', 'message': 'root value'},
+    {'service': {'name': 'dict value', 'node': {'name': 'n1'}}},
+    {},
+]
+
+
+class TestStaticFields(TestCase):
+    def _assert_same_output(self, **kwargs):
+        renderer = NestedDictJSONRenderer(separator='.', static_fields=_static_fields, **kwargs)
+        reference = NestedDictJSONRenderer(separator='.', **kwargs)
+        for event_dict in _events * 2:
+            rendered = renderer(None, 'info', dict(event_dict))
+            expected = reference(None, 'info', {**_static_fields, **event_dict})
+            self.assertEqual(json.loads(rendered), json.loads(expected), event_dict)
+        return renderer
+
+    def test_same_output_as_fields_in_event(self):
+        self._assert_same_output()
+
+    def test_streaming(self):
+        self._assert_same_output(streaming=True)
+
+    def test_as_bytes(self):
+        renderer = self._assert_same_output(as_bytes=True)
+        self.assertIsInstance(renderer(None, 'info', {'a': 1}), bytes)
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        self._assert_same_output(backend='orjson')
+
+    def test_merges_into_shared_parent(self):
+        renderer = NestedDictJSONRenderer(separator='.', static_fields=_static_fields)
+        rendered = json.loads(renderer(None, 'info', {'event.original': 'GET /', 'service.version': '2.0.0'}))
+        self.assertEqual(rendered['event'], {'dataset': 'apache.access', 'original': 'GET /'})
+        self.assertEqual(rendered['service'], {'name': 'shop', 'version': '2.0.0'})
+        self.assertEqual(rendered['host'], {'hostname': 'web-1'})
+
+    def test_splices_rendered_text(self):
+        renderer = NestedDictJSONRenderer(separator='.', static_fields={'service.name': 'shop'})
+        self.assertEqual(renderer(None, 'info', {'level': 'info'}),
+                         '{"service": {"name": "shop"}, "level": "info"}')
+        self.assertEqual(renderer(None, 'info', {}), '{"service": {"name": "shop"}}')
+        compact = NestedDictJSONRenderer(separator='.', static_fields={'service.name': 'shop'},
+                                         separators=(',', ':'))
+        self.assertEqual(compact(None, 'info', {'level': 'info'}), '{"service":{"name":"shop"},"level":"info"}')
+
+    def test_key_order(self):
+        renderer = NestedDictJSONRenderer(separator='.', static_fields={'event.dataset': 'web', 'host.name': 'h1'})
+        self.assertEqual(renderer(None, 'info', {'level': 'info', 'event.original': 'GET /'}),
+                         '{"host": {"name": "h1"}, "event": {"dataset": "web", "original": "GET /"}, "level": "info"}')
+
+    def test_invalid_configuration(self):
+        with self.assertRaises(ValueError):
+            NestedDictJSONRenderer(separator='.', static_fields=_static_fields, indent=2)
+        with self.assertRaises(ValueError):
+            NestedDictJSONRenderer(separator='.', static_fields=_static_fields, sort_keys=True)
@@ -0,0 +1,49 @@
+from unittest import TestCase
+from datetime import datetime, timedelta, timezone
+import time
+import pytz
+import structlog_extensions.utils as utils
+from structlog_extensions.timestamps import CoarseClock, TimestampCache, offset_tzinfo, parse_combined_timestamp
+
+
+def _strptime_reference(timestamp):
+    dt = datetime.strptime(timestamp[0:-6], '%d/%b/%Y:%H:%M:%S')
+    minutes = int(timestamp[-4:-2]) * 60 + int(timestamp[-2:])
+    return dt.replace(tzinfo=pytz.FixedOffset(-minutes if timestamp[-5] == '-' else minutes))
+
+
+class TestTimestamps(TestCase):
+    def test_matches_strptime(self):
+        start = datetime(2019, 12, 31, 23, 59, 0)
+        for offset in ['+0000', '-0700', '+0530', '-0330', '+1400']:
+            for seconds in range(0, 86400 * 400, 31337):
+                timestamp = (start + timedelta(seconds=seconds)).strftime('%d/%b/%Y:%H:%M:%S ') + offset
+                expected = _strptime_reference(timestamp)
+                self.assertEqual(parse_combined_timestamp(timestamp), expected)
+                self.assertEqual(utils.combined_log_timestring_to_iso(timestamp), expected.isoformat())
+
+    def test_negative_half_hour_offset(self):
+        self.assertEqual(utils.combined_log_timestring_to_iso('10/Oct/2000:13:55:36 -0330'),
+                         '2000-10-10T13:55:36-03:30')
+
+    def test_tzinfo_cached(self):
+        self.assertIs(offset_tzinfo('-0700'), offset_tzinfo('-0700'))
+
+    def test_invalid_timestamp(self):
+        with self.assertRaises(ValueError):
+            parse_combined_timestamp('10/Foo/2000:13:55:36 -0700')
+
+    def test_cache_bounded(self):
+        cache = TimestampCache(maxsize=2)
+        for second in range(10):
+            self.assertEqual(cache('10/Oct/2000:13:55:{0:02d} +0000'.format(second)),
+                             '2000-10-10T13:55:{0:02d}+00:00'.format(second))
+        self.assertLessEqual(len(cache._rendered), 2)
+
+    def test_coarse_clock(self):
+        clock = CoarseClock(tick=60)
+        first = clock()
+        self.assertIs(clock(), first)
+        created = datetime.fromisoformat(first)
+        self.assertEqual(created.tzinfo, timezone.utc)
+        self.assertLess(abs(time.time() - created.timestamp()), 5)
@@ -0,0 +1,57 @@
+from unittest import TestCase
+import logging
+import threading
+import structlog_extensions
+import structlog_extensions.utils as utils
+from structlog_extensions.useragent import UserAgentCache
+
+
+class TestUserAgentCache(TestCase):
+    def setUp(self):
+        self.agents = ['Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) Gecko/20100101 Firefox/54.0',
+                       'Googlebot-Image/1.0',
+                       'hjkhsdfjkhjrkf']
+
+    def test_same_fields_as_parser(self):
+        cache = UserAgentCache(maxsize=8)
+        for agent in self.agents * 2:
+            self.assertEqual(cache(agent), utils._parse_user_agent_section(agent))
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 3, 'evictions': 0, 'size': 3, 'maxsize': 8})
+
+    def test_eviction(self):
+        cache = UserAgentCache(maxsize=2)
+        cache(self.agents[0])
+        cache(self.agents[1])
+        cache(self.agents[0])
+        cache(self.agents[2])
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 2)
+        cache(self.agents[0])
+        self.assertEqual(cache.hits, 2)
+
+    def test_thread_safety(self):
+        cache = UserAgentCache(maxsize=2)
+
+        def worker():
+            for _ in range(200):
+                for agent in self.agents:
+                    cache(agent)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 4 * 200 * len(self.agents))
+        self.assertLessEqual(stats['size'], 2)
+
+    def test_combined_log_parser_cache_size(self):
+        logger = logging.Logger("gunicorn.access")
+        line = '127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET / HTTP/1.1" 200 140 "-" "Googlebot-Image/1.0"'
+        logparser = structlog_extensions.processors.CombinedLogParser("gunicorn.access", ua_cache_size=16)
+        for _ in range(3):
+            result = logparser(logger, "info", {'event': line})
+            self.assertEqual(result['user_agent.name'], 'Googlebot-Image')
+        self.assertEqual(logparser.ua_cache.stats()['hits'], 2)
+        self.assertIsNone(structlog_extensions.processors.CombinedLogParser("gunicorn.access", ua_cache_size=0).ua_cache)
@@ -0,0 +1,60 @@
+from unittest import TestCase
+import gzip
+import logging
+import os
+import tempfile
+import structlog_extensions
+import structlog_extensions.utils as utils
+from structlog_extensions.__main__ import main
+from structlog_extensions.useragent import UserAgentTable, build_user_agent_table
+
+_line = '127.0.0.1 - - [05/Feb/2012:17:11:55 +0000] "GET / HTTP/1.1" 200 140 "-" "{0}"\n'
+
+
+class TestUserAgentTable(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.agents = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                       'Chrome/64.0.3282.186 Safari/537.36',
+                       'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 1.1.4322)',
+                       'Googlebot-Image/1.0',
+                       'hjkhsdfjkhjrkf']
+        self.log_path = os.path.join(self.directory.name, 'access.log.gz')
+        with gzip.open(self.log_path, 'wt') as log_file:
+            for agent in self.agents + self.agents[:2]:
+                log_file.write(_line.format(agent))
+            log_file.write('not an access log line\n')
+        self.table_path = os.path.join(self.directory.name, 'user_agents.table')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_lookup_matches_parser(self):
+        self.assertEqual(build_user_agent_table([self.log_path], self.table_path), len(self.agents))
+        table = UserAgentTable(self.table_path)
+        try:
+            self.assertEqual(len(table), len(self.agents))
+            for agent in self.agents:
+                self.assertEqual(table.get(agent), utils._parse_user_agent_section(agent))
+            self.assertIsNone(table.get('Unknown/1.0'))
+            self.assertEqual(table('Firefox/54.0')['user_agent.original'], 'Firefox/54.0')
+            self.assertEqual(table.misses, 1)
+        finally:
+            table.close()
+
+    def test_min_count(self):
+        self.assertEqual(build_user_agent_table([self.log_path], self.table_path, min_count=2), 2)
+
+    def test_not_a_table(self):
+        with open(self.table_path, 'wb') as table_file:
+            table_file.write(b'\x00' * 32)
+        with self.assertRaises(ValueError):
+            UserAgentTable(self.table_path)
+
+    def test_cli_and_combined_log_parser(self):
+        self.assertEqual(main(['build-ua-table', self.table_path, self.log_path]), 0)
+        logparser = structlog_extensions.processors.CombinedLogParser("gunicorn.access", ua_table=self.table_path)
+        result = logparser(logging.Logger("gunicorn.access"), "info", {'event': _line.format(self.agents[2]).strip()})
+        self.assertEqual(result['user_agent.name'], 'Googlebot-Image')
+        self.assertEqual(logparser.ua_table.hits, 1)
+        logparser.ua_table.close()